@@ -0,0 +1,255 @@
+from extract_global import GlobalParser, RACES
+
+import sys
+import time
+from absl import app
+from absl import flags
+
+import numpy as np
+
+from pysc2.lib.units import Neutral
+from s2clientprotocol import sc2api_pb2 as sc_pb
+
+FLAGS = flags.FLAGS
+flags.DEFINE_string(name='player_race', default='Protoss',
+                    help='Player race')
+flags.DEFINE_string(name='enemy_race', default='Terran',
+                    help='Enemy race')
+
+flags.DEFINE_integer(name='n_obs', default=200,
+                     help='# of synthetic observations')
+flags.DEFINE_integer(name='n_units', default=400,
+                     help='# of units per observation')
+flags.DEFINE_integer(name='repeats', default=5,
+                     help='# of timed runs, best is reported')
+flags.DEFINE_integer(name='seed', default=0,
+                     help='Random seed')
+
+
+class LegacyGlobalParser(GlobalParser):
+    """GlobalParser with the original per-unit loops and per-type tag sets, kept as the reference for benchmarking"""
+
+    def __init__(self, player_race, enemy_race):
+        super(LegacyGlobalParser, self).__init__(player_race, enemy_race)
+        self.enemy_tags = [set() for _ in self.enemy_unit_map]
+
+    def extract(self, obs):
+        upgrades = self.get_upgrades(obs)
+        allied_alive, allied_hp = self.get_allied_alive(obs)
+        allied_construction, allied_percent = self.get_allied_construction(obs)
+        enemy_visible, enemy_hp = self.get_enemy_visible(obs)
+        enemy_construction, enemy_percent = self.get_enemy_construction(obs)
+        enemy_killed = self.get_enemy_killed(obs)
+
+        return np.concatenate((
+            upgrades,
+            allied_alive, allied_hp,
+            allied_construction, allied_percent,
+            enemy_visible, enemy_hp,
+            enemy_construction, enemy_percent,
+            enemy_killed))
+
+    def get_unit_idx(self, type_map, unit_type):
+        if unit_type in self.id_alias:
+            unit_type = self.id_alias[unit_type]
+
+        if unit_type in type_map:
+            return type_map[unit_type]
+        else:
+            print('Unknown unit (neural parasite?):', unit_type)
+            return None
+
+    def get_allied_alive(self, obs):
+        count = np.zeros(len(self.player_unit_map))
+        hp = np.zeros(len(self.player_unit_map))
+
+        for unit in obs.raw_data.units:
+            if unit.alliance == 1 and unit.build_progress >= 1:
+                idx = self.get_unit_idx(self.player_unit_map, unit.unit_type)
+                if idx is not None:
+                    count[idx] += 1
+                    hp[idx] += (unit.health + unit.shield) / (unit.health_max + unit.shield_max)
+
+                    for passenger in unit.passengers:
+                        idx = self.get_unit_idx(self.player_unit_map, passenger.unit_type)
+                        if idx is not None:
+                            count[idx] += 1
+                            hp[idx] += (passenger.health + passenger.shield) / (passenger.health_max + passenger.shield_max)
+
+        for idx, num in np.ndenumerate(count):
+            if num > 0:
+                hp[idx] /= num
+
+        return (count, hp)
+
+    def get_allied_construction(self, obs):
+        count = np.zeros(len(self.player_unit_map))
+        percentage = np.zeros(len(self.player_unit_map))
+
+        for unit in obs.raw_data.units:
+            if unit.alliance == 1 and unit.build_progress < 1:
+                idx = self.get_unit_idx(self.player_unit_map, unit.unit_type)
+                if idx is not None:
+                    count[idx] += 1
+                    percentage[idx] += unit.build_progress
+
+        for idx, num in np.ndenumerate(count):
+            if num > 0:
+                percentage[idx] /= num
+
+        return (count, percentage)
+
+    def get_enemy_visible(self, obs):
+        count = np.zeros(len(self.enemy_unit_map))
+        hp = np.zeros(len(self.enemy_unit_map))
+
+        for unit in obs.raw_data.units:
+            if unit.alliance == 4 and unit.display_type == 1 and unit.build_progress >= 1:
+                idx = self.get_unit_idx(self.enemy_unit_map, unit.unit_type)
+                if idx is not None:
+                    count[idx] += 1
+                    hp[idx] += (unit.health + unit.shield) / (unit.health_max + unit.shield_max)
+                    self.enemy_tags[idx].add(unit.tag)
+
+        for idx, num in np.ndenumerate(count):
+            if num > 0:
+                hp[idx] /= num
+
+        return (count, hp)
+
+    def get_enemy_construction(self, obs):
+        count = np.zeros(len(self.enemy_unit_map))
+        percentage = np.zeros(len(self.enemy_unit_map))
+
+        for unit in obs.raw_data.units:
+            if unit.alliance == 4 and unit.display_type == 1 and unit.build_progress < 1:
+                idx = self.get_unit_idx(self.enemy_unit_map, unit.unit_type)
+                if idx is not None:
+                    count[idx] += 1
+                    percentage[idx] += unit.build_progress
+                    self.enemy_tags[idx].add(unit.tag)
+
+        for idx, num in np.ndenumerate(count):
+            if num > 0:
+                percentage[idx] /= num
+
+        return (count, percentage)
+
+
+    def get_enemy_killed(self, obs, dead_units=None):
+        dead_tags = set(obs.raw_data.event.dead_units if dead_units is None else dead_units)
+
+        count = np.zeros(len(self.enemy_unit_map))
+
+        for idx, tags in enumerate(self.enemy_tags):
+            remaining_tags = tags - dead_tags
+            count[idx] = len(tags) - len(remaining_tags)
+            self.enemy_tags[idx] = remaining_tags
+
+        return count
+
+
+class UnitParser(GlobalParser):
+    """GlobalParser reduced to the unit features, so the benchmark times the unit passes only"""
+
+    def extract(self, obs):
+        return np.concatenate((self.get_upgrades(obs),) + self.get_units(obs) + (self.get_enemy_killed(obs),))
+
+
+def synthetic_observations(rng, player_race, enemy_race, n_obs, n_units):
+    """Observations with a stable population of allied, enemy and neutral units where some die every step"""
+    player_types = [unit_id.value for unit_id in RACES[player_race]]
+    enemy_types = [unit_id.value for unit_id in RACES[enemy_race]]
+    neutral_types = [unit_id.value for unit_id in Neutral]
+
+    next_tag = 1
+    enemy_alive = []
+    observations = []
+
+    for loop in range(n_obs):
+        obs = sc_pb.Observation(game_loop=loop * 72)
+
+        for _ in range(n_units):
+            unit = obs.raw_data.units.add()
+            unit.alliance = rng.choice([1, 3, 4], p=[0.45, 0.1, 0.45])
+            unit.display_type = rng.choice([1, 2], p=[0.8, 0.2])
+            unit.build_progress = 1 if rng.random() < 0.9 else rng.random()
+            unit.health_max = rng.integers(20, 500)
+            unit.shield_max = rng.integers(0, 200)
+            unit.health = rng.integers(1, unit.health_max + 1)
+            unit.shield = rng.integers(0, unit.shield_max + 1)
+
+            if unit.alliance == 1:
+                unit.unit_type = rng.choice(player_types)
+                if rng.random() < 0.02:
+                    for _ in range(rng.integers(1, 5)):
+                        passenger = unit.passengers.add(unit_type=rng.choice(player_types),
+                                                        health_max=rng.integers(20, 200), shield_max=rng.integers(0, 50))
+                        passenger.health = rng.integers(1, passenger.health_max + 1)
+            elif unit.alliance == 4:
+                unit.unit_type = rng.choice(enemy_types)
+                if len(enemy_alive) > 0 and rng.random() < 0.5:
+                    unit.tag = enemy_alive[rng.integers(len(enemy_alive))]
+                else:
+                    unit.tag = next_tag
+                    enemy_alive.append(next_tag)
+                    next_tag += 1
+                continue
+            else:
+                unit.unit_type = rng.choice(neutral_types)
+
+            unit.tag = next_tag
+            next_tag += 1
+
+        for _ in range(min(len(enemy_alive), rng.integers(0, 10))):
+            obs.raw_data.event.dead_units.append(enemy_alive.pop(rng.integers(len(enemy_alive))))
+
+        observations.append(obs)
+
+    return observations
+
+
+def empty_category_observations(player_race):
+    """Observations leaving unit categories empty, which the single pass reduces with nothing to count: no units at
+    all, then only a built allied unit"""
+    empty = sc_pb.Observation(game_loop=0)
+
+    allied_only = sc_pb.Observation(game_loop=72)
+    unit = allied_only.raw_data.units.add(alliance=1, display_type=1, build_progress=1, tag=1,
+                                          unit_type=next(iter(RACES[player_race])).value)
+    unit.health = unit.health_max = 100
+
+    return [empty, allied_only]
+
+
+def time_parser(parser_class, observations):
+    best = None
+    for _ in range(FLAGS.repeats):
+        parser = parser_class(FLAGS.player_race, FLAGS.enemy_race)
+        start = time.perf_counter()
+        states = [parser.extract(obs) for obs in observations]
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best, np.asarray(states)
+
+
+def benchmark(argv):
+    rng = np.random.default_rng(FLAGS.seed)
+    observations = empty_category_observations(FLAGS.player_race) + \
+        synthetic_observations(rng, FLAGS.player_race, FLAGS.enemy_race, FLAGS.n_obs, FLAGS.n_units)
+
+    legacy_time, legacy_states = time_parser(LegacyGlobalParser, observations)
+    unit_time, unit_states = time_parser(UnitParser, observations)
+
+    if legacy_states.tobytes() != unit_states.tobytes():
+        print('Output mismatch between legacy and single pass unit parsing')
+        sys.exit(1)
+
+    print(f"{FLAGS.n_obs} observations x {FLAGS.n_units} units and {len(observations) - FLAGS.n_obs} with empty unit "
+          f"categories, outputs identical")
+    print(f"legacy      {legacy_time * 1000 / FLAGS.n_obs:8.3f} ms/obs")
+    print(f"single pass {unit_time * 1000 / FLAGS.n_obs:8.3f} ms/obs ({legacy_time / unit_time:.1f}x)")
+
+if __name__ == '__main__':
+    app.run(benchmark)
@@ -0,0 +1,90 @@
+from benchmark_writer import synthetic_steps
+from global_codec import GlobalReader, save, load_global
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+from absl import app
+from absl import flags
+
+import numpy as np
+from scipy import sparse
+
+FLAGS = flags.FLAGS
+flags.DEFINE_list(name='globals', default=[],
+                  help='Parsed global states (.glo.npz) to benchmark, a synthetic replay is used when none are given')
+flags.DEFINE_integer(name='window', default=32,
+                     help='# of steps per randomly placed window decoded')
+flags.DEFINE_integer(name='n_windows', default=2000,
+                     help='# of windows decoded per format')
+flags.DEFINE_integer(name='repeats', default=5,
+                     help='# of full decodes timed, the best is reported')
+
+
+def time_best(fn):
+    best = None
+    for _ in range(FLAGS.repeats):
+        start = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best, result
+
+
+def time_windows(read_window, starts):
+    """Seconds to decode every window, and the windows"""
+    start = time.perf_counter()
+    windows = [read_window(s) for s in starts]
+
+    return time.perf_counter() - start, windows
+
+
+def benchmark_states(name, states, output_path):
+    sparse_path = os.path.join(output_path, f'{name}.glo.npz')
+    delta_path = os.path.join(output_path, f'{name}.gld.npz')
+    sparse.save_npz(sparse_path, sparse.csc_matrix(states))
+    save(delta_path, states)
+
+    sparse_time, sparse_states = time_best(lambda: load_global(sparse_path))
+    delta_time, delta_states = time_best(lambda: load_global(delta_path))
+    if sparse_states.tobytes() != delta_states.tobytes() or states.tobytes() != delta_states.tobytes():
+        print(f'{name}: output mismatch between sparse and delta/run-length storage')
+        sys.exit(1)
+
+    # A sparse file is decoded whole to get at any window, the reader only decodes the window asked for
+    starts = np.random.default_rng(FLAGS.seed).integers(0, max(len(states) - FLAGS.window, 0) + 1, FLAGS.n_windows)
+    sparse_window_time, sparse_windows = time_windows(
+        lambda s: np.asarray(sparse.load_npz(sparse_path).todense())[s:s + FLAGS.window], starts)
+    reader = GlobalReader.load(delta_path)
+    delta_window_time, delta_windows = time_windows(lambda s: reader.window(s, s + FLAGS.window), starts)
+    if any(a.tobytes() != b.tobytes() for a, b in zip(sparse_windows, delta_windows)):
+        print(f'{name}: window mismatch between sparse and delta/run-length storage')
+        sys.exit(1)
+
+    raw_size = states.astype(np.float64).nbytes
+    sparse_size, delta_size = os.path.getsize(sparse_path), os.path.getsize(delta_path)
+    print(f"{name}: {states.shape[0]} steps x {states.shape[1]} features, outputs identical")
+    print(f"{'':<8} {'size':>10} {'ratio':>7} {'full decode':>12} {f'{FLAGS.window}-step windows':>18}")
+    for label, size, full_time, window_time in [('sparse', sparse_size, sparse_time, sparse_window_time),
+                                                ('delta', delta_size, delta_time, delta_window_time)]:
+        print(f"{label:<8} {size / 2**10:7.1f} KB {raw_size / size:6.1f}x {full_time * 1000:9.2f} ms "
+              f"{FLAGS.n_windows / window_time:11.0f} win/s")
+
+
+def benchmark(argv):
+    output_path = tempfile.mkdtemp()
+    try:
+        if FLAGS.globals:
+            for path in FLAGS.globals:
+                benchmark_states(os.path.basename(path).replace('.glo.npz', ''), load_global(path), output_path)
+        else:
+            states = np.array([global_state for _, global_state, _ in synthetic_steps(np.random.default_rng(FLAGS.seed))])
+            benchmark_states('synthetic', states, output_path)
+    finally:
+        shutil.rmtree(output_path)
+
+if __name__ == '__main__':
+    app.run(benchmark)
@@ -0,0 +1,93 @@
+from benchmark_global import LegacyGlobalParser
+from extract_global import GlobalParser
+
+import sys
+import time
+from absl import app
+from absl import flags
+
+import numpy as np
+
+from s2clientprotocol import sc2api_pb2 as sc_pb
+
+FLAGS = flags.FLAGS
+flags.DEFINE_integer(name='n_steps', default=4000,
+                     help='# of steps in the synthetic game')
+flags.DEFINE_integer(name='n_new', default=10,
+                     help='# of enemy units first seen every step')
+flags.DEFINE_integer(name='n_visible', default=60,
+                     help='# of enemy units seen before that are visible every step')
+flags.DEFINE_integer(name='n_deaths', default=5,
+                     help='Most # of enemy units dying every step')
+flags.DEFINE_integer(name='n_phases', default=4,
+                     help='# of equal parts of the game per step cost is reported for')
+
+
+def synthetic_game(rng, n_types):
+    """
+    Enemy tags seen and units dying every step of a game where the enemy keeps growing
+
+    Some units are only seen once, so the tags tracked grow with the game as they do with units glimpsed in the fog
+    """
+    next_tag = 1
+    alive = []
+    steps = []
+
+    for _ in range(FLAGS.n_steps):
+        seen = [alive[i] for i in rng.integers(len(alive), size=min(len(alive), FLAGS.n_visible))]
+        seen += range(next_tag, next_tag + FLAGS.n_new)
+        alive += range(next_tag, next_tag + FLAGS.n_new)
+        next_tag += FLAGS.n_new
+
+        tags = [(tag, tag % n_types) for tag in seen]
+        obs = sc_pb.Observation()
+        for _ in range(rng.integers(0, FLAGS.n_deaths + 1)):
+            obs.raw_data.event.dead_units.append(alive.pop(rng.integers(len(alive))))
+
+        steps.append((tags, obs))
+
+    return steps
+
+
+def legacy_track(parser, tags):
+    for tag, idx in tags:
+        parser.enemy_tags[idx].add(tag)
+
+
+def track(parser, tags):
+    parser.track_enemy_tags([tag for tag, _ in tags], [idx for _, idx in tags])
+
+
+def time_tracking(parser, track, steps):
+    """Per step cost of tracking the tags seen and counting the enemy units killed, and the counts"""
+    times = []
+    killed = []
+    for tags, obs in steps:
+        start = time.perf_counter()
+        track(parser, tags)
+        killed.append(parser.get_enemy_killed(obs))
+        times.append(time.perf_counter() - start)
+
+    return np.array(times), np.asarray(killed)
+
+
+def benchmark(argv):
+    legacy = LegacyGlobalParser(FLAGS.player_race, FLAGS.enemy_race)
+    parser = GlobalParser(FLAGS.player_race, FLAGS.enemy_race)
+    steps = synthetic_game(np.random.default_rng(FLAGS.seed), len(parser.enemy_unit_map))
+
+    legacy_times, legacy_killed = time_tracking(legacy, legacy_track, steps)
+    times, killed = time_tracking(parser, track, steps)
+
+    if legacy_killed.tobytes() != killed.tobytes():
+        print('Output mismatch between per-type tag sets and the tag map')
+        sys.exit(1)
+
+    print(f"{FLAGS.n_steps} steps, {int(killed.sum())} enemy units killed, "
+          f"{sum(len(tags) for tags in legacy.enemy_tags)} tags left tracked, outputs identical")
+    print(f"{'steps':>13} {'tag sets':>10} {'tag map':>10}")
+    for phase in np.array_split(np.arange(FLAGS.n_steps), FLAGS.n_phases):
+        print(f"{phase[0]:>6}-{phase[-1]:<6} {legacy_times[phase].mean() * 1e6:7.1f} us {times[phase].mean() * 1e6:7.1f} us")
+
+if __name__ == '__main__':
+    app.run(benchmark)
@@ -0,0 +1,128 @@
+from benchmark_writer import synthetic_steps
+from replay_writer import ReplayWriter
+from loader import BatchLoader, read_split
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import multiprocessing
+from absl import app
+from absl import flags
+
+import numpy as np
+from scipy import sparse
+
+FLAGS = flags.FLAGS
+flags.DEFINE_string(name='parsed_replays', default=None,
+                    help='Parsed data path with a train.csv to read, synthetic replays are written when not given')
+flags.DEFINE_integer(name='n_replays', default=8,
+                     help='# of synthetic replays')
+flags.DEFINE_integer(name='window', default=32,
+                     help='# of steps per window')
+flags.DEFINE_integer(name='batch_size', default=16,
+                     help='# of windows per batch')
+flags.DEFINE_integer(name='n_batches', default=100,
+                     help='# of batches read per configuration')
+flags.DEFINE_integer(name='cache_mb', default=512,
+                     help='Decoded replay cache of every loader (per process with processes), in MB')
+flags.DEFINE_list(name='n_workers', default=['0', '2', '4'],
+                  help='# of workers of every configuration timed, for both threads and processes')
+flags.DEFINE_enum(name='start_method', default=None, enum_values=['fork', 'spawn', 'forkserver'],
+                  help='Start method of the process workers, the platform\'s default if not set')
+
+
+def write_synthetic(path):
+    """Synthetic replays with a train.csv listing them all and a normalisation.npz, as postprocess leaves them"""
+    for out_folder in ['actions', 'global', 'spatial']:
+        os.makedirs(os.path.join(path, out_folder))
+
+    rng = np.random.default_rng(FLAGS.seed)
+    maximums = np.zeros(FLAGS.n_features)
+    with open(os.path.join(path, 'train.csv'), 'w') as f:
+        for i in range(FLAGS.n_replays):
+            writer = ReplayWriter(path, f'1@synthetic{i}', FLAGS.chunk_size)
+            for spatial_state, global_state, actions in synthetic_steps(rng):
+                writer.append(spatial_state, global_state, actions)
+                maximums = np.maximum(maximums, global_state)
+            writer.seal()
+            f.write(f"1@synthetic{i},1,{FLAGS.n_steps}\n")
+
+    scale = np.where(maximums == 0, 1, maximums)
+    np.savez(os.path.join(path, 'normalisation.npz'), offset=np.zeros_like(scale), scale=scale)
+
+
+def naive_batches(path, batch_windows):
+    """Every window decoding its replay's files whole, as consumers do without a loader"""
+    for windows in batch_windows:
+        glo, spa = [], []
+        for name, start in windows:
+            glo.append(np.asarray(sparse.load_npz(os.path.join(path, 'global', f'{name}.glo.npz')).todense())[start:start + FLAGS.window])
+            spa.append(np.asarray(sparse.load_npz(os.path.join(path, 'spatial', f'{name}.spa.npz')).todense())[start:start + FLAGS.window])
+        yield np.stack(glo), np.stack(spa)
+
+
+def time_batches(batches):
+    """Batches/s and process CPU seconds per batch (of this process only) reading every batch, and the first batch"""
+    start, cpu_start = time.perf_counter(), time.process_time()
+    first = None
+    n_batches = 0
+    for batch in batches:
+        first = batch if first is None else first
+        n_batches += 1
+
+    return n_batches / (time.perf_counter() - start), (time.process_time() - cpu_start) / n_batches, first
+
+
+def benchmark_loader(path):
+    names, n_steps = read_split(path, 'train')
+    print(f"{len(names)} replays, {int(n_steps.sum())} steps, {FLAGS.n_batches} batches of "
+          f"{FLAGS.batch_size} x {FLAGS.window} steps")
+    print(f"{'':<16} {'batches/s':>10} {'consumer cpu':>13} {'cache hits':>11}")
+
+    reference = None
+    for backend, n_workers in [('thread', 0)] + [(backend, int(n)) for backend in ['thread', 'process']
+                                                 for n in FLAGS.n_workers if int(n) > 0]:
+        with BatchLoader(path, 'train', FLAGS.window, FLAGS.batch_size, seed=FLAGS.seed, map_size=FLAGS.map_size,
+                         n_workers=n_workers, backend=backend,
+                         cache_bytes=FLAGS.cache_mb * 2**20) as loader:
+            rate, cpu, first = time_batches(loader.batches(FLAGS.n_batches))
+            windows = [loader.sample(i) for i in range(FLAGS.n_batches)]
+
+            # Process workers keep their own caches
+            hits = '' if backend == 'process' else \
+                f"{100 * loader.reader.hits / max(loader.reader.hits + loader.reader.misses, 1):10.1f}%"
+
+        if reference is None:
+            reference = first
+        elif any(a.tobytes() != b.tobytes() for a, b in zip(reference[:2], first[:2])):
+            print(f'{backend} x {n_workers}: batches differ from reading them in the consumer')
+            sys.exit(1)
+
+        label = 'consumer' if n_workers == 0 else f'{backend} x {n_workers}'
+        print(f"{label:<16} {rate:10.1f} {cpu * 1000:10.1f} ms {hits:>11}")
+
+    # Fewer batches, decoding whole replays per window is slow
+    n_naive = max(FLAGS.n_batches // 10, 1)
+    rate, cpu, first = time_batches(naive_batches(path, windows[:n_naive]))
+    print(f"{'load per window':<16} {rate:10.1f} {cpu * 1000:10.1f} ms {'':>11} ({n_naive} batches)")
+
+
+def benchmark(argv):
+    if FLAGS.start_method is not None:
+        multiprocessing.set_start_method(FLAGS.start_method)
+
+    if FLAGS.parsed_replays is not None:
+        benchmark_loader(FLAGS.parsed_replays)
+        return
+
+    path = tempfile.mkdtemp()
+    try:
+        write_synthetic(path)
+        benchmark_loader(path)
+    finally:
+        shutil.rmtree(path)
+
+if __name__ == '__main__':
+    app.run(benchmark)
@@ -0,0 +1,132 @@
+from benchmark_global import synthetic_observations
+from extract_global import GlobalParser
+from extract_spatial import SpatialParser
+from extract_actions import ActionExtractor
+from replay_writer import ReplayWriter
+from pipeline import step_observations, prefetch
+
+import os
+import time
+import shutil
+import tempfile
+from absl import app
+from absl import flags
+
+import numpy as np
+
+from google.protobuf.internal import api_implementation
+from pysc2.lib.features import MINIMAP_FEATURES
+from s2clientprotocol import sc2api_pb2 as sc_pb
+
+FLAGS = flags.FLAGS
+flags.DEFINE_float(name='step_latency', default=10,
+                   help='Milliseconds the simulated client takes to step')
+flags.DEFINE_float(name='observe_latency', default=5,
+                   help='Milliseconds the simulated client takes to render an observation')
+flags.DEFINE_boolean(name='parse_responses', default=True,
+                     help='Parse observations from bytes in observe as the real controller does, turn off to approximate '
+                          'a C++ protobuf backend where parsing is nearly free')
+flags.DEFINE_integer(name='map_size', default=64,
+                     help='Spatial observation size in pixels')
+flags.DEFINE_integer(name='chunk_size', default=32,
+                     help='# of steps per chunk written')
+flags.DEFINE_list(name='depths', default=['2', '4', '8', '32'],
+                  help='Pipeline depths to time')
+
+
+class SimulatedController:
+    """
+    Stand-in for a remote controller over serialised observations
+
+    step and observe sleep for the client's time, which like a socket wait releases the GIL, and observe parses the
+    response from bytes as the real controller does, holding the GIL on the stepping thread
+    """
+    def __init__(self, responses):
+        self.responses = responses if FLAGS.parse_responses else \
+            [sc_pb.ResponseObservation.FromString(response) for response in responses]
+        self.idx = 0
+
+    def step(self, count):
+        time.sleep(FLAGS.step_latency / 1000)
+
+    def observe(self):
+        time.sleep(FLAGS.observe_latency / 1000)
+        response = self.responses[self.idx]
+        if FLAGS.parse_responses:
+            response = sc_pb.ResponseObservation.FromString(response)
+        self.idx += 1
+        return response
+
+
+def synthetic_responses(rng):
+    """Serialised ResponseObservations with minimap layers, the last one carrying a player result"""
+    responses = []
+    observations = synthetic_observations(rng, FLAGS.player_race, FLAGS.enemy_race, FLAGS.n_obs, FLAGS.n_units)
+
+    for i, obs in enumerate(observations):
+        for feature in MINIMAP_FEATURES:
+            layer = getattr(obs.feature_layer_data.minimap_renders, feature.name)
+            layer.size.x = layer.size.y = FLAGS.map_size
+            if feature.scale <= 2:
+                layer.bits_per_pixel = 1
+                layer.data = np.packbits(rng.random(FLAGS.map_size ** 2) < 0.3).tobytes()
+            else:
+                layer.bits_per_pixel = 8 if feature.scale <= 256 else 32
+                dtype = np.uint8 if feature.scale <= 256 else np.int32
+                layer.data = rng.integers(0, min(feature.scale, 256), FLAGS.map_size ** 2).astype(dtype).tobytes()
+
+        response = sc_pb.ResponseObservation(observation=obs)
+        if i == len(observations) - 1:
+            response.player_result.add(player_id=1, result=1)
+        responses.append(response.SerializeToString())
+
+    return responses
+
+
+def parse_replay(responses, output_path, depth):
+    """The process_replay loop over a simulated client, pipelined when depth > 0"""
+    global_parser = GlobalParser(FLAGS.player_race, FLAGS.enemy_race)
+    spatial_parser = SpatialParser()
+    action_extractor = ActionExtractor()
+    writer = ReplayWriter(output_path, f'depth_{depth}', FLAGS.chunk_size)
+
+    observations = step_observations(SimulatedController(responses), 72)
+    if depth > 0:
+        observations = prefetch(observations, depth)
+
+    start = time.perf_counter()
+    for obs in observations:
+        writer.append(spatial_parser.extract(obs.observation),
+                      global_parser.extract(obs.observation),
+                      action_extractor.extract(obs))
+    writer.seal()
+
+    return time.perf_counter() - start
+
+
+def benchmark(argv):
+    responses = synthetic_responses(np.random.default_rng(FLAGS.seed))
+
+    output_path = tempfile.mkdtemp()
+    try:
+        for out_folder in ['actions', 'global', 'spatial']:
+            os.makedirs(os.path.join(output_path, out_folder))
+
+        client_time = FLAGS.n_obs * (FLAGS.step_latency + FLAGS.observe_latency) / 1000
+        # The gain depends on both: extraction only overlaps the client's wait, and the response parse competes with it
+        print(f"{len(os.sched_getaffinity(0))} cores, {api_implementation.Type()} protobuf, responses "
+              f"{'parsed' if FLAGS.parse_responses else 'pre-parsed'}")
+        print(f"{FLAGS.n_obs} steps x {FLAGS.n_units} units, client {FLAGS.step_latency + FLAGS.observe_latency:.1f} "
+              f"ms/step ({client_time:.2f} s per replay)")
+
+        serial = min(parse_replay(responses, output_path, 0) for _ in range(FLAGS.repeats))
+        print(f"serial     {serial:7.2f} s per replay")
+
+        for depth in [int(depth) for depth in FLAGS.depths]:
+            pipelined = min(parse_replay(responses, output_path, depth) for _ in range(FLAGS.repeats))
+            print(f"depth {depth:>4} {pipelined:7.2f} s per replay ({serial / pipelined:.2f}x)")
+    finally:
+        shutil.rmtree(output_path)
+
+if __name__ == '__main__':
+    app.run(benchmark)
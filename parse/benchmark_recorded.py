@@ -0,0 +1,109 @@
+from benchmark_pipeline import synthetic_responses
+from extract_global import GlobalParser
+from extract_spatial import SpatialParser
+from extract_actions import ActionExtractor
+from replay_writer import ReplayWriter
+from observation_stream import ObservationRecorder, RecordedController
+from pipeline import step_observations, replay_races, Stride, extract_observations
+from metrics import Metrics
+
+import os
+import time
+import shutil
+import tempfile
+import tracemalloc
+from absl import app
+from absl import flags
+
+import numpy as np
+
+from s2clientprotocol import common_pb2 as common_pb
+from s2clientprotocol import sc2api_pb2 as sc_pb
+
+FLAGS = flags.FLAGS
+flags.DEFINE_list(name='recordings', default=[],
+                  help='Observation recordings to parse, a synthetic one is recorded when none are given')
+flags.DEFINE_string(name='save_recording', default=None,
+                    help='Keep the synthetic recording at this path, to benchmark later changes against the same input')
+flags.DEFINE_boolean(name='trace_memory', default=True,
+                     help='Parse every recording once more under tracemalloc to report its peak memory')
+
+STAGES = ['step', 'observe', 'extract_spatial', 'extract_global', 'extract_actions', 'assemble', 'save']
+
+
+def record_synthetic(path):
+    """A recording of the synthetic replay benchmark_pipeline serves, observed by player 1"""
+    replay_info = sc_pb.ResponseReplayInfo(map_name='Synthetic', game_duration_loops=FLAGS.n_obs * 72)
+    for player_id, race in [(1, FLAGS.player_race), (2, FLAGS.enemy_race)]:
+        player = replay_info.player_info.add()
+        player.player_info.player_id = player_id
+        player.player_info.race_actual = common_pb.Race.Value(race)
+
+    recorder = ObservationRecorder(path, replay_info, sc_pb.RequestStartReplay(observed_player_id=1), 72)
+    for response in synthetic_responses(np.random.default_rng(FLAGS.seed)):
+        recorder.append(sc_pb.ResponseObservation.FromString(response))
+    recorder.close()
+
+
+def parse_recording(controller, output_path, metrics):
+    """The process_replay loop over a recording, returning the # of steps parsed"""
+    player_id = controller.start_request.observed_player_id
+    player_race, enemy_race = replay_races(controller.replay_info(), player_id)
+
+    stride = Stride(controller.step_size, GlobalParser(player_race, enemy_race),
+                    ReplayWriter(output_path, 'recorded', FLAGS.chunk_size))
+
+    controller.start_replay(sc_pb.RequestStartReplay(observed_player_id=player_id))
+
+    extract_observations(step_observations(controller, controller.step_size, metrics), controller.step_size, [stride],
+                         SpatialParser(), ActionExtractor(), metrics)
+    with metrics.time('save'):
+        stride.writer.seal()
+
+    return len(stride.game_loops)
+
+
+def benchmark_recording(path, output_path):
+    controller = RecordedController(path, in_memory=True)
+
+    best = None
+    for _ in range(FLAGS.repeats):
+        metrics = Metrics(path)
+        start = time.perf_counter()
+        n_steps = parse_recording(controller, output_path, metrics)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best[0]:
+            best = elapsed, metrics
+
+    elapsed, metrics = best
+    print(f"{path}: {n_steps} steps, {elapsed:.2f} s, {n_steps / elapsed:.1f} steps/s")
+    for stage in STAGES:
+        calls, seconds = metrics.stages.get(stage, [0, 0.0])
+        print(f"    {stage:<16} {1000 * seconds / n_steps:8.3f} ms/step {100 * seconds / elapsed:5.1f}%")
+
+    if FLAGS.trace_memory:
+        tracemalloc.start()
+        parse_recording(controller, output_path, Metrics(path))
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print(f"    peak memory {peak / 2**20:.1f} MB (recording held in memory excluded)")
+
+
+def benchmark(argv):
+    output_path = tempfile.mkdtemp()
+    try:
+        for out_folder in ['actions', 'global', 'spatial']:
+            os.makedirs(os.path.join(output_path, out_folder))
+
+        recordings = FLAGS.recordings
+        if not recordings:
+            recordings = [FLAGS.save_recording or os.path.join(output_path, 'synthetic.obs.gz')]
+            record_synthetic(recordings[0])
+
+        for path in recordings:
+            benchmark_recording(path, output_path)
+    finally:
+        shutil.rmtree(output_path)
+
+if __name__ == '__main__':
+    app.run(benchmark)
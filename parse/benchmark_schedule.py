@@ -0,0 +1,78 @@
+from scheduling import schedule, simulate
+
+import json
+from absl import app
+from absl import flags
+
+import numpy as np
+
+FLAGS = flags.FLAGS
+flags.DEFINE_string(name='library', default=None,
+                    help='Replay library json to take durations and maps from, synthetic if not set')
+flags.DEFINE_integer(name='n_replays', default=2000,
+                     help='# of synthetic replays')
+flags.DEFINE_float(name='sigma', default=0.5,
+                   help='Spread of the synthetic log-normal durations, heavier tailed as it grows')
+flags.DEFINE_integer(name='max_duration', default=80000,
+                     help='Longest synthetic replay in game loops, preprocess\' max_duration')
+flags.DEFINE_integer(name='n_maps', default=12,
+                     help='# of maps in the synthetic library')
+flags.DEFINE_list(name='n_instances', default=['4', '8', '16', '32'],
+                  help='# of instances to simulate')
+flags.DEFINE_float(name='overhead', default=2000,
+                   help='Cost of starting a replay, in game loops')
+flags.DEFINE_float(name='map_load', default=3000,
+                   help='Extra cost of starting a replay on a map the instance doesn\'t have loaded, in game loops')
+flags.DEFINE_integer(name='trials', default=20,
+                     help='# of shuffled library orders averaged')
+flags.DEFINE_integer(name='seed', default=0,
+                     help='Random seed')
+
+
+def synthetic_library(rng):
+    """
+    Durations drawn from a log-normal (median ~15 minutes of game time) clipped to 8000-max_duration loops, maps drawn
+    with Zipf-like popularity
+    """
+    durations = np.clip(rng.lognormal(np.log(20000), FLAGS.sigma, FLAGS.n_replays), 8000, FLAGS.max_duration).astype(int)
+    popularity = 1 / np.arange(1, FLAGS.n_maps + 1)
+    maps = rng.choice(FLAGS.n_maps, FLAGS.n_replays, p=popularity / popularity.sum())
+
+    return [{'duration_frames': int(duration), 'map': f'map_{map_idx}'} for duration, map_idx in zip(durations, maps)]
+
+
+def makespan(replays, n_instance):
+    return simulate([replay['duration_frames'] for replay in replays], [replay['map'] for replay in replays],
+                    n_instance, FLAGS.overhead, FLAGS.map_load)[0]
+
+
+def benchmark(argv):
+    rng = np.random.default_rng(FLAGS.seed)
+
+    if FLAGS.library is not None:
+        with open(FLAGS.library) as f:
+            library = json.load(f)
+    else:
+        library = synthetic_library(rng)
+
+    durations = np.array([replay['duration_frames'] for replay in library])
+    print(f"{len(library)} replays, {len({replay['map'] for replay in library})} maps, duration_frames "
+          f"median {np.median(durations):.0f} p99 {np.percentile(durations, 99):.0f} max {durations.max()}")
+    print(f"Makespan in game loops, overhead {FLAGS.overhead:.0f} per replay, {FLAGS.map_load:.0f} per map switch\n")
+    print(f"{'instances':>9} {'bound':>10} {'library':>10} {'longest':>10} {'+maps':>10} {'gain':>6} {'+maps gain':>10}")
+
+    for n_instance in [int(n) for n in FLAGS.n_instances]:
+        # Nothing beats a perfect split of the work with one map load per instance, or the longest single replay
+        bound = max((durations.sum() + FLAGS.overhead * len(library)) / n_instance + FLAGS.map_load,
+                    durations.max() + FLAGS.overhead + FLAGS.map_load)
+
+        library_order = np.mean([makespan([library[i] for i in rng.permutation(len(library))], n_instance)
+                                 for _ in range(FLAGS.trials)])
+        longest = makespan(schedule(library, 'longest'), n_instance)
+        grouped = makespan(schedule(library, 'longest', group_maps=True), n_instance)
+
+        print(f"{n_instance:>9} {bound:>10.0f} {library_order:>10.0f} {longest:>10.0f} {grouped:>10.0f} "
+              f"{library_order / longest:>5.2f}x {library_order / grouped:>9.2f}x")
+
+if __name__ == '__main__':
+    app.run(benchmark)
@@ -0,0 +1,87 @@
+from benchmark_writer import synthetic_steps
+from extract_spatial import SpatialParser, compact_unit_ids, load_compact
+from replay_writer import ReplayWriter
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+from absl import app
+from absl import flags
+
+import numpy as np
+from scipy import sparse
+
+FLAGS = flags.FLAGS
+flags.DEFINE_integer(name='repeats', default=3,
+                     help='# of timed decodes, best is reported')
+
+
+def time_decode(decode):
+    best = None
+    for _ in range(FLAGS.repeats):
+        start = time.perf_counter()
+        spatial = decode()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best, spatial
+
+
+def benchmark(argv):
+    output_path = tempfile.mkdtemp()
+    try:
+        for out_folder in ['actions', 'global', 'spatial']:
+            os.makedirs(os.path.join(output_path, out_folder))
+
+        compact_args = (SpatialParser().get_encoding(), compact_unit_ids('Protoss', 'Terran'))
+        map_files = {}
+        for name, writer_args in [('sparse', ()), ('compact', compact_args),
+                                  ('static', compact_args + (['height_map', 'pathable'], 'synthetic')),
+                                  ('detected', compact_args + (None, 'synthetic'))]:
+            writer = ReplayWriter(output_path, name, FLAGS.chunk_size, *writer_args)
+            for spatial_state, global_state, actions in synthetic_steps(np.random.default_rng(FLAGS.seed)):
+                writer.append(spatial_state, global_state, actions)
+            writer.seal()
+            if name in ['static', 'detected']:
+                map_files[name] = writer.spatial_writer.map_file
+
+        sparse_path = os.path.join(output_path, 'spatial', 'sparse.spa.npz')
+        compact_path = os.path.join(output_path, 'spatial', 'compact.spc.npz')
+        static_path = os.path.join(output_path, 'spatial', 'static.spc.npz')
+        detected_path = os.path.join(output_path, 'spatial', 'detected.spc.npz')
+
+        sparse_time, sparse_spatial = time_decode(lambda: np.asarray(sparse.load_npz(sparse_path).todense()))
+        compact_time, compact_spatial = time_decode(lambda: load_compact(compact_path))
+        static_time, static_spatial = time_decode(lambda: load_compact(static_path))
+        detected_time, detected_spatial = time_decode(lambda: load_compact(detected_path))
+
+        for spatial in [compact_spatial, static_spatial, detected_spatial]:
+            if sparse_spatial.dtype != spatial.dtype or \
+                not np.array_equal(sparse_spatial, spatial.reshape((spatial.shape[0], -1))):
+                print('Compact spatial encoding is lossy')
+                sys.exit(1)
+
+        sparse_size = os.path.getsize(sparse_path)
+        compact_size = os.path.getsize(compact_path)
+        static_size = os.path.getsize(static_path)
+        detected_size = os.path.getsize(detected_path)
+        with np.load(detected_path) as data:
+            detected = ', '.join(data['static'])
+
+        print(f"{FLAGS.n_steps} steps, decoded outputs identical")
+        print(f"sparse  .spa.npz {sparse_size / 2**20:8.2f} MB  decode {sparse_time * 1000:8.1f} ms")
+        print(f"compact .spc.npz {compact_size / 2**20:8.2f} MB  decode {compact_time * 1000:8.1f} ms "
+              f"({sparse_size / compact_size:.1f}x smaller, {sparse_time / compact_time:.1f}x faster)")
+        print(f"static  .spc.npz {static_size / 2**20:8.2f} MB  decode {static_time * 1000:8.1f} ms "
+              f"({sparse_size / static_size:.1f}x smaller, {sparse_time / static_time:.1f}x faster), "
+              f"{os.path.getsize(map_files['static']) / 2**10:.1f} KB once per map")
+        print(f"detected .spc.npz {detected_size / 2**20:7.2f} MB  decode {detected_time * 1000:8.1f} ms "
+              f"({sparse_size / detected_size:.1f}x smaller, {sparse_time / detected_time:.1f}x faster), "
+              f"{os.path.getsize(map_files['detected']) / 2**10:.1f} KB once per map for {detected}")
+    finally:
+        shutil.rmtree(output_path)
+
+if __name__ == '__main__':
+    app.run(benchmark)
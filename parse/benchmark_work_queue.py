@@ -0,0 +1,136 @@
+from work_queue import LeaseQueue
+from watchdog import Watchdog
+
+import os
+import sys
+import time
+import signal
+import shutil
+import tempfile
+import multiprocessing
+from collections import defaultdict
+from absl import app
+from absl import flags
+
+import numpy as np
+
+FLAGS = flags.FLAGS
+flags.DEFINE_integer(name='n_nodes', default=4,
+                     help='# of processes standing in for hosts, each running its own watchdog and workers')
+flags.DEFINE_integer(name='n_workers', default=2,
+                     help='# of workers per node')
+flags.DEFINE_integer(name='n_replays', default=400,
+                     help='# of replays in the library')
+flags.DEFINE_float(name='work_time', default=0.02,
+                   help='Most seconds a worker spends on a replay')
+flags.DEFINE_float(name='fail_rate', default=0.05,
+                   help='Share of replay attempts failing')
+flags.DEFINE_integer(name='lease_seconds', default=2,
+                     help='Lease length')
+flags.DEFINE_boolean(name='kill_node', default=True,
+                     help='SIGKILL the first node halfway through, leaving its leases to run out')
+flags.DEFINE_integer(name='seed', default=0,
+                     help='Random seed')
+
+
+def fake_worker(inbox, status_queue, worker_id, owner, log_path):
+    """Processes the replays sent to it like a ReplayProcessor, logging (replay, owner, started, finished) for every
+    one it gets through"""
+    signal.signal(signal.SIGTERM, lambda a, b: sys.exit())
+    rng = np.random.default_rng((FLAGS.seed, os.getpid()))
+    with open(log_path, 'a') as log:
+        while True:
+            job, replay = inbox.get()
+            started = time.time()
+            time.sleep(rng.random() * FLAGS.work_time)
+            failed = rng.random() < FLAGS.fail_rate
+            log.write(f"{replay['player_id']}@{replay['replay_id']} {owner} {started} {time.time()} {int(failed)}\n")
+            log.flush()
+            status_queue.put(('done', worker_id, job, failed, 0))
+
+
+def node(db_path, log_path, node_id, replay_list):
+    """A parse run: adds the library to the shared queue, then supervises its workers until every replay is processed"""
+    os.setpgid(0, 0)
+    replay_queue = LeaseQueue(db_path, FLAGS.lease_seconds, max_retries=2, backoff=0.1, poll_interval=0.05,
+                              owner=f'node-{node_id}')
+    replay_queue.add(replay_list)
+    status_queue = multiprocessing.SimpleQueue()
+
+    def start_worker(worker_id):
+        inbox = multiprocessing.SimpleQueue()
+        p = multiprocessing.Process(target=fake_worker, args=(inbox, status_queue, worker_id, replay_queue.owner,
+                                                               log_path))
+        p.inbox = inbox
+        p.daemon = True
+        p.start()
+        return p
+
+    watchdog = Watchdog({i: start_worker(i) for i in range(FLAGS.n_workers)}, start_worker, replay_queue, status_queue)
+    n_replays, _ = replay_queue.totals()
+    while replay_queue.progress()[0] < n_replays:
+        time.sleep(0.05)
+        watchdog.poll()
+        n_replays, _ = replay_queue.totals()
+
+
+def check(log_paths, db_path, killed):
+    """Every replay processed, and no two nodes on a replay at once unless one of them had been killed"""
+    runs = defaultdict(list)
+    for path in log_paths:
+        if os.path.isfile(path):
+            with open(path) as f:
+                for line in f:
+                    name, owner, started, finished, failed = line.split()
+                    runs[name].append((owner, float(started), float(finished)))
+
+    states = dict(LeaseQueue(db_path).conn.execute('SELECT name, state FROM replays'))
+    unprocessed = [name for name, state in states.items() if state not in ('done', 'failed')]
+    overlaps = 0
+    for name, attempts in runs.items():
+        attempts.sort(key=lambda attempt: attempt[1])
+        for (owner_a, _, end_a), (owner_b, start_b, _) in zip(attempts, attempts[1:]):
+            if start_b < end_a and killed not in (owner_a, owner_b):
+                overlaps += 1
+
+    return states, unprocessed, overlaps, sum(len(attempts) for attempts in runs.values())
+
+
+def benchmark(argv):
+    path = tempfile.mkdtemp()
+    try:
+        db_path = os.path.join(path, 'queue.sqlite')
+        log_paths = [os.path.join(path, f'node-{i}.log') for i in range(FLAGS.n_nodes)]
+        replay_list = [{'replay_id': f'replay{i}', 'player_id': 1, 'duration_frames': 1000} for i in range(FLAGS.n_replays)]
+
+        start = time.perf_counter()
+        nodes = [multiprocessing.Process(target=node, args=(db_path, log_paths[i], i, replay_list))
+                 for i in range(FLAGS.n_nodes)]
+        for p in nodes:
+            p.start()
+
+        killed = None
+        if FLAGS.kill_node:
+            time.sleep(FLAGS.n_replays * FLAGS.work_time / (2 * FLAGS.n_nodes * FLAGS.n_workers))
+            os.killpg(nodes[0].pid, signal.SIGKILL) # With its workers, as a host going down would
+            killed = 'node-0'
+
+        for p in nodes:
+            p.join()
+        elapsed = time.perf_counter() - start
+
+        states, unprocessed, overlaps, n_attempts = check(log_paths, db_path, killed)
+        counts = defaultdict(int)
+        for state in states.values():
+            counts[state] += 1
+
+        print(f"{FLAGS.n_nodes} nodes x {FLAGS.n_workers} workers, {FLAGS.n_replays} replays in {elapsed:.1f} s "
+              f"({n_attempts / elapsed:.0f} claims/s), {dict(counts)}")
+        print(f"{n_attempts} attempts, {overlaps} concurrent claims outside expired leases, {len(unprocessed)} left")
+        if overlaps > 0 or unprocessed:
+            sys.exit(1)
+    finally:
+        shutil.rmtree(path)
+
+if __name__ == '__main__':
+    app.run(benchmark)
@@ -0,0 +1,122 @@
+from replay_writer import ReplayWriter
+from extract_spatial import compact_unit_ids
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import tracemalloc
+from absl import app
+from absl import flags
+
+import numpy as np
+from scipy import sparse
+
+FLAGS = flags.FLAGS
+flags.DEFINE_integer(name='n_steps', default=1100,
+                     help='# of steps in the synthetic replay')
+flags.DEFINE_integer(name='n_features', default=515,
+                     help='# of global features')
+flags.DEFINE_integer(name='map_size', default=64,
+                     help='Spatial observation size in pixels')
+flags.DEFINE_integer(name='chunk_size', default=32,
+                     help='# of steps per chunk written by the streaming writer')
+flags.DEFINE_integer(name='seed', default=0,
+                     help='Random seed')
+
+
+def synthetic_steps(rng):
+    """
+    Spatial/global states resembling a replay
+
+    A fixed height map, categorical layers where a small share of the pixels change every step, and global counters
+    that change now and then
+    """
+    spatial_state = np.zeros((6, FLAGS.map_size, FLAGS.map_size), dtype=np.int32)
+    spatial_state[0] = rng.integers(0, 256, (FLAGS.map_size, FLAGS.map_size))
+    spatial_state[5] = rng.random((FLAGS.map_size, FLAGS.map_size)) < 0.7
+    global_state = np.zeros(FLAGS.n_features)
+    unit_ids = compact_unit_ids('Protoss', 'Terran')
+
+    for step in range(FLAGS.n_steps):
+        for channel, values, density in [(1, np.arange(4), 0.05), (2, np.arange(2), 0.01),
+                                         (3, np.arange(5), 0.02), (4, unit_ids, 0.02)]:
+            mask = rng.random((FLAGS.map_size, FLAGS.map_size)) < density
+            spatial_state[channel][mask] = rng.choice(values, mask.sum())
+
+        global_state[0] = step * 72
+        changed = rng.random(FLAGS.n_features) < 0.05
+        global_state[changed] = rng.integers(0, 50, changed.sum())
+
+        yield spatial_state.copy(), global_state.copy(), []
+
+
+def legacy_write(output_path, name, steps):
+    spatial_states_np, global_states_np = [], []
+    actions = {}
+    n_states = 0
+
+    for spatial_state, global_state, step_actions in steps:
+        actions[n_states] = step_actions
+        spatial_states_np.append(spatial_state)
+        global_states_np.append(global_state)
+        n_states += 1
+
+    spatial_states_np = np.asarray(spatial_states_np)
+    global_states_np = np.asarray(global_states_np)
+
+    spatial_states_np = spatial_states_np.reshape((n_states, -1))
+
+    sparse.save_npz(os.path.join(output_path, 'global', f'{name}.glo'), sparse.csc_matrix(global_states_np))
+    sparse.save_npz(os.path.join(output_path, 'spatial', f'{name}.spa'), sparse.csc_matrix(spatial_states_np))
+
+    with open(os.path.join(output_path, 'actions', f'{name}.act'), 'w') as f:
+        f.write(json.dumps(actions, indent=4))
+
+
+def streaming_write(output_path, name, steps):
+    writer = ReplayWriter(output_path, name, FLAGS.chunk_size)
+    for spatial_state, global_state, step_actions in steps:
+        writer.append(spatial_state, global_state, step_actions)
+    writer.seal()
+
+
+def measure(write, output_path, name):
+    steps = synthetic_steps(np.random.default_rng(FLAGS.seed))
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    write(output_path, name, steps)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return elapsed, peak
+
+
+def benchmark(argv):
+    output_path = tempfile.mkdtemp()
+    try:
+        for out_folder in ['actions', 'global', 'spatial']:
+            os.makedirs(os.path.join(output_path, out_folder))
+
+        legacy_time, legacy_peak = measure(legacy_write, output_path, 'legacy')
+        stream_time, stream_peak = measure(streaming_write, output_path, 'stream')
+
+        for folder, ext in [('global', 'glo'), ('spatial', 'spa')]:
+            legacy = sparse.load_npz(os.path.join(output_path, folder, f'legacy.{ext}.npz'))
+            stream = sparse.load_npz(os.path.join(output_path, folder, f'stream.{ext}.npz'))
+            if legacy.shape != stream.shape or legacy.dtype != stream.dtype or (legacy != stream).nnz > 0:
+                print(f'Output mismatch in {folder}')
+                sys.exit(1)
+
+        print(f"{FLAGS.n_steps} steps, outputs identical")
+        print(f"legacy    {legacy_time:7.2f} s {FLAGS.n_steps / legacy_time:8.1f} steps/s  peak {legacy_peak / 2**20:8.1f} MB")
+        print(f"streaming {stream_time:7.2f} s {FLAGS.n_steps / stream_time:8.1f} steps/s  peak {stream_peak / 2**20:8.1f} MB")
+    finally:
+        shutil.rmtree(output_path)
+
+if __name__ == '__main__':
+    app.run(benchmark)
@@ -0,0 +1,73 @@
+from extract_spatial import SpatialParser, load_compact
+from global_codec import load_global
+from shards import ShardWriter
+
+import os
+import json
+from absl import app
+from absl import flags
+
+from scipy import sparse
+import numpy as np
+
+from tqdm import tqdm
+
+FLAGS = flags.FLAGS
+flags.DEFINE_string(name='output_path', default='../parsed_replays',
+                    help='Path for saving results')
+
+flags.DEFINE_string(name='player_race', default='Protoss',
+                    help='Player race')
+flags.DEFINE_string(name='enemy_race', default='Terran',
+                    help='Enemy race')
+flags.DEFINE_integer(name='step_size', default=0,
+                     help='Step size whose outputs (step_{size}/) to consolidate, for replays parsed with several '
+                          'step_sizes. 0 for replays parsed with a single step size')
+flags.DEFINE_enum(name='spatial_format', default='sparse', enum_values=['sparse', 'compact'],
+                  help='Spatial storage the replays were parsed with')
+
+flags.DEFINE_enum(name='global_format', default='sparse', enum_values=['sparse', 'delta'],
+                  help='Global storage the replays were parsed with, sparse matrix (.glo.npz) or runs along time (.gld.npz)')
+flags.DEFINE_integer(name='map_size', default=64,
+                     help='Spatial observation size in pixels')
+flags.DEFINE_integer(name='shard_steps', default=200000,
+                     help='# of steps per shard')
+
+def load_replay(replay):
+
+    glo_ext = 'gld' if FLAGS.global_format == 'delta' else 'glo'
+    glo = load_global(os.path.join(FLAGS.output_path, 'global', f"{replay}.{glo_ext}.npz"))
+
+    if FLAGS.spatial_format == 'compact':
+        spa = load_compact(os.path.join(FLAGS.output_path, 'spatial', f"{replay}.spc.npz"))
+    else:
+        spa = np.asarray(sparse.load_npz(os.path.join(FLAGS.output_path, 'spatial', f"{replay}.spa.npz")).todense())
+
+    with open(os.path.join(FLAGS.output_path, 'actions', f"{replay}.act")) as f:
+        actions = json.load(f)
+
+    actions = [[int(func_id) for action in actions[str(step)] for func_id in action] for step in range(glo.shape[0])]
+
+    return glo, spa, actions
+
+def consolidate(argv):
+    """Pack the replays listed by finalise into memory mapped shards, appending any not already in them"""
+
+    FLAGS.output_path = os.path.join(FLAGS.output_path, f"{FLAGS.player_race}_vs_{FLAGS.enemy_race}")
+    if FLAGS.step_size > 0: # As laid out by parse with step_sizes
+        FLAGS.output_path = os.path.join(FLAGS.output_path, f"step_{FLAGS.step_size}")
+
+    replays = np.loadtxt(os.path.join(FLAGS.output_path, 'replays.csv'), delimiter=',', usecols=(0), ndmin=1, dtype='str')
+
+    writer = ShardWriter(os.path.join(FLAGS.output_path, 'shards'), FLAGS.shard_steps)
+    spatial_shape = (len(SpatialParser().features), FLAGS.map_size, FLAGS.map_size)
+
+    try:
+        for replay in tqdm([replay for replay in replays if replay not in writer], desc='Consolidating'):
+            glo, spa, actions = load_replay(replay)
+            writer.append(replay, glo, spa.reshape((glo.shape[0], *spatial_shape)), actions)
+    finally:
+        writer.close()
+
+if __name__ == '__main__':
+    app.run(consolidate)
@@ -0,0 +1,97 @@
+import os
+import traceback
+
+import portpicker
+
+
+def pick_ports(n):
+    """
+    Distinct ports free right now, one per instance, so instances launched at once don't all pick the same one
+
+    Best effort: nothing holds them until the clients bind them, which happens later in the workers (a socket held
+    here would keep the client from binding), so another process may take one in the meantime. ControllerSlot.launch
+    then retries on a freshly picked port
+    """
+    ports = set()
+    while len(ports) < n:
+        ports.add(portpicker.pick_unused_port())
+
+    return sorted(ports)
+
+
+class ControllerSlot:
+    """
+    A game client owned by a worker and reused across replays
+
+    The client is health checked with ping() before it's handed out, and only relaunched when it has crashed or used up
+    its budget of replays (max_replays) or resident memory (max_memory, MB). 0 disables a budget
+    """
+    def __init__(self, run_config, port, max_replays, max_memory):
+        self.run_config = run_config
+        self.port = port
+        self.max_replays = max_replays
+        self.max_memory = max_memory
+
+        self.process = None
+        self.n_replays = 0
+        self.n_restarts = 0
+
+    def controller(self):
+        """A healthy controller, launching the client if needed"""
+        if self.process is not None and not self.healthy():
+            print(f'Instance on port {self.port} stopped responding, restarting')
+            self.close()
+            self.n_restarts += 1
+
+        if self.process is None:
+            self.launch()
+
+        return self.process.controller
+
+    def healthy(self):
+        try:
+            return self.process.running and self.process.controller.ping() is not None
+        except Exception:
+            return False
+
+    def launch(self, attempts=3):
+        for attempt in range(attempts):
+            try:
+                self.process = self.run_config.start(port=self.port)
+                self.n_replays = 0
+                return
+            except Exception:
+                traceback.print_exc()
+                self.close()
+                self.port = portpicker.pick_unused_port() # Picked port may have been taken in the meantime
+
+        raise RuntimeError(f'Unable to launch an instance after {attempts} attempts')
+
+    def release(self):
+        """Hand the controller back after a replay, restarting the client if it's over budget"""
+        if self.process is None:
+            return
+
+        self.n_replays += 1
+
+        if self.max_replays > 0 and self.n_replays >= self.max_replays:
+            self.close()
+        elif self.max_memory > 0 and self.memory() > self.max_memory:
+            print(f'Instance on port {self.port} over its memory budget, restarting')
+            self.close()
+
+    def memory(self):
+        """Resident memory of the client in MB, 0 where it can't be read"""
+        try:
+            with open(f'/proc/{self.process.pid}/statm') as f:
+                return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+        except (OSError, ValueError):
+            return 0
+
+    def close(self):
+        if self.process is not None:
+            try:
+                self.process.close()
+            except Exception:
+                traceback.print_exc()
+            self.process = None
@@ -1,21 +1,102 @@
-from pysc2.lib.actions import FUNCTIONS
+from pysc2.lib.actions import FUNCTIONS, ABILITY_IDS
 from pysc2.lib import features
+from s2clientprotocol import sc2api_pb2 as sc_pb
+from collections import Counter
 
+MACRO_CATEGORIES = {'Build', 'Train', 'Research', 'Morph', 'TrainWarp'}
 
-def extract_actions(obs):
+# Commands by how they target, in the form reverse_action expects them
+COMMANDS = {
+    'screen': lambda ability_id: sc_pb.Action(action_feature_layer={'unit_command': {
+        'ability_id': ability_id, 'target_screen_coord': {'x': 0, 'y': 0}}}),
+    'minimap': lambda ability_id: sc_pb.Action(action_feature_layer={'unit_command': {
+        'ability_id': ability_id, 'target_minimap_coord': {'x': 0, 'y': 0}}}),
+    'quick': lambda ability_id: sc_pb.Action(action_feature_layer={'unit_command': {'ability_id': ability_id}}),
+    'autocast': lambda ability_id: sc_pb.Action(action_ui={'toggle_autocast': {'ability_id': ability_id}}),
+}
 
-    agent_intf = features.AgentInterfaceFormat(feature_dimensions=features.Dimensions(screen=(1,1), minimap=(1,1)))
-    feat = features.Features(agent_intf)
+UI_ACTIONS = {'control_group', 'select_army', 'select_warp_gates', 'select_larva', 'select_idle_worker',
+              'multi_panel', 'cargo_panel', 'production_panel'}
 
-    actions = []
+SPATIAL_ACTIONS = {'camera_move', 'unit_selection_point', 'unit_selection_rect'}
 
-    for action in obs.actions:
-        try:
-            func_id = feat.reverse_action(action).function
-            func_name = FUNCTIONS[func_id].name
-            if func_name.split('_')[0] in {'Build', 'Train', 'Research', 'Morph', 'TrainWarp'}:
-                actions.append({func_id: func_name})    
-        except:
-            pass
 
-    return actions
\ No newline at end of file
+class ActionExtractor:
+    """
+    Extracts macro actions (Build, Train, Research, Morph, TrainWarp) from observations
+
+    The agent interface is built once, and every ability is run through reverse_action up front to get an
+    (ability_id, command) -> (function_id, function_name) table, so actions are classified with a single dict lookup.
+    Actions that can't be classified are counted in self.counts rather than dropped silently
+    """
+    def __init__(self):
+        agent_intf = features.AgentInterfaceFormat(feature_dimensions=features.Dimensions(screen=(1,1), minimap=(1,1)))
+        self.feat = features.Features(agent_intf)
+
+        self.ability_map = {}
+        self.counts = Counter()
+
+        for ability_id in ABILITY_IDS:
+            for command, build_action in COMMANDS.items():
+                try:
+                    func_id = self.feat.reverse_action(build_action(ability_id)).function
+                except ValueError: # Ability has no function for this kind of command
+                    continue
+
+                func_name = FUNCTIONS[func_id].name
+                if func_name.split('_')[0] in MACRO_CATEGORIES:
+                    self.ability_map[(ability_id, command)] = (int(func_id), func_name)
+                else:
+                    self.ability_map[(ability_id, command)] = None
+
+    def classify(self, action):
+        """Key into the ability map for an action, or the reason it can't be a macro action"""
+        if action.HasField('action_ui'):
+            ui_action = action.action_ui.WhichOneof('action')
+            if ui_action == 'toggle_autocast':
+                return (action.action_ui.toggle_autocast.ability_id, 'autocast')
+            elif ui_action in UI_ACTIONS:
+                return 'other'
+
+        if action.HasField('action_feature_layer'):
+            spatial_action = action.action_feature_layer.WhichOneof('action')
+            if spatial_action == 'unit_command':
+                cmd = action.action_feature_layer.unit_command
+                if cmd.HasField('target_screen_coord'):
+                    return (cmd.ability_id, 'screen')
+                elif cmd.HasField('target_minimap_coord'):
+                    return (cmd.ability_id, 'minimap')
+                else:
+                    return (cmd.ability_id, 'quick')
+            elif spatial_action in SPATIAL_ACTIONS:
+                return 'other'
+
+        if action.HasField('action_raw') or action.HasField('action_render'):
+            return 'skipped' # Not representable in the feature layer interface
+
+        return 'other'
+
+    def is_macro(self, action):
+        """Whether extract would keep an action, without counting it"""
+        key = self.classify(action)
+        return not isinstance(key, str) and self.ability_map.get(key) is not None
+
+    def extract(self, obs):
+
+        actions = []
+
+        for action in obs.actions:
+            key = self.classify(action)
+
+            if isinstance(key, str):
+                self.counts[key] += 1
+            elif key not in self.ability_map:
+                self.counts['unknown' if key[0] not in ABILITY_IDS else 'failed'] += 1
+            elif self.ability_map[key] is None:
+                self.counts['other'] += 1
+            else:
+                func_id, func_name = self.ability_map[key]
+                actions.append({func_id: func_name})
+                self.counts['macro'] += 1
+
+        return actions
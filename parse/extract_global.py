@@ -1,57 +1,86 @@
-from pysc2.lib.units import Protoss, Terran, Zerg
+from pysc2.lib.units import Neutral, Protoss, Terran, Zerg
 from pysc2.lib.upgrades import Upgrades
+from collections import Counter
+from functools import lru_cache
 import numpy as np
 
-class GlobalParser:
+RACES = {'Terran': Terran, 'Zerg': Zerg, 'Protoss': Protoss}
+
+ID_ALIAS = {
+    Protoss.DisruptorPhased : Protoss.Disruptor,
+    Protoss.ObserverSurveillanceMode : Protoss.Observer,
+    Protoss.WarpPrismPhasing : Protoss.WarpPrism,
+    Terran.GhostAlternate : Terran.Ghost,
+    Terran.GhostNova : Terran.Ghost,
+    Terran.LiberatorAG : Terran.Liberator,
+    Terran.SiegeTankSieged : Terran.SiegeTank,
+    Terran.SupplyDepotLowered : Terran.SupplyDepot,
+    Terran.ThorHighImpactMode : Terran.Thor,
+    Terran.VikingAssault : Terran.VikingFighter,
+    Zerg.OverseerOversightMode : Zerg.Overseer
+}
+
+N_UNIT_IDS = max(max(race) for race in (Neutral, Protoss, Terran, Zerg)) + 1
+
+def map_unit_ids(race):
+    """Feature index of each unit of a race, and the aliases folding alternate modes (burrowed, flying...) into them"""
+    id_map = {}
+    id_alias = {}
+    id_idx = 0
+
+    race_enum = RACES[race]
+
+    for unit, unit_id in race_enum.__members__.items():
+
+        if unit_id.value in ID_ALIAS:
+            continue
+        elif unit.endswith('Burrowed'):
+            unit = unit.replace('Burrowed','')
+        elif unit.endswith('Uprooted'):
+            unit = unit.replace('Uprooted','')
+        elif unit.endswith('Flying'):
+            unit = unit.replace('Flying','')
+        else:
+            id_map[unit_id] = id_idx
+            id_idx += 1
+            continue
 
-    def __init__(self, player_race, enemy_race):
-        self.id_alias = {
-            Protoss.DisruptorPhased : Protoss.Disruptor,
-            Protoss.ObserverSurveillanceMode : Protoss.Observer,
-            Protoss.WarpPrismPhasing : Protoss.WarpPrism,
-            Terran.GhostAlternate : Terran.Ghost,
-            Terran.GhostNova : Terran.Ghost,
-            Terran.LiberatorAG : Terran.Liberator,
-            Terran.SiegeTankSieged : Terran.SiegeTank,
-            Terran.SupplyDepotLowered : Terran.SupplyDepot,
-            Terran.ThorHighImpactMode : Terran.Thor,
-            Terran.VikingAssault : Terran.VikingFighter,
-            Zerg.OverseerOversightMode : Zerg.Overseer
-        }
-        self.player_unit_map = self.map_unit_ids(player_race)
-        self.enemy_unit_map = self.map_unit_ids(enemy_race)
-        self.upgrade_map = self.map_upgrade_ids()
+        id_alias[unit_id] = race_enum[unit]
 
-        # self.player_upgrades = [0,0,0]
-        # self.enemy_upgrades = [0,0,0]
-        self.enemy_tags = [set() for _ in self.enemy_unit_map]
+    return id_map, id_alias
 
-    def map_unit_ids(self, race):
-        id_map = {}
-        id_idx = 0
+@lru_cache(maxsize=None)
+def unit_lookup(race):
+    """
+    Unit map and aliases of a race, compiled into a dense raw unit_type -> feature index array
 
-        race_map = {'Terran': Terran, 'Zerg': Zerg, 'Protoss': Protoss}
-        race_enum = race_map[race]
+    Unknown types map to -1. Cached, so it's built once per process and race
+    """
+    id_map, id_alias = map_unit_ids(race)
 
-        for unit, unit_id in race_enum.__members__.items():
+    lookup = np.full(N_UNIT_IDS, -1, dtype=np.intp)
+    for unit_id in RACES[race]:
+        base_id = ID_ALIAS.get(unit_id, id_alias.get(unit_id, unit_id))
+        if base_id in id_map:
+            lookup[unit_id] = id_map[base_id]
 
-            if unit_id.value in self.id_alias:
-                continue
-            elif unit.endswith('Burrowed'):
-                unit = unit.replace('Burrowed','')
-            elif unit.endswith('Uprooted'):
-                unit = unit.replace('Uprooted','')
-            elif unit.endswith('Flying'):
-                unit = unit.replace('Flying','')
-            else:
-                id_map[unit_id] = id_idx
-                id_idx += 1
-                continue
+    lookup.flags.writeable = False
 
-            self.id_alias[unit_id] = race_enum[unit]
+    return id_map, id_alias, lookup
+
+class GlobalParser:
+
+    def __init__(self, player_race, enemy_race):
+        self.player_unit_map, player_alias, self.player_lookup = unit_lookup(player_race)
+        self.enemy_unit_map, enemy_alias, self.enemy_lookup = unit_lookup(enemy_race)
+        self.id_alias = {**ID_ALIAS, **player_alias, **enemy_alias}
+        self.upgrade_map = self.map_upgrade_ids()
+
+        # self.player_upgrades = [0,0,0]
+        # self.enemy_upgrades = [0,0,0]
+        self.enemy_tags = {} # Tag -> enemy columns it was seen as, until it dies
+        self.unknown_units = Counter() # Raw unit_type -> # of sightings that didn't map to a feature (neural parasite?)
 
-        return id_map
-    
     def map_upgrade_ids(self):
 
         id_map = {}
@@ -63,7 +92,8 @@ class GlobalParser:
 
         return id_map
 
-    def extract(self, obs):
+    def extract(self, obs, dead_units=None):
+        """Global features of an observation, dead_units replacing the units it reports dead if given"""
 
         state = np.array([
             obs.game_loop,
@@ -92,11 +122,9 @@ class GlobalParser:
         ])
 
         upgrades = self.get_upgrades(obs)
-        allied_alive, allied_hp = self.get_allied_alive(obs)
-        allied_construction, allied_percent = self.get_allied_construction(obs)
-        enemy_visible, enemy_hp = self.get_enemy_visible(obs)
-        enemy_construction, enemy_percent = self.get_enemy_construction(obs)
-        enemy_killed = self.get_enemy_killed(obs)
+        (allied_alive, allied_hp, allied_construction, allied_percent,
+         enemy_visible, enemy_hp, enemy_construction, enemy_percent) = self.get_units(obs)
+        enemy_killed = self.get_enemy_killed(obs, dead_units)
         # enemy_seen = self.get_enemy_seen(obs)
 
         return np.concatenate((
@@ -155,118 +183,110 @@ class GlobalParser:
 
         return upgrades
 
-    def get_unit_idx(self, type_map, unit_type):
-        if unit_type in self.id_alias:
-            unit_type = self.id_alias[unit_type]
-        
-        if unit_type in type_map:
-            return type_map[unit_type]
-        else:
-            print('Unknown unit (neural parasite?):', unit_type)
-            return None
-
-    def get_allied_alive(self, obs):
-        count = np.zeros(len(self.player_unit_map))
-        hp = np.zeros(len(self.player_unit_map))
-
-        for unit in obs.raw_data.units:
-            if unit.alliance == 1 and unit.build_progress >= 1:
-                idx = self.get_unit_idx(self.player_unit_map, unit.unit_type)
-                if idx is not None:
-                    count[idx] += 1
-                    hp[idx] += (unit.health + unit.shield) / (unit.health_max + unit.shield_max)
-                    # self.player_upgrades[0] = max(self.player_upgrades[0], unit.attack_upgrade_level)
-                    # self.player_upgrades[1] = max(self.player_upgrades[1], unit.armor_upgrade_level)
-                    # self.player_upgrades[2] = max(self.player_upgrades[2], unit.shield_upgrade_level)
-
-                    for passenger in unit.passengers:
-                        idx = self.get_unit_idx(self.player_unit_map, passenger.unit_type)
-                        if idx is not None:
-                            count[idx] += 1
-                            hp[idx] += (passenger.health + passenger.shield) / (passenger.health_max + passenger.shield_max)
-
-        for idx, num in np.ndenumerate(count):
-            if num > 0:
-                hp[idx] /= num
-
-        return (count, hp)
-
-    def get_allied_construction(self, obs):
-        count = np.zeros(len(self.player_unit_map))
-        percentage = np.zeros(len(self.player_unit_map))
-
-        for unit in obs.raw_data.units:
-            if unit.alliance == 1 and unit.build_progress < 1:
-                idx = self.get_unit_idx(self.player_unit_map, unit.unit_type)
-                if idx is not None:
-                    count[idx] += 1
-                    percentage[idx] += unit.build_progress
-
-        for idx, num in np.ndenumerate(count):
-            if num > 0:
-                percentage[idx] /= num
-
-        return (count, percentage)
-
-    def get_enemy_visible(self, obs):
-        count = np.zeros(len(self.enemy_unit_map))
-        hp = np.zeros(len(self.enemy_unit_map))
-
-        for unit in obs.raw_data.units:
-            if unit.alliance == 4 and unit.display_type == 1 and unit.build_progress >= 1:
-                idx = self.get_unit_idx(self.enemy_unit_map, unit.unit_type)
-                if idx is not None:
-                    count[idx] += 1
-                    hp[idx] += (unit.health + unit.shield) / (unit.health_max + unit.shield_max)
-                    self.enemy_tags[idx].add(unit.tag)
-
-                    # self.enemy_upgrades[0] = max(self.enemy_upgrades[0], unit.attack_upgrade_level)
-                    # self.enemy_upgrades[1] = max(self.enemy_upgrades[1], unit.armor_upgrade_level)
-                    # self.enemy_upgrades[2] = max(self.enemy_upgrades[2], unit.shield_upgrade_level)
-
-        for idx, num in np.ndenumerate(count):
-            if num > 0:
-                hp[idx] /= num
-
-        return (count, hp)
-
-    def get_enemy_construction(self, obs):
-        count = np.zeros(len(self.enemy_unit_map))
-        percentage = np.zeros(len(self.enemy_unit_map))
-
-        for unit in obs.raw_data.units:
-            if unit.alliance == 4 and unit.display_type == 1 and unit.build_progress < 1:
-                idx = self.get_unit_idx(self.enemy_unit_map, unit.unit_type)
-                if idx is not None:
-                    count[idx] += 1
-                    percentage[idx] += unit.build_progress
-                    self.enemy_tags[idx].add(unit.tag)
-
-        for idx, num in np.ndenumerate(count):
-            if num > 0:
-                percentage[idx] /= num
-
-        return (count, percentage)
-
-    def get_enemy_killed(self, obs):
-
-        dead_tags = set(obs.raw_data.event.dead_units)
-
+    def map_units(self, lookup, unit_types):
+        """Map an array of raw unit types to feature indices through a lookup table, -1 for unknown units"""
+        unit_types = np.asarray(unit_types, dtype=np.intp)
+        idx = lookup[np.minimum(unit_types, len(lookup) - 1)]
+        idx[unit_types >= len(lookup)] = -1
+
+        unknown = unit_types[idx < 0]
+        if len(unknown) > 0:
+            self.unknown_units.update(unknown.tolist())
+
+        return idx
+
+    def get_units(self, obs):
+        """
+        Allied alive/construction and enemy visible/construction counts in a single pass over the units
+
+        Unit fields are pulled into columns once and reduced with np.bincount, which sums weights in unit order so
+        the result is identical to accumulating unit by unit
+        """
+        units = obs.raw_data.units
+
+        rows = [(unit.alliance, unit.display_type, unit.build_progress, unit.unit_type,
+                 unit.health + unit.shield, unit.health_max + unit.shield_max, unit.tag) for unit in units]
+        cols = np.array(rows, dtype=np.float64).reshape(-1, 7)
+
+        alliance, display_type, build_progress = cols[:,0], cols[:,1], cols[:,2]
+        unit_type = cols[:,3].astype(np.int64)
+
+        allied = alliance == 1
+        enemy = (alliance == 4) & (display_type == 1)
+        built = build_progress >= 1
+
+        player_idx = np.full(len(units), -1, dtype=np.int64)
+        player_idx[allied] = self.map_units(self.player_lookup, unit_type[allied])
+        enemy_idx = np.full(len(units), -1, dtype=np.int64)
+        enemy_idx[enemy] = self.map_units(self.enemy_lookup, unit_type[enemy])
+
+        # Allied alive units, with passengers following straight after the unit carrying them
+        alive = np.flatnonzero(allied & built & (player_idx >= 0))
+        alive_idx = player_idx[alive]
+        alive_hp = cols[alive,4] / cols[alive,5]
+
+        passengers = [(pos + 1, passenger) for pos, i in enumerate(alive) for passenger in units[int(i)].passengers]
+        if len(passengers) > 0:
+            passenger_idx = self.map_units(self.player_lookup, [passenger.unit_type for _, passenger in passengers])
+            passengers = [(pos, idx, (passenger.health + passenger.shield) / (passenger.health_max + passenger.shield_max))
+                          for (pos, passenger), idx in zip(passengers, passenger_idx) if idx >= 0]
+
+            if len(passengers) > 0:
+                positions, passenger_idx, passenger_hp = zip(*passengers)
+                alive_idx = np.insert(alive_idx, positions, passenger_idx)
+                alive_hp = np.insert(alive_hp, positions, passenger_hp)
+
+        allied_alive, allied_hp = self.reduce_units(len(self.player_unit_map), alive_idx, alive_hp)
+
+        construction = np.flatnonzero(allied & ~built & (player_idx >= 0))
+        allied_construction, allied_percent = self.reduce_units(len(self.player_unit_map),
+                                                                player_idx[construction], build_progress[construction])
+
+        visible = np.flatnonzero(enemy & built & (enemy_idx >= 0))
+        enemy_visible, enemy_hp = self.reduce_units(len(self.enemy_unit_map),
+                                                    enemy_idx[visible], cols[visible,4] / cols[visible,5])
+
+        construction = np.flatnonzero(enemy & ~built & (enemy_idx >= 0))
+        enemy_construction, enemy_percent = self.reduce_units(len(self.enemy_unit_map),
+                                                              enemy_idx[construction], build_progress[construction])
+
+        seen = np.flatnonzero(enemy & (enemy_idx >= 0))
+        self.track_enemy_tags([rows[i][6] for i in seen], enemy_idx[seen].tolist()) # Tags don't fit in float64 columns
+
+        return (allied_alive, allied_hp, allied_construction, allied_percent,
+                enemy_visible, enemy_hp, enemy_construction, enemy_percent)
+
+    @staticmethod
+    def reduce_units(n_types, idx, values):
+        """Per type unit count and mean of values"""
+        count = np.bincount(idx, minlength=n_types).astype(np.float64)
+        total = np.bincount(idx, weights=values, minlength=n_types).astype(np.float64, copy=False) # int64 if idx is empty
+        np.divide(total, count, out=total, where=count > 0)
+
+        return (count, total)
+
+    def track_enemy_tags(self, tags, idx):
+        """Remember the column of every enemy tag seen, a tag seen as several unit types counting for each of them"""
+        enemy_tags = self.enemy_tags
+        for tag, i in zip(tags, idx):
+            columns = enemy_tags.get(tag)
+            if columns is None:
+                enemy_tags[tag] = (i,)
+            elif i not in columns:
+                enemy_tags[tag] = columns + (i,)
+
+    def get_enemy_killed(self, obs, dead_units=None):
+        """
+        Per type count of the enemy units seen that died since the last observation
+
+        Only the dead tags are looked up, and they're dropped as they're counted, so the cost is in the # of deaths
+        rather than the # of enemy units seen so far
+        """
         count = np.zeros(len(self.enemy_unit_map))
 
-        for idx, tags in enumerate(self.enemy_tags):
-            remaining_tags = tags - dead_tags
-            count[idx] = len(tags) - len(remaining_tags)
-
-            # if count[idx] > 0:
-
-            #     for a, b in self.enemy_unit_map.items():
-            #         if b == idx:
-            #             name = a.name
-
-            #     print(f"{name} killed-{count[idx]} remaining-{len(remaining_tags)}")
-
-            self.enemy_tags[idx] = remaining_tags
+        for tag in (obs.raw_data.event.dead_units if dead_units is None else dead_units):
+            for i in self.enemy_tags.pop(tag, ()):
+                count[i] += 1
 
         return count
 
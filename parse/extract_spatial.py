@@ -1,4 +1,9 @@
 from pysc2.lib.features import MINIMAP_FEATURES
+from pysc2.lib.units import Neutral
+from extract_global import RACES
+import os
+import re
+import hashlib
 import numpy as np
 
 
@@ -10,4 +15,83 @@ class SpatialParser:
         return np.stack([f.unpack(obs) for f in MINIMAP_FEATURES if f.name in self.features])#.astype(np.float32, copy=False)
 
     def get_scale(self):
-        return [(f.name,f.type.name,f.scale) for f in MINIMAP_FEATURES if f.name in self.features]
\ No newline at end of file
+        return [(f.name,f.type.name,f.scale) for f in MINIMAP_FEATURES if f.name in self.features]
+
+    def get_encoding(self):
+        """Compact storage of each channel: 'bits' for binary layers, otherwise the smallest dtype that fits its scale"""
+        encoding = []
+
+        for name, _, scale in self.get_scale():
+            if name == 'unit_type':
+                encoding.append((name, 'unit_type')) # Remapped to a compact unit index
+            elif scale <= 2:
+                encoding.append((name, 'bits'))
+            elif scale <= 256:
+                encoding.append((name, np.uint8))
+            else:
+                encoding.append((name, np.uint16))
+
+        return encoding
+
+def compact_unit_ids(player_race, enemy_race):
+    """Raw unit_type ids that can appear in a matchup, index 0 being no unit"""
+    unit_ids = {0}
+    for race in (Neutral, RACES[player_race], RACES[enemy_race]):
+        unit_ids.update(unit_id.value for unit_id in race)
+
+    return np.array(sorted(unit_ids), dtype=np.int32)
+
+def map_key(replay_info, map_size):
+    """Name of a replay's map in the map cache, with a hash telling apart custom maps and resolutions of the same name"""
+    name = re.sub(r'[^A-Za-z0-9]+', '_', replay_info.map_name).strip('_') or 'map'
+    digest = hashlib.sha1(f'{replay_info.map_name}|{replay_info.local_map_path}|{map_size}'.encode()).hexdigest()
+
+    return f'{name}-{digest[:10]}'
+
+def replay_changes(frame, counts, pixels, values):
+    """(n_states, n_pixels) frames of a static channel from its cached frame and the pixels changed at every step"""
+    frames = np.empty((len(counts), frame.size), dtype=frame.dtype)
+    frame = frame.copy()
+    ends = np.cumsum(counts)
+
+    # Steps without changes are copies of the last frame
+    last = 0
+    for step in np.flatnonzero(counts).tolist():
+        frames[last:step] = frame
+        frame[pixels[ends[step] - counts[step]:ends[step]]] = values[ends[step] - counts[step]:ends[step]]
+        last = step
+    frames[last:] = frame
+
+    return frames
+
+def load_compact(path, maps_path=None):
+    """
+    Decode a compact spatial file (.spc.npz) back to the (n_states, n_channels, height, width) minimap stack
+
+    Static channels are rebuilt from the map cache, by default the maps folder next to the spatial folder
+    """
+    with np.load(path) as data:
+        n_states, n_channels, height, width = data['shape']
+        spatial = np.empty((n_states, n_channels, height, width), dtype=data['dtype'].item())
+
+        static = {}
+        if 'static' in data.files:
+            maps_path = maps_path or os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(path))), 'maps')
+            with np.load(os.path.join(maps_path, data['map'].item())) as cached:
+                static = {name: cached[name] for name in data['static']}
+
+        for i, name in enumerate(data['channels']):
+            if name in static:
+                spatial[:,i] = replay_changes(static[name], data[f'{name}.counts'], data[f'{name}.pixels'],
+                                              data[f'{name}.values']).reshape(n_states, height, width)
+                continue
+
+            channel = data[name]
+            if name == 'unit_type':
+                spatial[:,i] = data['unit_ids'][channel]
+            elif channel.dtype == np.uint8 and channel.ndim == 2: # Bit-packed
+                spatial[:,i] = np.unpackbits(channel, axis=1, count=height * width).reshape(n_states, height, width)
+            else:
+                spatial[:,i] = channel
+
+    return spatial
@@ -1,5 +1,7 @@
 from extract_global import GlobalParser
 from extract_spatial import SpatialParser
+from manifest import Manifest
+from global_codec import load_global
 
 import os
 import sys
@@ -7,7 +9,6 @@ import json
 from absl import app
 from absl import flags
 
-from scipy import sparse
 import numpy as np
 
 from tqdm import tqdm
@@ -22,22 +23,50 @@ flags.DEFINE_string(name='player_race', default='Protoss',
                     help='Player race')
 flags.DEFINE_string(name='enemy_race', default='Terran',
                     help='Enemy race')
+flags.DEFINE_integer(name='step_size', default=0,
+                     help='Step size whose outputs (step_{size}/) to finalise, for replays parsed with several '
+                          'step_sizes. 0 for replays parsed with a single step size')
+flags.DEFINE_enum(name='spatial_format', default='sparse', enum_values=['sparse', 'compact'],
+                  help='Spatial storage the replays were parsed with')
+flags.DEFINE_enum(name='global_format', default='sparse', enum_values=['sparse', 'delta'],
+                  help='Global storage the replays were parsed with, sparse matrix (.glo.npz) or runs along time (.gld.npz)')
 
-def is_valid_replay(replay, player):
+def is_valid_replay(replay, player, manifest):
 
     if player['race'] != FLAGS.player_race:
         return False, None
 
     replay_id = os.path.basename(replay['path']).replace('.SC2Replay','')
 
-    if not os.path.isfile(os.path.join(FLAGS.output_path, 'global', f"{player['id']}@{replay_id}.glo.npz")):
+    record = manifest.get(f"{player['id']}@{replay_id}") if manifest is not None else None
+    if record is None:
+        return is_valid_files(replay, player, replay_id)
+
+    if record['global_format'] != FLAGS.global_format:
+        return False, -1
+    if record['spatial_format'] != FLAGS.spatial_format:
+        return False, -2
+    if record['second_loop'] is None:
+        return False, record['n_steps']
+
+    if (replay['duration_frames'] - record['last_loop']) > (record['second_loop'] * 10): # If final frame cut off too early, give 10x leeway
+        return False, record['n_steps']
+
+    return True, record['n_steps']
+
+def is_valid_files(replay, player, replay_id):
+    """Validity check against the outputs themselves, for replays parsed before the manifest existed"""
+    spatial_ext = 'spc' if FLAGS.spatial_format == 'compact' else 'spa'
+    global_ext = 'gld' if FLAGS.global_format == 'delta' else 'glo'
+
+    if not os.path.isfile(os.path.join(FLAGS.output_path, 'global', f"{player['id']}@{replay_id}.{global_ext}.npz")):
         return False, -1
-    if not os.path.isfile(os.path.join(FLAGS.output_path, 'spatial', f"{player['id']}@{replay_id}.spa.npz")):
+    if not os.path.isfile(os.path.join(FLAGS.output_path, 'spatial', f"{player['id']}@{replay_id}.{spatial_ext}.npz")):
         return False, -2
     if not os.path.isfile(os.path.join(FLAGS.output_path, 'actions', f"{player['id']}@{replay_id}.act")):
         return False, -3
         
-    glo = np.asarray(sparse.load_npz(os.path.join(FLAGS.output_path, 'global', f"{player['id']}@{replay_id}.glo.npz")).todense())
+    glo = load_global(os.path.join(FLAGS.output_path, 'global', f"{player['id']}@{replay_id}.{global_ext}.npz"))
 
     if (replay['duration_frames'] - glo[-1,0]) > (glo[1,0] * 10): # If final frame cut off too early, give 10x leeway
         return False, glo.shape[0]
@@ -47,6 +76,8 @@ def is_valid_replay(replay, player):
 def finalise(argv):
 
     FLAGS.output_path = os.path.join(FLAGS.output_path, f"{FLAGS.player_race}_vs_{FLAGS.enemy_race}")
+    if FLAGS.step_size > 0: # As laid out by parse with step_sizes
+        FLAGS.output_path = os.path.join(FLAGS.output_path, f"step_{FLAGS.step_size}")
 
     with open(os.path.join(FLAGS.output_path, 'features.csv'), 'w') as f:
         global_parser = GlobalParser(FLAGS.player_race, FLAGS.enemy_race)
@@ -67,11 +98,13 @@ def finalise(argv):
     with open(os.path.join(FLAGS.library_path, '_vs_'.join(sorted([FLAGS.player_race, FLAGS.enemy_race])) + '.json')) as f:
         replay_library = json.load(f) 
 
+    manifest = Manifest(FLAGS.output_path) if Manifest.exists(FLAGS.output_path) else None
+
     with open(os.path.join(FLAGS.output_path, 'replays.csv'), 'w') as f:
         
         for replay in tqdm(replay_library, desc = 'Finalising'):
             for player in replay['players']:
-                valid, steps = is_valid_replay(replay, player)
+                valid, steps = is_valid_replay(replay, player, manifest)
 
                 if valid:
                     f.write(f"{player['id']}@{os.path.basename(replay['path']).split('.')[0]},{player['result']},{steps}\n")
@@ -0,0 +1,188 @@
+import os
+
+import numpy as np
+from scipy import sparse
+
+# Storage types by code, 'none' for the slopes of columns stored as constant runs
+CODES = ['none', 'uint8', 'int8', 'uint16', 'int16', 'uint32', 'int32', 'int64', 'float32', 'float64']
+INTEGERS = ['uint8', 'int8', 'uint16', 'int16', 'uint32', 'int32', 'int64']
+
+
+def narrow_dtype(values):
+    """Smallest storage type holding values exactly: an integer type if they're all whole, else float32 or float64"""
+    if len(values) == 0:
+        return 'uint8'
+
+    if np.isfinite(values).all() and (values == np.round(values)).all():
+        low, high = values.min(), values.max()
+        for dtype in INTEGERS:
+            if np.iinfo(dtype).min <= low and high <= np.iinfo(dtype).max:
+                return dtype
+
+    if np.array_equal(values.astype(np.float32).astype(np.float64), values, equal_nan=True):
+        return 'float32'
+
+    return 'float64'
+
+
+def encode(states):
+    """
+    Encode (n_states, n_features) global states as runs along time, column by column
+
+    A column is stored as constant runs, or as linear runs (a value and a slope) if that takes fewer runs and the
+    line reproduces it exactly, so counters like the game loop take a single run. Runs are kept in column order with
+    the step they start at, and each column's values and slopes at the smallest type that holds them exactly
+    """
+    states = np.asarray(states, dtype=np.float64)
+    n_states, n_features = states.shape
+
+    constant = np.ones((n_states, n_features), dtype=bool)
+    constant[1:] = states[1:] != states[:-1]
+
+    # A linear run starts wherever the step to the next value changes
+    delta = np.zeros((n_states, n_features))
+    delta[:-1] = states[1:] - states[:-1]
+    linear = np.ones((n_states, n_features), dtype=bool)
+    linear[1:-1] = delta[1:-1] != delta[:-2]
+
+    run_start = np.maximum.accumulate(np.where(linear, np.arange(n_states)[:,None], 0), axis=0)
+    with np.errstate(invalid='ignore'): # Non-finite values never fit a line
+        exact = (np.take_along_axis(states, run_start, axis=0) +
+                 np.take_along_axis(delta, run_start, axis=0) * (np.arange(n_states)[:,None] - run_start) == states).all(axis=0)
+    use_linear = exact & (linear.sum(axis=0) < constant.sum(axis=0))
+
+    starts = np.where(use_linear, linear, constant)
+    cols, steps = np.nonzero(starts.T) # Column order, then step order
+    values = states[steps, cols]
+    slopes = np.where(use_linear[cols], delta[steps, cols], 0)
+    ptr = np.concatenate(([0], np.cumsum(starts.sum(axis=0))))
+
+    encoded = {
+        'shape': np.array((n_states, n_features)),
+        'ptr': ptr,
+        'starts': steps.astype(np.uint16 if n_states <= 2**16 else np.uint32),
+        'value_codes': np.zeros(n_features, dtype=np.uint8),
+        'slope_codes': np.zeros(n_features, dtype=np.uint8)
+    }
+
+    grouped = {}
+    for col in range(n_features):
+        runs = slice(ptr[col], ptr[col + 1])
+        value_dtype = narrow_dtype(values[runs])
+        encoded['value_codes'][col] = CODES.index(value_dtype)
+        grouped.setdefault(f'values.{value_dtype}', []).append(values[runs].astype(value_dtype))
+
+        if use_linear[col]:
+            slope_dtype = narrow_dtype(slopes[runs])
+            encoded['slope_codes'][col] = CODES.index(slope_dtype)
+            grouped.setdefault(f'slopes.{slope_dtype}', []).append(slopes[runs].astype(slope_dtype))
+
+    for name, arrays in grouped.items():
+        encoded[name] = np.concatenate(arrays)
+
+    return encoded
+
+
+class GlobalReader:
+    """
+    Decodes encoded global states, any window of steps at a time
+
+    The runs are widened to float64 once, then every (step, column) of a window finds its run with a single
+    searchsorted over run keys (column * n_states + start step), so a window costs the same wherever it is in the replay
+    """
+    def __init__(self, encoded):
+        self.n_states, self.n_features = (int(x) for x in encoded['shape'])
+        ptr = encoded['ptr']
+        runs_per_col = np.diff(ptr)
+
+        self.starts = encoded['starts'].astype(np.int64)
+        self.keys = np.repeat(np.arange(self.n_features, dtype=np.int64), runs_per_col) * self.n_states + self.starts
+
+        self.values = np.zeros(ptr[-1])
+        self.slopes = np.zeros(ptr[-1])
+        for name, codes in [('values', encoded['value_codes']), ('slopes', encoded['slope_codes'])]:
+            run_codes = np.repeat(codes, runs_per_col)
+            for code in np.unique(codes):
+                if CODES[code] != 'none':
+                    getattr(self, name)[run_codes == code] = encoded[f'{name}.{CODES[code]}']
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls({name: data[name] for name in data.files})
+
+    @property
+    def shape(self):
+        return (self.n_states, self.n_features)
+
+    def window(self, start, stop):
+        """States of steps start to stop, (stop - start, n_features) float64"""
+        steps = np.arange(max(start, 0), min(stop, self.n_states), dtype=np.int64)
+        keys = np.arange(self.n_features, dtype=np.int64) * self.n_states + steps[:,None]
+        runs = np.searchsorted(self.keys, keys, side='right') - 1
+
+        return self.values[runs] + self.slopes[runs] * (steps[:,None] - self.starts[runs])
+
+    def read(self):
+        """All states, expanding each run by its length rather than searching for every step"""
+        ends = np.append(self.keys[1:], self.n_features * self.n_states)
+        lengths = ends - self.keys
+        offsets = np.arange(self.n_states * self.n_features) - np.repeat(self.keys, lengths)
+        states = np.repeat(self.values, lengths) + np.repeat(self.slopes, lengths) * offsets
+
+        return states.reshape((self.n_features, self.n_states)).T
+
+
+def save(path, states):
+    """Write global states to a delta/run-length file (.gld.npz), returns its size in bytes"""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez_compressed(f, **encode(states))
+    os.replace(tmp_path, path)
+
+    return os.path.getsize(path)
+
+
+def load_global(path):
+    """(n_states, n_features) global states of a sparse (.glo.npz) or delta/run-length (.gld.npz) file"""
+    if path.endswith('.gld.npz'):
+        return GlobalReader.load(path).read()
+
+    return np.asarray(sparse.load_npz(path).todense())
+
+
+class DeltaGlobalWriter:
+    """
+    Streams global states to a spool and encodes them into a .gld.npz when sealed
+
+    Runs span the whole replay, so rows are spooled raw (a few MB per replay) rather than encoded chunk by chunk
+    """
+    def __init__(self, path, spool_dir):
+        self.path = path
+        self.n_rows = 0
+        self.n_cols = 0
+        self.spool_path = os.path.join(spool_dir, os.path.basename(path) + '.rows')
+        self.file = open(self.spool_path, 'wb')
+
+    def append(self, row):
+        self.n_cols = row.size
+        self.file.write(np.asarray(row, dtype=np.float64).tobytes())
+        self.n_rows += 1
+
+    def finish(self):
+        """Close the spool, after which the writer pickles small and can be sealed by another process"""
+        if self.file is None:
+            return
+
+        self.file.close()
+        self.file = None
+
+    def seal(self):
+        """Write the final .gld.npz, returns its size in bytes"""
+        self.finish()
+
+        states = np.fromfile(self.spool_path, dtype=np.float64).reshape((self.n_rows, self.n_cols))
+        return save(self.path, states)
+
+    def abort(self):
+        self.finish()
@@ -0,0 +1,229 @@
+from extract_spatial import SpatialParser, load_compact
+from global_codec import load_global
+
+import os
+import sys
+import json
+import signal
+import threading
+import itertools
+import collections
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+from scipy import sparse
+import numpy as np
+
+
+def read_split(path, split):
+    """Names and # of steps of the replays in train.csv/test.csv (name, result, # of steps per line)"""
+    rows = np.loadtxt(os.path.join(path, f'{split}.csv'), delimiter=',', usecols=(0, 2), ndmin=2, dtype='str')
+
+    return list(rows[:,0]), rows[:,1].astype(np.int64)
+
+
+def load_replay(path, replay):
+    """
+    Global states, spatial states and per step action ids of a parsed replay, whichever formats it was written in
+
+    Spatial states are uint16 as in batches, and sparse ones are kept as a CSR matrix of
+    (n_steps, n_channels * height * width) so a cached replay costs about what it does on disk and only the windows
+    read are made dense
+    """
+    if os.path.isfile(os.path.join(path, 'global', f'{replay}.gld.npz')):
+        glo = load_global(os.path.join(path, 'global', f'{replay}.gld.npz'))
+    else:
+        glo = load_global(os.path.join(path, 'global', f'{replay}.glo.npz'))
+
+    if os.path.isfile(os.path.join(path, 'spatial', f'{replay}.spc.npz')):
+        spa = load_compact(os.path.join(path, 'spatial', f'{replay}.spc.npz')).astype(np.uint16)
+    else:
+        spa = sparse.load_npz(os.path.join(path, 'spatial', f'{replay}.spa.npz')).tocsr().astype(np.uint16)
+
+    with open(os.path.join(path, 'actions', f'{replay}.act')) as f:
+        actions = json.load(f)
+
+    actions = [np.array([func_id for action in actions[str(step)] for func_id in action], dtype=np.int32)
+               for step in range(glo.shape[0])]
+
+    return glo, spa, actions
+
+
+def replay_bytes(replay):
+    glo, spa, actions = replay
+    spa_bytes = spa.data.nbytes + spa.indices.nbytes + spa.indptr.nbytes if sparse.issparse(spa) else spa.nbytes
+
+    return glo.nbytes + spa_bytes + sum(step.nbytes for step in actions)
+
+
+class WindowReader:
+    """
+    Reads step windows of parsed replays through an LRU cache of decoded replays bounded by cache_bytes
+
+    Safe to share between threads. Two threads missing the same replay at once both decode it, which costs time but
+    not correctness
+    """
+    def __init__(self, path, window, spatial_shape, cache_bytes, scale=None, offset=None):
+        self.path = path
+        self.window = window
+        self.spatial_shape = spatial_shape
+        self.cache_bytes = cache_bytes
+        self.scale = scale
+        self.offset = offset
+
+        self.cache = collections.OrderedDict()
+        self.cached_bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def replay(self, name):
+        with self.lock:
+            if name in self.cache:
+                self.cache.move_to_end(name)
+                self.hits += 1
+                return self.cache[name]
+            self.misses += 1
+
+        replay = load_replay(self.path, name)
+        size = replay_bytes(replay)
+
+        with self.lock:
+            if name not in self.cache:
+                self.cache[name] = replay
+                self.cached_bytes += size
+            # The replay just read is kept even if it alone is over the budget, it's used right away
+            while self.cached_bytes > self.cache_bytes and len(self.cache) > 1:
+                _, evicted = self.cache.popitem(last=False)
+                self.cached_bytes -= replay_bytes(evicted)
+
+        return replay
+
+    def read_batch(self, windows):
+        """
+        Global states (batch, window, n_features) float32, spatial states (batch, window, *spatial_shape) uint16 and
+        per step action ids of windows given as (replay, first step)
+        """
+        glo_batch, spa_batch, act_batch = [], [], []
+
+        for name, start in windows:
+            glo, spa, actions = self.replay(name)
+            stop = start + self.window
+
+            glo_batch.append(glo[start:stop])
+            if sparse.issparse(spa):
+                spa_batch.append(spa[start:stop].toarray().reshape((self.window, *self.spatial_shape)))
+            else:
+                spa_batch.append(spa[start:stop])
+            act_batch.append(actions[start:stop])
+
+        glo_batch = np.stack(glo_batch).astype(np.float32)
+        if self.scale is not None:
+            glo_batch -= self.offset
+            glo_batch /= self.scale
+
+        return glo_batch, np.stack(spa_batch), act_batch
+
+
+worker = {}
+
+
+def init_worker(*reader_args):
+    """Build the process' own WindowReader from its constructor arguments, a reader holds a lock and so can't be
+    pickled to processes started with spawn or forkserver"""
+    signal.signal(signal.SIGTERM, lambda a, b: sys.exit())
+    worker['reader'] = WindowReader(*reader_args)
+
+
+def read_batch(windows):
+    return worker['reader'].read_batch(windows)
+
+
+class BatchLoader:
+    """
+    Batches of fixed length step windows sampled across the replays of train.csv or test.csv
+
+    Windows are drawn uniformly over every window of every replay long enough to hold one, windows_per_replay at a
+    time from the same replay so a cached replay serves several windows. Batch i only depends on (seed, i), so a run
+    is reproducible whatever the # of workers and can resume from any batch
+
+    Batches are read by n_workers threads, or processes with backend='process' (each with its own cache), at most
+    prefetch batches ahead of the consumer; with no workers they're read in the consumer. With normalise, global
+    states are scaled by normalisation.npz as written by postprocess, (global - offset) / scale
+
+    Usage:
+        with BatchLoader(path, 'train') as loader:
+            for global_states, spatial_states, actions in loader.batches(n_batches):
+                ...
+    """
+    def __init__(self, path, split='train', window=32, batch_size=16, windows_per_replay=4, seed=0, normalise=False,
+                 map_size=64, n_workers=2, backend='thread', prefetch=4, cache_bytes=2**30):
+        self.window = window
+        self.batch_size = batch_size
+        self.windows_per_replay = windows_per_replay
+        self.seed = seed
+        self.prefetch = prefetch
+        self.backend = backend
+
+        names, n_steps = read_split(path, split)
+        long_enough = n_steps >= window
+        self.replays = [name for name, keep in zip(names, long_enough) if keep]
+        self.n_windows = n_steps[long_enough] - window + 1
+        if len(self.replays) == 0:
+            raise ValueError(f'No replay in {split}.csv has {window} steps')
+
+        scale = offset = None
+        if normalise:
+            with np.load(os.path.join(path, 'normalisation.npz')) as data:
+                scale, offset = data['scale'].astype(np.float32), data['offset'].astype(np.float32)
+
+        spatial_shape = (len(SpatialParser().features), map_size, map_size)
+        reader_args = (path, window, spatial_shape, cache_bytes, scale, offset)
+        self.reader = WindowReader(*reader_args)
+
+        self.pool = None
+        if n_workers > 0 and backend == 'process':
+            self.pool = multiprocessing.Pool(n_workers, init_worker, reader_args)
+        elif n_workers > 0:
+            self.pool = ThreadPool(n_workers)
+
+    def sample(self, batch):
+        """(replay, first step) of every window of a batch"""
+        rng = np.random.default_rng((self.seed, batch))
+        n_groups = -(-self.batch_size // self.windows_per_replay)
+
+        replays = rng.choice(len(self.replays), n_groups, p=self.n_windows / self.n_windows.sum())
+        starts = rng.integers(0, self.n_windows[replays][:,None], (n_groups, self.windows_per_replay))
+
+        return [(self.replays[replay], int(start)) for replay, row in zip(replays, starts) for start in row][:self.batch_size]
+
+    def batches(self, n_batches=None, start=0):
+        """Batches start to start + n_batches (endless if None) in order"""
+        indices = range(start, start + n_batches) if n_batches is not None else itertools.count(start)
+
+        if self.pool is None:
+            for batch in indices:
+                yield self.reader.read_batch(self.sample(batch))
+            return
+
+        # Processes read with the reader they built when started
+        read = read_batch if self.backend == 'process' else self.reader.read_batch
+        pending = collections.deque()
+        for batch in indices:
+            pending.append(self.pool.apply_async(read, (self.sample(batch),)))
+            if len(pending) > self.prefetch:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,101 @@
+import os
+import time
+import zlib
+import sqlite3
+
+MANIFEST = 'manifest.sqlite'
+
+FILES = ['global', 'spatial', 'actions']
+
+
+def file_checksum(path):
+    """Size and CRC32 of a file"""
+    crc = 0
+    size = 0
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            crc = zlib.crc32(block, crc)
+            size += len(block)
+
+    return size, crc
+
+
+class Manifest:
+    """
+    Per-replay record of what process_replay wrote, kept in a SQLite index next to the outputs
+
+    Every worker appends its own records, SQLite serialises the writes. finalise, resume detection and postprocess
+    read it instead of stat-ing and decompressing the outputs. A manifest written from several hosts (shared) uses the
+    rollback journal, as WAL only works between processes of one host
+    """
+    def __init__(self, output_path, shared=False):
+        self.path = os.path.join(output_path, MANIFEST)
+        self.conn = sqlite3.connect(self.path, timeout=60)
+        self.conn.execute('PRAGMA journal_mode=DELETE' if shared else 'PRAGMA journal_mode=WAL')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS replays (
+            name TEXT PRIMARY KEY,
+            replay_id TEXT,
+            player_id INTEGER,
+            n_steps INTEGER,
+            first_loop INTEGER,
+            second_loop INTEGER,
+            last_loop INTEGER,
+            player_result INTEGER,
+            spatial_format TEXT,
+            global_format TEXT,
+            global_bytes INTEGER, global_crc INTEGER,
+            spatial_bytes INTEGER, spatial_crc INTEGER,
+            actions_bytes INTEGER, actions_crc INTEGER,
+            created REAL)''')
+        # Manifests from before the global format was recorded only hold sparse global states
+        if 'global_format' not in [column[1] for column in self.conn.execute('PRAGMA table_info(replays)')]:
+            self.conn.execute("ALTER TABLE replays ADD COLUMN global_format TEXT DEFAULT 'sparse'")
+        self.conn.commit()
+
+    @staticmethod
+    def exists(output_path):
+        return os.path.isfile(os.path.join(output_path, MANIFEST))
+
+    def record(self, replay_id, player_id, game_loops, player_result, spatial_format, global_format, paths):
+        """Record a replay once its outputs (paths, keyed by FILES) are on disk"""
+        files = {}
+        for kind in FILES:
+            files[f'{kind}_bytes'], files[f'{kind}_crc'] = file_checksum(paths[kind])
+
+        # Columns named, global_format comes last in manifests it was added to
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO replays (name, replay_id, player_id, n_steps, first_loop, '
+                              'second_loop, last_loop, player_result, spatial_format, global_format, global_bytes, '
+                              'global_crc, spatial_bytes, spatial_crc, actions_bytes, actions_crc, created) VALUES '
+                              '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', (
+                f'{player_id}@{replay_id}', replay_id, player_id, len(game_loops),
+                game_loops[0], game_loops[1] if len(game_loops) > 1 else None, game_loops[-1],
+                player_result, spatial_format, global_format,
+                files['global_bytes'], files['global_crc'],
+                files['spatial_bytes'], files['spatial_crc'],
+                files['actions_bytes'], files['actions_crc'],
+                time.time()))
+
+    def get(self, name):
+        """Record of a replay as a dict, None if it hasn't been parsed"""
+        cursor = self.conn.execute('SELECT * FROM replays WHERE name = ?', (name,))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+
+        return dict(zip([column[0] for column in cursor.description], row))
+
+    def names(self, spatial_format=None, global_format=None):
+        """Names of every recorded replay, optionally only those with a given spatial and/or global format"""
+        formats = {'spatial_format': spatial_format, 'global_format': global_format}
+        formats = {column: value for column, value in formats.items() if value is not None}
+        where = ' WHERE ' + ' AND '.join(f'{column} = ?' for column in formats) if formats else ''
+
+        return {name for name, in self.conn.execute('SELECT name FROM replays' + where, tuple(formats.values()))}
+
+    def steps(self):
+        """# of steps of every recorded replay"""
+        return dict(self.conn.execute('SELECT name, n_steps FROM replays'))
+
+    def close(self):
+        self.conn.close()
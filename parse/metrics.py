@@ -0,0 +1,120 @@
+import os
+import json
+import time
+import queue as Queue
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+
+class Metrics:
+    """
+    Stage timers and counters of one process
+
+    time(stage) adds to the # of calls and seconds spent in a stage, count(counter) to a counter. push() ships what
+    was gathered since the last push to a MetricsAggregator in the parent through queue, and starts over
+    """
+    def __init__(self, name, queue=None):
+        self.name = name
+        self.queue = queue
+        self.reset()
+
+    def reset(self):
+        self.stages = defaultdict(lambda: [0, 0.0])
+        self.counters = Counter()
+
+    @contextmanager
+    def time(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            entry = self.stages[stage]
+            entry[0] += 1
+            entry[1] += time.perf_counter() - start
+
+    def count(self, counter, n=1):
+        self.counters[counter] += n
+
+    def push(self):
+        if self.queue is not None:
+            self.queue.put((self.name, dict(self.stages), dict(self.counters)))
+        self.reset()
+
+
+class MetricsAggregator:
+    """
+    Sums what every process pushed and writes it to metrics.json and, in the Prometheus text format, metrics.prom
+
+    Both files are rewritten atomically, so they can be read or scraped (e.g. by node_exporter's textfile collector)
+    while parsing runs
+    """
+    def __init__(self, output_path, queue):
+        self.output_path = output_path
+        self.queue = queue
+        self.processes = {}
+        self.started = time.time()
+
+    def collect(self):
+        while True:
+            try:
+                name, stages, counters = self.queue.get_nowait()
+            except Queue.Empty:
+                return
+
+            process = self.processes.setdefault(name, {'stages': {}, 'counters': Counter()})
+            for stage, (calls, seconds) in stages.items():
+                total = process['stages'].setdefault(stage, [0, 0.0])
+                total[0] += calls
+                total[1] += seconds
+            process['counters'].update(counters)
+
+    def totals(self):
+        stages = {}
+        counters = Counter()
+        for process in self.processes.values():
+            for stage, (calls, seconds) in process['stages'].items():
+                total = stages.setdefault(stage, [0, 0.0])
+                total[0] += calls
+                total[1] += seconds
+            counters.update(process['counters'])
+
+        return stages, counters
+
+    def write(self):
+        self.collect()
+        stages, counters = self.totals()
+
+        def as_json(stages, counters):
+            return {
+                'stages': {stage: {'calls': calls, 'seconds': seconds, 'ms_per_call': 1000 * seconds / max(calls, 1)}
+                           for stage, (calls, seconds) in sorted(stages.items())},
+                'counters': dict(sorted(counters.items()))
+            }
+
+        metrics = {
+            'elapsed': time.time() - self.started,
+            'total': as_json(stages, counters),
+            'processes': {name: as_json(process['stages'], process['counters'])
+                          for name, process in sorted(self.processes.items())}
+        }
+
+        lines = ['# HELP mscs_stage_seconds_total Seconds spent in a parse stage',
+                 '# TYPE mscs_stage_seconds_total counter']
+        lines += [f'mscs_stage_seconds_total{{process="{name}",stage="{stage}"}} {seconds}'
+                  for name, process in sorted(self.processes.items())
+                  for stage, (_, seconds) in sorted(process['stages'].items())]
+        lines += ['# HELP mscs_stage_calls_total Calls of a parse stage',
+                  '# TYPE mscs_stage_calls_total counter']
+        lines += [f'mscs_stage_calls_total{{process="{name}",stage="{stage}"}} {calls}'
+                  for name, process in sorted(self.processes.items())
+                  for stage, (calls, _) in sorted(process['stages'].items())]
+        for counter in sorted(counters):
+            lines += [f'# TYPE mscs_{counter}_total counter']
+            lines += [f'mscs_{counter}_total{{process="{name}"}} {process["counters"][counter]}'
+                      for name, process in sorted(self.processes.items()) if counter in process['counters']]
+
+        for file_name, contents in [('metrics.json', json.dumps(metrics, indent=4)), ('metrics.prom', '\n'.join(lines) + '\n')]:
+            path = os.path.join(self.output_path, file_name)
+            with open(path + '.tmp', 'w') as f:
+                f.write(contents)
+            os.replace(path + '.tmp', path)
@@ -0,0 +1,112 @@
+import os
+import gzip
+
+import stream
+from s2clientprotocol import sc2api_pb2 as sc_pb
+
+
+class ObservationRecorder:
+    """
+    Records what a game client answered while a replay was parsed, as a gzipped length-delimited protobuf stream
+
+    The stream starts with the ResponseReplayInfo, the RequestStartReplay (without replay and map data) and a
+    RequestStep with the step size, followed by every ResponseObservation. It's written to a temporary file and only
+    moved into place by close(), so a recording that exists is complete
+    """
+    def __init__(self, path, replay_info, start_replay, step_size, compresslevel=6):
+        self.path = path
+        self.file = gzip.open(path + '.tmp', 'wb', compresslevel=compresslevel)
+        self.stream = stream.open(fileobj=self.file, mode='wb')
+
+        start_replay = sc_pb.RequestStartReplay.FromString(start_replay.SerializeToString())
+        start_replay.ClearField('replay_data')
+        start_replay.ClearField('map_data')
+        self.stream.write(replay_info, start_replay, sc_pb.RequestStep(count=step_size))
+
+    def append(self, obs):
+        self.stream.write(obs)
+
+    def close(self):
+        self.stream.close()
+        self.file.close()
+        os.replace(self.path + '.tmp', self.path)
+
+    def abort(self):
+        self.stream.close()
+        self.file.close()
+        if os.path.exists(self.path + '.tmp'):
+            os.remove(self.path + '.tmp')
+
+
+def read_recording(path):
+    """
+    The ResponseReplayInfo, RequestStartReplay and step size of a recording, and an open stream of its serialised
+    observations to iterate over and close
+    """
+    responses = stream.open(path, 'rb')
+    try:
+        replay_info = sc_pb.ResponseReplayInfo.FromString(next(responses))
+        start_replay = sc_pb.RequestStartReplay.FromString(next(responses))
+        step_size = sc_pb.RequestStep.FromString(next(responses)).count
+    except:
+        responses.close()
+        raise
+
+    return replay_info, start_replay, step_size, responses
+
+
+class RecordedController:
+    """
+    Stand-in for a game client's controller, serving a recording made by ObservationRecorder
+
+    replay_info and start_replay answer with what was recorded whatever the replay data, and every step moves on to the
+    next recorded observation, which observe() parses from bytes as the real controller does. Stepping by anything but
+    the recorded step size is refused, as the observations wouldn't match. With in_memory the whole recording is read
+    up front, so disk and decompression times are left out of step()
+    """
+    def __init__(self, path, in_memory=False):
+        self.path = path
+        self.in_memory = in_memory
+        self.info, self.start_request, self.step_size, observations = read_recording(path)
+        with observations:
+            self.recorded = list(observations) if in_memory else None
+
+        self.observations = None
+        self.current = None
+
+    def replay_info(self, replay_data=None):
+        return self.info
+
+    def start_replay(self, req_start_replay):
+        if req_start_replay.observed_player_id != self.start_request.observed_player_id:
+            raise ValueError(f'{self.path} was recorded for player {self.start_request.observed_player_id}, '
+                             f'not {req_start_replay.observed_player_id}')
+
+        self.close()
+        if self.in_memory:
+            self.observations = iter(self.recorded)
+        else:
+            self.observations = read_recording(self.path)[3]
+        self.current = None
+
+    def step(self, count=1):
+        if self.step_size and count != self.step_size: # 0 for recordings stepped irregularly
+            raise ValueError(f'{self.path} was recorded with a step size of {self.step_size}, not {count}')
+
+        self.current = next(self.observations, None)
+        if self.current is None:
+            raise ValueError(f'{self.path} has no observations left')
+
+    def observe(self):
+        return sc_pb.ResponseObservation.FromString(self.current)
+
+    def ping(self):
+        return sc_pb.ResponsePing()
+
+    def close(self):
+        if self.observations is not None and not self.in_memory:
+            self.observations.close()
+        self.observations = None
+
+    def quit(self):
+        self.close()
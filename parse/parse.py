@@ -2,7 +2,9 @@ import os
 import sys
 import json
 import time
+import math
 import signal
+import cProfile
 import threading
 import traceback
 import queue as Queue
@@ -12,19 +14,26 @@ from absl import app
 from absl import flags
 from future.builtins import range
 
-import numpy as np
-from scipy import sparse
-
 from google.protobuf.json_format import MessageToJson
 
 from pysc2 import run_configs
 from pysc2.lib import point
 from s2clientprotocol import sc2api_pb2 as sc_pb
-from s2clientprotocol import common_pb2 as common_pb
 
 from extract_global import GlobalParser
-from extract_spatial import SpatialParser
-from extract_actions import extract_actions
+from extract_spatial import SpatialParser, compact_unit_ids, map_key
+from extract_actions import ActionExtractor
+from replay_writer import ReplayWriter, remove_partial
+from manifest import Manifest
+from controller_pool import ControllerSlot, pick_ports
+from scheduling import SCHEDULES, schedule
+from pipeline import step_observations, adaptive_observations, EventDetector, prefetch, replay_races, Stride, \
+    extract_observations
+from writer_pool import WriterQueue, start_writer, stop_writers
+from metrics import Metrics, MetricsAggregator
+from observation_stream import ObservationRecorder
+from watchdog import Watchdog
+from work_queue import LeaseQueue
 
 from tqdm import tqdm
 
@@ -42,11 +51,72 @@ flags.DEFINE_string(name='map', default = None,
 
 flags.DEFINE_integer(name='n_instance', default=1,
                      help='# of processes to run')
-flags.DEFINE_integer(name='batch_size', default=10,
-                     help='# of replays to process in one iter')
+flags.DEFINE_enum(name='schedule', default='library', enum_values=SCHEDULES,
+                  help='Order replays are queued in, library order or longest first. Longest first only shortens a '
+                       'run with few replays per instance or a heavy tail of long ones, see benchmark_schedule.py')
+flags.DEFINE_boolean(name='group_maps', default=False,
+                     help='Keep replays of the same map together in the queue, with schedule longest')
+flags.DEFINE_integer(name='batch_size', default=100,
+                     help='# of replays an instance parses before being restarted, 0 for no limit')
+flags.DEFINE_integer(name='max_instance_memory', default=0,
+                     help='Resident memory in MB above which an instance is restarted between replays, 0 for no limit')
+flags.DEFINE_integer(name='replay_timeout', default=300,
+                     help='Seconds a replay may take on top of timeout_per_loop per game loop before its worker and '
+                          'instance are killed and restarted, 0 for no limit')
+flags.DEFINE_float(name='timeout_per_loop', default=0.02,
+                   help='Seconds a replay may take per game loop of its duration, on top of replay_timeout')
+flags.DEFINE_integer(name='max_retries', default=2,
+                     help='# of times a replay that failed or timed out is queued again before it\'s left unparsed')
+flags.DEFINE_integer(name='retry_backoff', default=30,
+                     help='Seconds before a replay is retried, doubling with every attempt')
+flags.DEFINE_string(name='work_queue', default=None,
+                    help='SQLite database on storage shared by every host parsing the library, to share the replays '
+                         'between them instead of queueing them locally. Replays and output_path must be shared too')
+flags.DEFINE_integer(name='lease_seconds', default=300,
+                     help='Seconds a replay claimed from work_queue stays with its host without being renewed')
 
 flags.DEFINE_integer(name='step_size', default=72,
                      help='# of frames to step')
+flags.DEFINE_list(name='step_sizes', default=[],
+                  help='Step sizes to write outputs for in one pass over each replay, each under step_{size}/. The game is '
+                       'stepped by their greatest common divisor. step_size alone is used if empty')
+flags.DEFINE_boolean(name='adaptive_step', default=False,
+                     help='Step by min_step after macro actions, unit deaths or score changes and up to max_step '
+                          'otherwise, instead of by step_size. Observations are irregular, see their game loop')
+flags.DEFINE_integer(name='min_step', default=8,
+                     help='# of frames to step after an event in adaptive stepping')
+flags.DEFINE_integer(name='max_step', default=216,
+                     help='Most # of frames to step in adaptive stepping')
+flags.DEFINE_float(name='score_change', default=0.05,
+                   help='Relative change in score between observations counting as an event in adaptive stepping')
+flags.DEFINE_boolean(name='pipeline', default=False,
+                     help='Step the game in a separate thread while features are extracted. Only pays off with the C++ '
+                          'protobuf backend or a core to spare per worker, see benchmark_pipeline.py')
+flags.DEFINE_integer(name='pipeline_depth', default=4,
+                     help='# of observations the stepping thread may run ahead')
+flags.DEFINE_integer(name='n_writers', default=0,
+                     help='# of processes compressing and recording finished replays, 0 to do it in the workers')
+flags.DEFINE_integer(name='max_pending_writes', default=4,
+                     help='# of finished replays that may wait for a writer before workers block')
+flags.DEFINE_integer(name='metrics_interval', default=30,
+                     help='Seconds between rewrites of metrics.json/metrics.prom, 0 to not write them')
+flags.DEFINE_integer(name='profile_every', default=0,
+                     help='cProfile one in this many replays of each worker (main thread only) to profiles/, 0 for none')
+flags.DEFINE_boolean(name='record_observations', default=False,
+                     help='Also keep every replay\'s raw observations in observations/, for reextract.py to rebuild '
+                          'the outputs from without the game')
+flags.DEFINE_integer(name='chunk_size', default=32,
+                     help='# of steps buffered in memory before being flushed to disk')
+flags.DEFINE_enum(name='spatial_format', default='sparse', enum_values=['sparse', 'compact'],
+                  help='Spatial storage, sparse matrix (.spa.npz) or compact per-channel encoding (.spc.npz)')
+
+flags.DEFINE_enum(name='global_format', default='sparse', enum_values=['sparse', 'delta'],
+                  help='Global storage, sparse matrix (.glo.npz) or runs along time (.gld.npz)')
+flags.DEFINE_list(name='static_channels', default=None,
+                  help='Compact spatial channels kept once per map in maps/, with only the pixels changing stored per '
+                       'step. Detected as the channels unchanged over the first static_probe steps if not set')
+flags.DEFINE_integer(name='static_probe', default=8,
+                     help='# of steps static channels are detected over')
 
 flags.DEFINE_integer(name='width', default=24,
                      help='World width of rendered area in screen')
@@ -54,6 +124,10 @@ flags.DEFINE_integer(name='map_size', default=64,
                      help='Spatial observation size in pixels')
 
 FLAGS(sys.argv)
+if FLAGS.adaptive_step and FLAGS.step_sizes:
+    sys.exit('adaptive_step writes irregular observations, it can\'t be combined with step_sizes')
+if FLAGS.group_maps and FLAGS.schedule != 'longest':
+    sys.exit('group_maps groups maps within duration bands, it needs schedule longest')
 size = point.Point(FLAGS.map_size, FLAGS.map_size)
 interface = sc_pb.InterfaceOptions(raw=True, score=True,
                 feature_layer=sc_pb.SpatialCameraSetup(width=FLAGS.width, allow_cheating_layers=True),)
@@ -61,113 +135,239 @@ size.assign_to(interface.feature_layer.resolution)
 size.assign_to(interface.feature_layer.minimap_resolution)
 
 
+def step_paths():
+    """Output path of every step size parsed"""
+    if FLAGS.adaptive_step:
+        return {0: FLAGS.output_path}
+    if not FLAGS.step_sizes:
+        return {FLAGS.step_size: FLAGS.output_path}
+
+    return {int(step_size): os.path.join(FLAGS.output_path, f'step_{int(step_size)}') for step_size in FLAGS.step_sizes}
+
+
 class ReplayProcessor(multiprocessing.Process):
-    """A Process that pulls replays and processes them."""
-    def __init__(self, run_config, replay_queue):
+    """
+    A Process that processes the replays the Watchdog sends to its inbox.
+
+    Every replay finished is reported on status_queue, for the Watchdog to account for it
+    """
+    def __init__(self, run_config, status_queue, port, writer_queue=None, metrics_queue=None, worker_id=0):
         super(ReplayProcessor, self).__init__()
         self.run_config = run_config
-        self.replay_queue = replay_queue
+        self.inbox = multiprocessing.SimpleQueue() # One per process, a worker killed reading it leaves its lock held
+        self.status_queue = status_queue
+        self.port = port
+        self.writer_queue = writer_queue
+        self.metrics_queue = metrics_queue
+        self.worker_id = worker_id
 
     def run(self):
         signal.signal(signal.SIGTERM, lambda a, b: sys.exit())  # Kill thread upon termination signal
-        while True:
-            with self.run_config.start() as controller:
-                for _ in range(FLAGS.batch_size):
-                    try:
-                        replay = self.replay_queue.get()
-                    except Queue.Empty:
-                        return
-                    try:
-                        if not os.path.isfile(replay['replay_path']): # Unable to find replay
-                            print('Unable to locate', replay['replay_path'])
-                            return
-
-                        replay_data = self.run_config.replay_data(replay['replay_path'])
-
-                        self.process_replay(controller, replay_data, replay['replay_id'], replay['player_id'])
-
-                    except Exception:
-                        traceback.print_exc()
-
-                    finally:
-                        self.replay_queue.task_done()
-
-    def process_replay(self, controller, replay_data, replay_id, player_id):
-
-        replay_info = controller.replay_info(replay_data)
+        os.setpgid(0, 0) # Own process group, with the instance it launches, so the watchdog can kill both if hung
+        self.action_extractor = ActionExtractor() # Built once per worker
+        self.manifests = {path: Manifest(path, FLAGS.work_queue is not None) for path in step_paths().values()}
+        self.metrics = Metrics(f'worker-{self.worker_id}', self.metrics_queue)
+        n_replays = 0
+
+        # One instance per worker, kept across replays and only restarted after a crash or once over budget
+        slot = ControllerSlot(self.run_config, self.port, FLAGS.batch_size, FLAGS.max_instance_memory)
+        try:
+            while True:
+                job, replay = self.inbox.get()
+                self.n_writes = 0 # Outputs handed to writer processes
+
+                try:
+                    if not os.path.isfile(replay['replay_path']): # Unable to find replay
+                        print('Unable to locate', replay['replay_path'])
+                        self.metrics.count('failed_replays')
+                        failed = True
+                    else:
+                        with self.metrics.time('load'):
+                            replay_data = self.run_config.replay_data(replay['replay_path'])
+
+                        profiler = None
+                        if FLAGS.profile_every > 0 and n_replays % FLAGS.profile_every == 0:
+                            profiler = cProfile.Profile()
+                            profiler.enable()
+                        n_replays += 1
+
+                        try:
+                            self.process_replay(slot.controller(), replay_data, replay['replay_id'], replay['player_id'],
+                                                job)
+                        finally:
+                            if profiler is not None:
+                                profiler.disable()
+                                profiler.dump_stats(os.path.join(FLAGS.output_path, 'profiles',
+                                    f"{self.metrics.name}_{replay['player_id']}@{replay['replay_id']}.prof"))
+
+                        self.metrics.count('replays')
+                        failed = False
+
+                except Exception:
+                    traceback.print_exc() # A bad replay only costs itself, the next controller() call health checks
+                    self.metrics.count('failed_replays')
+                    failed = True
+
+                # Not in a finally, a worker being killed mid replay is reported by the watchdog
+                self.status_queue.put(('done', self.worker_id, job, failed, self.n_writes))
+                slot.release()
+                self.metrics.push()
+        finally:
+            slot.close()
+
+    def process_replay(self, controller, replay_data, replay_id, player_id, job=None):
+        metrics = self.metrics
+
+        with metrics.time('replay_info'):
+            replay_info = controller.replay_info(replay_data)
         map_data = None
         if replay_info.local_map_path: # Special handling for custom maps
             map_data = self.run_config.map_data(replay_info.local_map_path)
-        
-        for p in replay_info.player_info:
-            if p.player_info.player_id == player_id:
-                player_race = common_pb.Race.Name(p.player_info.race_actual)
-            else:
-                enemy_race = common_pb.Race.Name(p.player_info.race_actual)
 
-        global_parser = GlobalParser(player_race, enemy_race)
-        spatial_parser = SpatialParser()
+        player_race, enemy_race = replay_races(replay_info, player_id)
 
-        spatial_states_np, global_states_np = [], []
-        actions = {}      
+        spatial_parser = SpatialParser()
+        self.action_extractor.counts.clear()
 
-        controller.start_replay(sc_pb.RequestStartReplay(
+        start_replay = sc_pb.RequestStartReplay(
             replay_data=replay_data,
             map_data=map_data,
             options=interface,
-            observed_player_id=player_id))
-        
-        n_states = 0
+            observed_player_id=player_id)
+        with metrics.time('start_replay'):
+            controller.start_replay(start_replay)
 
         print('Parsing', replay_id)
 
-        while True:
-            controller.step(FLAGS.step_size)
-            obs = controller.observe()
-
-            actions[n_states] = extract_actions(obs)
-            spatial_states_np.append(spatial_parser.extract(obs.observation))
-            global_states_np.append(global_parser.extract(obs.observation))
-
-            n_states += 1
-
-            if obs.player_result: # Player result obtained means game has ended
-                break
-        
-        spatial_states_np = np.asarray(spatial_states_np)
-        global_states_np = np.asarray(global_states_np)
-
-        spatial_states_np = spatial_states_np.reshape((n_states, -1))
-
-        sparse.save_npz(os.path.join(FLAGS.output_path, 'global',
-                                    f'{player_id}@{replay_id}.glo'), sparse.csc_matrix(global_states_np)) # Global tensor
-
-        sparse.save_npz(os.path.join(FLAGS.output_path, 'spatial',
-                                    f'{player_id}@{replay_id}.spa'), sparse.csc_matrix(spatial_states_np)) # Spatial tensor
-
-        with open(os.path.join(FLAGS.output_path, 'actions', f'{player_id}@{replay_id}.act'), 'w') as f:
-            f.write(json.dumps(actions, indent=4))
+        # One set of outputs per step size, each with its own GlobalParser as enemy kill tracking is stateful
+        strides = []
+        for step_size, output_path in step_paths().items():
+            if FLAGS.spatial_format == 'compact':
+                writer = ReplayWriter(output_path, f'{player_id}@{replay_id}', FLAGS.chunk_size,
+                                      spatial_parser.get_encoding(), compact_unit_ids(player_race, enemy_race),
+                                      FLAGS.static_channels, map_key(replay_info, FLAGS.map_size),
+                                      FLAGS.global_format, FLAGS.static_probe)
+            else:
+                writer = ReplayWriter(output_path, f'{player_id}@{replay_id}', FLAGS.chunk_size,
+                                      global_format=FLAGS.global_format)
+            strides.append(Stride(step_size, GlobalParser(player_race, enemy_race), writer))
+
+        if FLAGS.adaptive_step:
+            # A Stride of 0 takes every observation, which are recorded with a step size of 0 for irregular
+            base_step = 0
+            observations = adaptive_observations(controller, FLAGS.min_step, FLAGS.max_step,
+                                                 EventDetector(self.action_extractor, FLAGS.score_change), metrics)
+        else:
+            base_step = math.gcd(*[stride.stride for stride in strides])
+            observations = step_observations(controller, base_step, metrics)
+        if FLAGS.pipeline:
+            observations = prefetch(observations, FLAGS.pipeline_depth)
+
+        recorder = None
+        if FLAGS.record_observations:
+            recorder = ObservationRecorder(os.path.join(FLAGS.output_path, 'observations', f'{player_id}@{replay_id}.obs.gz'),
+                                           replay_info, start_replay, base_step)
+
+        try:
+            extract_observations(observations, base_step, strides, spatial_parser, self.action_extractor, metrics,
+                                 recorder)
+            for stride in strides:
+                stride.writer.finish()
+            if recorder is not None:
+                recorder.close()
+        except:
+            for stride in strides:
+                stride.writer.abort()
+            if recorder is not None:
+                recorder.abort()
+            raise
+        finally:
+            observations.close() # Stops the stepping thread if extraction failed
+
+        for stride in strides:
+            writer = stride.writer
+            player_result = next((r.result for r in stride.last_obs.player_result if r.player_id == player_id), None)
+            record = dict(replay_id=replay_id, player_id=player_id, game_loops=stride.game_loops,
+                          player_result=player_result, spatial_format=FLAGS.spatial_format,
+                          global_format=FLAGS.global_format)
+
+            if self.writer_queue is not None:
+                with metrics.time('handoff'):
+                    self.writer_queue.put(writer, record, job) # Sealed and recorded by a writer process, blocks if they're behind
+                self.n_writes += 1
+            else:
+                try:
+                    with metrics.time('save'):
+                        paths = writer.seal()
+                except:
+                    writer.abort()
+                    raise
+                with metrics.time('record'):
+                    self.manifests[writer.output_path].record(paths=paths, **record)
+                metrics.count('bytes_written', sum(os.path.getsize(path) for path in paths.values()))
+
+        unknown_units = strides[0].global_parser.unknown_units
+        if unknown_units:
+            print('Unknown units (neural parasite?) in', replay_id, dict(unknown_units))
+
+        if self.action_extractor.counts['failed'] or self.action_extractor.counts['unknown']:
+            print('Unclassified actions in', replay_id, dict(self.action_extractor.counts))
 
 class ReplayQueue:
     """
     Replay queue
 
     Unable to inherit directly from multiprocessing.JoinableQueue as it's intended to be used as a method within context
+
+    claim(), task_done(), retry() and renew() are only called by the Watchdog, in the parent
     """
-    def __init__(self, queued_replays):
+    def __init__(self, queued_replays, max_retries=2, backoff=30):
         self.queue = multiprocessing.JoinableQueue(queued_replays)
         self.replays_processed = multiprocessing.Value('i', 0)
+        self.loops_processed = multiprocessing.Value('q', 0)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.attempts = {}
 
-    def task_done(self):
+    def task_done(self, replay):
         with self.replays_processed.get_lock():
             self.replays_processed.value += 1
+            self.loops_processed.value += replay['duration_frames']
         self.queue.task_done()
+
+    def retry(self, replay):
+        """Queue a replay that didn't go through again after backoff * 2**attempt seconds, or count it as processed after
+        max_retries attempts. Returns whether it's retried"""
+        key = (replay['replay_id'], replay['player_id'])
+        self.attempts[key] = self.attempts.get(key, 0) + 1
+        if self.attempts[key] > self.max_retries:
+            self.task_done(replay)
+            return False
+
+        self.queue.task_done()
+        timer = threading.Timer(self.backoff * 2**(self.attempts[key] - 1), self.queue.put, (replay,))
+        timer.daemon = True
+        timer.start()
+        return True
+
+    def renew(self, replays):
+        """Nothing to renew, replays are only leased by LeaseQueue"""
+        pass
+
+    def progress(self):
+        """# of replays and game loops processed"""
+        with self.replays_processed.get_lock():
+            return self.replays_processed.value, self.loops_processed.value
     
     def put(self, replay):
         self.queue.put(replay)
 
-    def get(self):
-        return self.queue.get()
+    def claim(self):
+        """The next replay queued, None if there isn't one right now"""
+        try:
+            return self.queue.get_nowait()
+        except Queue.Empty:
+            return None
 
     def join(self):
         self.queue.join()
@@ -183,10 +383,15 @@ def parse(argv):
 
     FLAGS.output_path = os.path.join(FLAGS.output_path, f"{FLAGS.player_race}_vs_{FLAGS.enemy_race}")
 
-    for out_folder in ['actions', 'global', 'spatial']:
-        path = os.path.join(FLAGS.output_path, out_folder)
+    out_paths = [os.path.join(output_path, out_folder) for output_path in step_paths().values()
+                 for out_folder in ['actions', 'global', 'spatial']]
+    out_paths += [os.path.join(FLAGS.output_path, out_folder) for out_folder in ['profiles', 'observations']]
+    for path in out_paths:
         if not os.path.isdir(path):
             os.makedirs(path)
+    if FLAGS.work_queue is None: # Other hosts may be writing otherwise
+        for output_path in step_paths().values():
+            remove_partial(output_path) # Left by workers killed in an earlier run
 
     run_config = run_configs.get()
     try:
@@ -200,49 +405,106 @@ def parse(argv):
             replay_library = [replay for replay in replay_library if replay['map'] in maps]
 
         replay_list = []
+        spatial_ext = 'spc' if FLAGS.spatial_format == 'compact' else 'spa'
+        global_ext = 'gld' if FLAGS.global_format == 'delta' else 'glo'
+
+        parsed = {}
+        for output_path in step_paths().values():
+            manifest = Manifest(output_path, FLAGS.work_queue is not None)
+            parsed[output_path] = manifest.names(FLAGS.spatial_format, FLAGS.global_format)
+            manifest.close()
+
+        def is_parsed(output_path, name):
+            # Outputs from before the manifest existed count too
+            return name in parsed[output_path] or \
+                (os.path.isfile(os.path.join(output_path, 'global', f"{name}.{global_ext}.npz")) and
+                 os.path.isfile(os.path.join(output_path, 'spatial', f"{name}.{spatial_ext}.npz")) and
+                 os.path.isfile(os.path.join(output_path, 'actions', f"{name}.act")))
         
         for replay in replay_library:
             for player in replay['players']:
                 if player['race'] == FLAGS.player_race:
                     replay_id = os.path.basename(replay['path']).replace('.SC2Replay','')
 
-                    if not os.path.isfile(os.path.join(FLAGS.output_path, 'global', f"{player['id']}@{replay_id}.glo.npz")) or \
-                        not os.path.isfile(os.path.join(FLAGS.output_path, 'spatial', f"{player['id']}@{replay_id}.spa.npz")) or \
-                        not os.path.isfile(os.path.join(FLAGS.output_path, 'actions', f"{player['id']}@{replay_id}.act")):
+                    # Parsed again for every step size if one is missing
+                    if not all(is_parsed(output_path, f"{player['id']}@{replay_id}") for output_path in parsed):
 
                         replay_list.append({
                             'replay_path': replay['path'],
                             'replay_id': replay_id,
-                            'player_id': player['id']
+                            'player_id': player['id'],
+                            'map': replay['map'],
+                            'duration_frames': replay['duration_frames']
                         })
 
-        replay_queue = ReplayQueue(FLAGS.n_instance * 10)
-        replay_queue_thread = threading.Thread(target=replay_queue_filler,
-                                           args=(replay_queue, replay_list))
-        replay_queue_thread.daemon = True
-        replay_queue_thread.start()
+        replay_list = schedule(replay_list, FLAGS.schedule, FLAGS.group_maps)
+
+        if FLAGS.work_queue is None:
+            replay_queue = ReplayQueue(FLAGS.n_instance * 10, FLAGS.max_retries, FLAGS.retry_backoff)
+            replay_queue_thread = threading.Thread(target=replay_queue_filler,
+                                               args=(replay_queue, replay_list))
+            replay_queue_thread.daemon = True
+            replay_queue_thread.start()
+            n_replays, total_loops = len(replay_list), sum(replay['duration_frames'] for replay in replay_list)
+        else:
+            # Every host adds what it finds unparsed, and progress is that of every host
+            replay_queue = LeaseQueue(FLAGS.work_queue, FLAGS.lease_seconds, FLAGS.max_retries, FLAGS.retry_backoff)
+            replay_queue.add(replay_list)
+            n_replays, total_loops = replay_queue.totals()
+
+        metrics_queue = multiprocessing.Queue()
+        aggregator = MetricsAggregator(FLAGS.output_path, metrics_queue)
+
+        status_queue = multiprocessing.SimpleQueue() # From workers and writers, for the watchdog
+
+        writer_queue = WriterQueue(FLAGS.max_pending_writes) if FLAGS.n_writers > 0 else None
 
-        for i in range(FLAGS.n_instance):
-            p = ReplayProcessor(run_config, replay_queue)
+        def restart_writer(writer_id):
+            return start_writer(writer_id, status_queue, metrics_queue, FLAGS.work_queue is not None)
+
+        def start_worker(worker_id, port=None):
+            p = ReplayProcessor(run_config, status_queue, port or pick_ports(1)[0], writer_queue, metrics_queue,
+                                worker_id)
             p.daemon = True
-            print('Starting thread', i)
+            print('Starting thread', worker_id)
             p.start()
-            time.sleep(1)   # Stagger startups, otherwise they seem to conflict somehow
+            return p
+
+        # Every instance gets its own port up front, so they can all launch at once
+        workers = {i: start_worker(i, port) for i, port in enumerate(pick_ports(FLAGS.n_instance))}
+        writers = {i: restart_writer(i) for i in range(FLAGS.n_writers)}
+        watchdog = Watchdog(workers, start_worker, replay_queue, status_queue, FLAGS.replay_timeout,
+                            FLAGS.timeout_per_loop, metrics_queue=metrics_queue, writers=writers,
+                            restart_writer=restart_writer, writer_queue=writer_queue)
 
-        n_replays = len(replay_list)
-        n_processed = 0
+        n_processed, n_loops = replay_queue.progress()
 
-        pbar = tqdm(total = n_replays, desc='Replays processed')
+        # Progress in game loops, which tracks remaining work far better than a replay count
+        pbar = tqdm(total = total_loops, initial = n_loops, desc='Game loops processed', unit='loop', unit_scale=True)
+        last_write = time.time()
         while n_processed < n_replays:
             time.sleep(1)
-            prev_processed = n_processed
-            with replay_queue.replays_processed.get_lock():
-                n_processed = replay_queue.replays_processed.value
+            watchdog.poll()
+            aggregator.collect()
+            if FLAGS.metrics_interval > 0 and time.time() - last_write >= FLAGS.metrics_interval:
+                aggregator.write()
+                last_write = time.time()
+
+            prev_loops = n_loops
+            n_processed, n_loops = replay_queue.progress()
+            if FLAGS.work_queue is not None: # Hosts started later add their replays
+                n_replays, pbar.total = replay_queue.totals()
 
-            pbar.update(n_processed - prev_processed)
+            pbar.set_postfix(replays=f'{n_processed}/{n_replays}')
+            pbar.update(n_loops - prev_loops)
 
         replay_queue.join() # Wait for the queue to empty.
 
+        stop_writers(watchdog.writers.values()) # Every replay counted as processed is written already
+
+        if FLAGS.metrics_interval > 0:
+            aggregator.write()
+
     except KeyboardInterrupt:
         print("Caught KeyboardInterrupt, exiting.")
 
@@ -0,0 +1,191 @@
+import queue
+import threading
+
+from metrics import Metrics
+
+from s2clientprotocol import common_pb2 as common_pb
+
+
+def step_observations(controller, step_size, metrics=None):
+    """
+    Step through a started replay, yielding every ResponseObservation up to and including the one ending the game
+
+    Time spent in step and observe is added to metrics if given
+    """
+    metrics = metrics or Metrics('local')
+    while True:
+        with metrics.time('step'):
+            controller.step(step_size)
+        with metrics.time('observe'):
+            obs = controller.observe()
+        yield obs
+
+        if obs.player_result: # Player result obtained means game has ended
+            return
+
+
+def adaptive_observations(controller, min_step, max_step, is_event, metrics=None):
+    """
+    Step through a started replay like step_observations, by a stride adapted to what happens in the game
+
+    The stride drops to min_step after an observation is_event flags, and otherwise doubles up to max_step, so quiet
+    stretches are sampled coarsely and the ones following an event finely
+    """
+    metrics = metrics or Metrics('local')
+    step_size = max_step
+    while True:
+        with metrics.time('step'):
+            controller.step(step_size)
+        with metrics.time('observe'):
+            obs = controller.observe()
+        yield obs
+
+        if obs.player_result: # Player result obtained means game has ended
+            return
+
+        step_size = min_step if is_event(obs) else min(step_size * 2, max_step)
+
+
+class EventDetector:
+    """
+    Flags observations with a macro action, a unit death or a relative change in score above score_change
+
+    Only reads the observations, so it can run in the stepping thread of a pipeline
+    """
+    def __init__(self, action_extractor, score_change):
+        self.action_extractor = action_extractor
+        self.score_change = score_change
+        self.score = None
+
+    def __call__(self, obs):
+        score, self.score = self.score, obs.observation.score.score
+        if score is not None and abs(self.score - score) > self.score_change * max(score, 1):
+            return True
+
+        if len(obs.observation.raw_data.event.dead_units) > 0:
+            return True
+
+        return any(self.action_extractor.is_macro(action) for action in obs.actions)
+
+
+def prefetch(iterable, depth):
+    """
+    Iterate over iterable in a producer thread, at most depth items ahead of the consumer
+
+    The game client runs out of process and its controller calls block on a socket without holding the GIL, so
+    stepping the next observations overlaps with extracting features from the current one. Exceptions in the producer
+    are raised in the consumer, and a consumer that stops early stops the producer
+    """
+    items = queue.Queue(depth)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+            put((done, None))
+        except BaseException as e:
+            put((done, e))
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+
+    try:
+        while True:
+            item, error = items.get()
+            if item is done:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+        producer.join()
+
+
+def replay_races(replay_info, player_id):
+    """Races of the observed player and their enemy in a ResponseReplayInfo"""
+    for p in replay_info.player_info:
+        if p.player_info.player_id == player_id:
+            player_race = common_pb.Race.Name(p.player_info.race_actual)
+        else:
+            enemy_race = common_pb.Race.Name(p.player_info.race_actual)
+
+    return player_race, enemy_race
+
+
+class Stride:
+    """
+    Outputs sampled every stride game loops, out of observations stepped by a divisor of stride
+
+    The client reports actions and dead units since the previous observation, so those of the observations skipped in
+    between are carried over to the next one sampled: the outputs are the same as if the game had been stepped by stride.
+    A stride of 0 samples every observation, for observations stepped irregularly
+    """
+    def __init__(self, stride, global_parser, writer):
+        self.stride = stride
+        self.global_parser = global_parser
+        self.writer = writer
+        self.game_loops = []
+        self.last_obs = None
+        self.actions = []
+        self.dead_units = []
+
+
+def extract_observations(observations, step_size, strides, spatial_parser, action_extractor, metrics=None,
+                         recorder=None):
+    """
+    Extract the features of observations stepped by step_size into every Stride they're sampled by
+
+    The last observation, which holds the player results, goes to every Stride. The observations are recorded too if a
+    recorder is given
+    """
+    metrics = metrics or Metrics('local')
+    for i, obs in enumerate(observations, 1):
+        metrics.count('steps')
+        metrics.count('units', len(obs.observation.raw_data.units))
+
+        if recorder is not None:
+            with metrics.time('record_observation'):
+                recorder.append(obs)
+
+        with metrics.time('extract_actions'):
+            actions = action_extractor.extract(obs)
+        dead_units = obs.observation.raw_data.event.dead_units
+
+        sampled = []
+        for stride in strides:
+            if stride.stride == 0 or (i * step_size) % stride.stride == 0 or obs.player_result:
+                sampled.append(stride)
+            else:
+                stride.actions += actions
+                stride.dead_units.extend(dead_units)
+
+        if not sampled:
+            continue
+
+        with metrics.time('extract_spatial'):
+            spatial_state = spatial_parser.extract(obs.observation)
+
+        for stride in sampled:
+            stride.game_loops.append(obs.observation.game_loop)
+            stride.last_obs = obs
+
+            with metrics.time('extract_global'):
+                global_state = stride.global_parser.extract(obs.observation,
+                                                            stride.dead_units + list(dead_units) if stride.dead_units else None)
+            with metrics.time('assemble'):
+                stride.writer.append(spatial_state, global_state, stride.actions + actions)
+
+            stride.actions, stride.dead_units = [], []
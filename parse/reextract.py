@@ -0,0 +1,142 @@
+from extract_global import GlobalParser
+from extract_spatial import SpatialParser, compact_unit_ids, map_key
+from extract_actions import ActionExtractor
+from replay_writer import ReplayWriter
+from manifest import Manifest
+from observation_stream import RecordedController
+from pipeline import step_observations, replay_races, Stride, extract_observations
+
+import os
+import sys
+import glob
+import signal
+import traceback
+import multiprocessing
+from absl import app
+from absl import flags
+
+from tqdm import tqdm
+
+from s2clientprotocol import sc2api_pb2 as sc_pb
+
+FLAGS = flags.FLAGS
+flags.DEFINE_string(name='output_path', default='../parsed_replays',
+                    help='Path to the parsed replays, with the observations recorded by parse.py --record_observations')
+flags.DEFINE_string(name='player_race', default='Protoss',
+                    help='Player race')
+flags.DEFINE_string(name='enemy_race', default='Terran',
+                    help='Enemy race')
+flags.DEFINE_integer(name='n_workers', default=multiprocessing.cpu_count(),
+                     help='# of processes extracting features')
+flags.DEFINE_list(name='step_sizes', default=[],
+                  help='Step sizes to write outputs for, each under step_{size}/ and a multiple of the recorded step '
+                       'size. The recorded step size alone is used if empty')
+flags.DEFINE_integer(name='chunk_size', default=32,
+                     help='# of steps buffered in memory before being flushed to disk')
+flags.DEFINE_enum(name='spatial_format', default='sparse', enum_values=['sparse', 'compact'],
+                  help='Spatial output format: sparse matrices or the compact per-layer encoding')
+flags.DEFINE_enum(name='global_format', default='sparse', enum_values=['sparse', 'delta'],
+                  help='Global storage, sparse matrix (.glo.npz) or runs along time (.gld.npz)')
+flags.DEFINE_list(name='static_channels', default=None,
+                  help='Compact spatial channels kept once per map in maps/, with only the pixels changing stored per '
+                       'step. Detected as the channels unchanged over the first static_probe steps if not set')
+flags.DEFINE_integer(name='static_probe', default=8,
+                     help='# of steps static channels are detected over')
+
+worker = {}
+
+
+def step_paths(recorded_step):
+    """Output path of every step size re-extracted"""
+    if not FLAGS.step_sizes:
+        return {recorded_step: FLAGS.output_path}
+
+    return {int(step_size): os.path.join(FLAGS.output_path, f'step_{int(step_size)}') for step_size in FLAGS.step_sizes}
+
+
+def init_worker():
+    signal.signal(signal.SIGTERM, lambda a, b: sys.exit())
+    worker['manifests'] = {}
+    worker['action_extractor'] = ActionExtractor()
+
+
+def reextract(path):
+    """Rebuild a replay's outputs from its recorded observations, returning its name and error if any"""
+    name = os.path.basename(path).replace('.obs.gz', '')
+    replay_id = name.split('@', 1)[1]
+    strides = []
+    try:
+        controller = RecordedController(path)
+        player_id = controller.start_request.observed_player_id
+        player_race, enemy_race = replay_races(controller.replay_info(), player_id)
+
+        spatial_parser = SpatialParser()
+        minimap_size = controller.start_request.options.feature_layer.minimap_resolution.x
+        action_extractor = worker['action_extractor']
+        action_extractor.counts.clear()
+
+        for step_size, output_path in step_paths(controller.step_size).items():
+            if step_size != controller.step_size and (controller.step_size == 0 or step_size % controller.step_size != 0):
+                raise ValueError(f'Step size {step_size} is not a multiple of the recorded {controller.step_size}')
+
+            if FLAGS.spatial_format == 'compact':
+                writer = ReplayWriter(output_path, name, FLAGS.chunk_size,
+                                      spatial_parser.get_encoding(), compact_unit_ids(player_race, enemy_race),
+                                      FLAGS.static_channels, map_key(controller.replay_info(), minimap_size),
+                                      FLAGS.global_format, FLAGS.static_probe)
+            else:
+                writer = ReplayWriter(output_path, name, FLAGS.chunk_size, global_format=FLAGS.global_format)
+            strides.append(Stride(step_size, GlobalParser(player_race, enemy_race), writer))
+
+        controller.start_replay(sc_pb.RequestStartReplay(observed_player_id=player_id))
+        try:
+            extract_observations(step_observations(controller, controller.step_size), controller.step_size, strides,
+                                 spatial_parser, action_extractor)
+        finally:
+            controller.close()
+
+        for stride in strides:
+            paths = stride.writer.seal()
+            player_result = next((r.result for r in stride.last_obs.player_result if r.player_id == player_id), None)
+
+            manifests = worker['manifests']
+            if stride.writer.output_path not in manifests:
+                manifests[stride.writer.output_path] = Manifest(stride.writer.output_path)
+            manifests[stride.writer.output_path].record(replay_id=replay_id, player_id=player_id,
+                                                        game_loops=stride.game_loops, player_result=player_result,
+                                                        spatial_format=FLAGS.spatial_format,
+                                                        global_format=FLAGS.global_format, paths=paths)
+
+        return name, None
+
+    except Exception:
+        for stride in strides:
+            stride.writer.abort()
+        return name, traceback.format_exc()
+
+
+def main(argv):
+    FLAGS.output_path = os.path.join(FLAGS.output_path, f"{FLAGS.player_race}_vs_{FLAGS.enemy_race}")
+
+    output_paths = [os.path.join(FLAGS.output_path, f'step_{int(step_size)}') for step_size in FLAGS.step_sizes]
+    for output_path in output_paths or [FLAGS.output_path]:
+        for out_folder in ['actions', 'global', 'spatial']:
+            path = os.path.join(output_path, out_folder)
+            if not os.path.isdir(path):
+                os.makedirs(path)
+
+    recordings = sorted(glob.glob(os.path.join(FLAGS.output_path, 'observations', '*.obs.gz')))
+    print(f'Re-extracting {len(recordings)} replays')
+
+    failed = 0
+    with multiprocessing.Pool(FLAGS.n_workers, init_worker) as pool:
+        for name, error in tqdm(pool.imap_unordered(reextract, recordings), total=len(recordings)):
+            if error is not None:
+                print('Failed to re-extract', name)
+                print(error)
+                failed += 1
+
+    print(f'{len(recordings) - failed} replays re-extracted, {failed} failed')
+
+if __name__ == '__main__':
+    app.run(main)
@@ -0,0 +1,472 @@
+import os
+import json
+import shutil
+import zipfile
+import tempfile
+
+import numpy as np
+from scipy import sparse
+
+from global_codec import DeltaGlobalWriter
+
+
+def write_array(zf, name, array):
+    """Write an array as a .npy entry of an open .npz"""
+    with zf.open(name + '.npy', 'w', force_zip64=True) as f:
+        np.lib.format.write_array(f, array, allow_pickle=False)
+
+def write_spooled(zf, name, spool_path, dtype, shape):
+    """Write a raw spool file as a .npy entry of an open .npz, copying it in blocks"""
+    header = {
+        'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)),
+        'fortran_order': False,
+        'shape': shape
+    }
+
+    with zf.open(name + '.npy', 'w', force_zip64=True) as f, open(spool_path, 'rb') as spool:
+        np.lib.format.write_array_header_1_0(f, header)
+        shutil.copyfileobj(spool, f, 1 << 20)
+
+
+class SparseChunkWriter:
+    """
+    Builds a CSC matrix row by row without holding it in memory
+
+    Rows are buffered densely, and every chunk_size rows the buffer is converted to CSC and its data/row indices are
+    appended to spool files. seal() merges the chunks column block by column block into the same .npz that
+    sparse.save_npz(path, sparse.csc_matrix(rows)) would write
+    """
+    def __init__(self, path, spool_dir, chunk_size):
+        self.path = path
+        self.chunk_size = chunk_size
+
+        self.buffer = None
+        self.n_buffered = 0
+        self.n_rows = 0
+        self.n_cols = 0
+        self.dtype = np.float64
+        self.nnz = 0
+        self.chunks = [] # (nnz offset, column indptr) of each spooled chunk
+
+        spool = os.path.join(spool_dir, os.path.basename(path))
+        self.data_path, self.indices_path, self.chunks_path = spool + '.data', spool + '.indices', spool + '.chunks.npy'
+        self.data_file = open(self.data_path, 'wb')
+        self.indices_file = open(self.indices_path, 'wb')
+
+    def append(self, row):
+        if self.buffer is None:
+            self.buffer = np.zeros((self.chunk_size, row.size), dtype=row.dtype)
+            self.n_cols = row.size
+            self.dtype = row.dtype
+
+        self.buffer[self.n_buffered] = row.reshape(-1)
+        self.n_buffered += 1
+
+        if self.n_buffered == self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self.n_buffered == 0:
+            return
+
+        chunk = sparse.csc_matrix(self.buffer[:self.n_buffered])
+        self.data_file.write(chunk.data.tobytes())
+        self.indices_file.write((chunk.indices.astype(np.int64) + self.n_rows).tobytes())
+        self.chunks.append((self.nnz, chunk.indptr.astype(np.int64)))
+
+        self.nnz += chunk.nnz
+        self.n_rows += self.n_buffered
+        self.n_buffered = 0
+
+    def finish(self):
+        """Flush and close the spools, after which the writer pickles small and can be sealed by another process"""
+        if self.data_file is None:
+            return
+
+        self.flush()
+        self.data_file.close()
+        self.indices_file.close()
+        self.data_file = self.indices_file = self.buffer = None
+
+        # The chunks' column pointers go to the spool too, rather than through a pipe: offset then indptr per chunk
+        offsets = np.array([offset for offset, _ in self.chunks], dtype=np.int64)
+        indptrs = np.array([chunk_indptr for _, chunk_indptr in self.chunks], dtype=np.int64)
+        np.save(self.chunks_path, np.column_stack([offsets, indptrs.reshape((len(self.chunks), self.n_cols + 1))]))
+        self.chunks = None
+
+    def seal(self):
+        """Write the final .npz, returns its size in bytes"""
+        self.finish()
+
+        chunks = np.load(self.chunks_path)
+        self.chunks = [(int(chunk[0]), chunk[1:]) for chunk in chunks]
+
+        idx_dtype = np.int32 if max(self.nnz, self.n_rows, self.n_cols) < 2**31 else np.int64
+        indptr = chunks[:,1:].sum(axis=0) if len(chunks) > 0 else np.zeros(self.n_cols + 1, dtype=np.int64)
+
+        tmp_path = self.path + '.tmp'
+        with zipfile.ZipFile(tmp_path, 'w', compression=zipfile.ZIP_DEFLATED, allowZip64=True) as zf:
+            self.write_merged(zf, 'indices', self.indices_path, np.int64, idx_dtype, self.n_cols)
+            write_array(zf, 'indptr', indptr.astype(idx_dtype))
+            write_array(zf, 'format', np.array(b'csc'))
+            write_array(zf, 'shape', np.array((self.n_rows, self.n_cols)))
+            self.write_merged(zf, 'data', self.data_path, self.dtype, self.dtype, self.n_cols)
+
+        os.replace(tmp_path, self.path)
+
+        return os.path.getsize(self.path)
+
+    def abort(self):
+        if self.data_file is not None:
+            self.data_file.close()
+            self.indices_file.close()
+
+    def write_merged(self, zf, name, spool_path, spool_dtype, dtype, n_cols):
+        """Write a spooled array as a 1D .npy entry in column order, merging the chunks a block of columns at a time"""
+        header = {
+            'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)),
+            'fortran_order': False,
+            'shape': (self.nnz,)
+        }
+
+        with zf.open(name + '.npy', 'w', force_zip64=True) as f:
+            np.lib.format.write_array_header_1_0(f, header)
+            if self.nnz == 0:
+                return
+
+            spool = np.memmap(spool_path, dtype=spool_dtype, mode='r')
+            block_cols = max(1, self.chunk_size * n_cols // self.n_rows) # Keeps a block around the size of a chunk
+
+            for col_start in range(0, n_cols, block_cols):
+                col_end = min(col_start + block_cols, n_cols)
+
+                # Each column takes its values from every chunk in turn, so the chunks stay in row order
+                counts = np.stack([np.diff(chunk_indptr[col_start:col_end + 1]) for _, chunk_indptr in self.chunks])
+                col_begin = np.cumsum(counts.sum(axis=0)) - counts.sum(axis=0)
+                chunk_begin = np.cumsum(counts, axis=0) - counts
+
+                block = np.empty(counts.sum(), dtype=dtype)
+                for k, (offset, chunk_indptr) in enumerate(self.chunks):
+                    values = spool[offset + chunk_indptr[col_start]:offset + chunk_indptr[col_end]]
+                    local_begin = chunk_indptr[col_start:col_end] - chunk_indptr[col_start]
+                    block[np.repeat(col_begin + chunk_begin[k] - local_begin, counts[k]) + np.arange(len(values))] = values
+
+                f.write(block.tobytes())
+
+            del spool
+
+
+
+class CompactSpatialWriter:
+    """
+    Streams minimap stacks to a compact spatial file (.spc.npz) that extract_spatial.load_compact decodes losslessly
+
+    Each channel is stored on its own: binary layers bit-packed, the rest at the smallest dtype that fits their scale,
+    and unit_type remapped to an index into unit_ids. Unit types missing from unit_ids are appended to it as they're
+    seen, and the index widens from uint8 to uint16 if it has to
+
+    Static channels (height_map, pathable, creep of a race without it...) barely change all replay long on the same
+    map, so their first frame is kept once per map in the map cache next to map_path, and a replay only stores the
+    pixels that changed at every step. With static None they're detected as the channels unchanged over the first
+    probe_steps frames, which are buffered until then. A channel detected static that changes later on is still stored
+    losslessly, only less compactly
+    """
+    def __init__(self, path, spool_dir, encoding, unit_ids, static=(), map_path=None, probe_steps=8):
+        self.path = path
+        self.spool_dir = spool_dir
+        self.encoding = encoding
+
+        if static is not None and any(encoding == 'unit_type' for name, encoding in encoding if name in static):
+            raise ValueError('unit_type can\'t be a static channel')
+        if static and map_path is None:
+            raise ValueError('Static channels need a map cache')
+        self.map_path = map_path
+        self.map_file = None # Cached frames of this replay's static channels, by map and set of static channels
+        self.probe_steps = probe_steps
+        self.probe = [] # First frames, until the static channels are detected from them
+        self.static = None
+        self.frames = None # Last frame of every static channel
+        self.counts = None # Pixels changed per step of every static channel
+
+        self.unit_ids = list(unit_ids)
+        self.unit_lookup = {unit_id: idx for idx, unit_id in enumerate(self.unit_ids)}
+        self.unit_dtype = np.uint8 if len(self.unit_ids) <= 256 else np.uint16
+
+        self.shape = None
+        self.dtype = None
+        self.n_rows = 0
+        self.spools = None
+        self.files = None
+        if static is not None:
+            self.open(static)
+        elif map_path is None:
+            self.open(()) # Nowhere to cache static channels
+
+    def open(self, static):
+        """Open the spools once the static channels are known"""
+        self.static = [name for name, _ in self.encoding if name in static]
+        self.counts = {name: [] for name in self.static}
+        if self.static:
+            self.map_file = f"{self.map_path}.{'+'.join(self.static)}.npz"
+
+        spools = [name for name in dict(self.encoding) if name not in self.static]
+        spools += [f'{name}.{part}' for name in self.static for part in ['pixels', 'values']]
+        self.spools = {name: os.path.join(self.spool_dir, f'{os.path.basename(self.path)}.{name}') for name in spools}
+        self.files = {name: open(spool, 'wb') for name, spool in self.spools.items()}
+
+    def detect(self):
+        """Open the spools with the channels unchanged over the probed frames (at least 2) as static, then write them"""
+        first = self.probe[0] if len(self.probe) > 1 else None
+        self.open([name for i, (name, encoding) in enumerate(self.encoding) if first is not None and
+                   encoding != 'unit_type' and all(np.array_equal(state[i], first[i]) for state in self.probe[1:])])
+
+        probe, self.probe = self.probe, []
+        for spatial_state in probe:
+            self.write(spatial_state)
+
+    def append(self, spatial_state):
+        if self.shape is None:
+            self.shape = spatial_state.shape[1:]
+            self.dtype = spatial_state.dtype
+
+        if self.static is None:
+            self.probe.append(spatial_state.copy())
+            if len(self.probe) == self.probe_steps:
+                self.detect()
+            return
+
+        self.write(spatial_state)
+
+    def write(self, spatial_state):
+        if self.static and self.frames is None:
+            self.frames = self.load_map(spatial_state)
+
+        for (name, encoding), channel in zip(self.encoding, spatial_state):
+            if name in self.static:
+                frame = channel.reshape(-1)
+                changed = np.flatnonzero(frame != self.frames[name])
+                self.files[f'{name}.pixels'].write(changed.astype(np.int32).tobytes())
+                self.files[f'{name}.values'].write(frame[changed].astype(self.static_dtype(encoding)).tobytes())
+                self.counts[name].append(len(changed))
+                self.frames[name] = frame
+                continue
+
+            if encoding == 'bits':
+                if channel.max() > 1:
+                    raise ValueError(f'Non-binary value in {name}')
+                encoded = np.packbits(channel.reshape(-1))
+            elif encoding == 'unit_type':
+                encoded = self.map_units(channel)
+            else:
+                if channel.max() > np.iinfo(encoding).max:
+                    raise ValueError(f'Value out of range in {name}')
+                encoded = channel.astype(encoding)
+
+            self.files[name].write(encoded.tobytes())
+
+        self.n_rows += 1
+
+    @staticmethod
+    def static_dtype(encoding):
+        return np.uint8 if encoding == 'bits' else encoding
+
+    def load_map(self, spatial_state):
+        """
+        The static channels' frames in the map cache, cached from spatial_state if they aren't yet
+
+        A new map is written to a temporary file then linked into place, which fails if another worker got there first,
+        so a cached map never changes once replays refer to it
+        """
+        if not os.path.isfile(self.map_file):
+            os.makedirs(os.path.dirname(self.map_file), exist_ok=True)
+            frames = {name: channel.reshape(-1).astype(self.static_dtype(encoding))
+                      for (name, encoding), channel in zip(self.encoding, spatial_state) if name in self.static}
+
+            tmp_path = f'{self.map_file}.{os.getpid()}.tmp'
+            np.savez(tmp_path, **frames)
+            try:
+                os.link(tmp_path + '.npz', self.map_file)
+            except FileExistsError:
+                pass
+            finally:
+                os.remove(tmp_path + '.npz')
+
+        with np.load(self.map_file) as cached:
+            frames = {name: cached[name] for name in self.static}
+
+        for name, frame in frames.items():
+            if frame.size != np.prod(self.shape):
+                raise ValueError(f'{name} in {self.map_file} is not {self.shape[0]}x{self.shape[1]}')
+
+        return frames
+
+    def map_units(self, channel):
+        unit_types, inverse = np.unique(channel, return_inverse=True)
+
+        for unit_type in unit_types.tolist():
+            if unit_type not in self.unit_lookup:
+                self.unit_lookup[unit_type] = len(self.unit_ids)
+                self.unit_ids.append(unit_type)
+
+        if len(self.unit_ids) > 256 and self.unit_dtype == np.uint8:
+            self.widen_units()
+
+        idx = np.array([self.unit_lookup[unit_type] for unit_type in unit_types.tolist()], dtype=self.unit_dtype)
+        return idx[inverse.reshape(channel.shape)]
+
+    def widen_units(self):
+        """Rewrite the spooled unit_type indices as uint16"""
+        spool = self.files['unit_type']
+        spool.close()
+
+        narrow = np.fromfile(spool.name, dtype=np.uint8)
+        narrow.astype(np.uint16).tofile(spool.name)
+
+        self.files['unit_type'] = open(spool.name, 'ab')
+        self.unit_dtype = np.uint16
+
+    def finish(self):
+        """Close the spools, after which the writer pickles small and can be sealed by another process"""
+        if self.static is None:
+            self.detect() # Fewer frames than probe_steps
+        self.close()
+
+    def close(self):
+        if self.files is None:
+            return
+
+        for spool in self.files.values():
+            spool.close()
+        self.files = None
+
+    def seal(self):
+        """Write the final .npz, returns its size in bytes"""
+        self.finish()
+
+        height, width = (0, 0) if self.shape is None else self.shape
+
+        tmp_path = self.path + '.tmp'
+        with zipfile.ZipFile(tmp_path, 'w', compression=zipfile.ZIP_DEFLATED, allowZip64=True) as zf:
+            for name, encoding in self.encoding:
+                if name in self.static:
+                    n_changed = sum(self.counts[name])
+                    write_array(zf, f'{name}.counts', np.array(self.counts[name], dtype=np.int32))
+                    write_spooled(zf, f'{name}.pixels', self.spools[f'{name}.pixels'], np.int32, (n_changed,))
+                    write_spooled(zf, f'{name}.values', self.spools[f'{name}.values'], self.static_dtype(encoding), (n_changed,))
+                    continue
+
+                if encoding == 'bits':
+                    dtype, shape = np.uint8, (self.n_rows, (height * width + 7) // 8)
+                else:
+                    dtype, shape = self.unit_dtype if encoding == 'unit_type' else encoding, (self.n_rows, height, width)
+
+                write_spooled(zf, name, self.spools[name], dtype, shape)
+
+            write_array(zf, 'channels', np.array([name for name, _ in self.encoding]))
+            write_array(zf, 'unit_ids', np.array(self.unit_ids, dtype=np.int32))
+            write_array(zf, 'shape', np.array((self.n_rows, len(self.encoding), height, width)))
+            write_array(zf, 'dtype', np.array(str(np.dtype(np.int32 if self.dtype is None else self.dtype))))
+            if self.static:
+                write_array(zf, 'static', np.array(self.static))
+                write_array(zf, 'map', np.array(os.path.basename(self.map_file)))
+
+        os.replace(tmp_path, self.path)
+
+        return os.path.getsize(self.path)
+
+    def abort(self):
+        self.probe = []
+        self.close()
+
+
+class ReplayWriter:
+    """
+    Streams the global, spatial and action outputs of a replay to disk as it's stepped
+
+    Peak memory is bounded by chunk_size steps instead of the replay length, at a cost in throughput: benchmark_writer
+    measures 26 MB peak instead of 662 MB for an 1100 step replay, but about 0.8x the steps/s of building the matrices
+    in memory (181 vs 229 on one core), as every chunk is spooled and read back again when sealed
+
+    Spatial states are written as a sparse matrix (.spa.npz), or with spatial_encoding/unit_ids to a compact spatial
+    file (.spc.npz), with the static channels (detected over the first static_probe steps if static is None) cached
+    once per map_key in maps/. Global states are written as a sparse matrix (.glo.npz), or with global_format 'delta'
+    as runs along time (.gld.npz, see global_codec)
+
+    Once finish() has been called the writer only refers to its spool directory, so it can be handed to another
+    process (see writer_pool) to be sealed there
+    """
+    def __init__(self, output_path, name, chunk_size, spatial_encoding=None, unit_ids=None, static=(), map_key=None,
+                 global_format='sparse', static_probe=8):
+        self.output_path = output_path
+        self.name = name
+        self.spool_dir = tempfile.mkdtemp(prefix=f'.{name}.', dir=output_path)
+
+        self.paths = {
+            'global': os.path.join(output_path, 'global', f'{name}.glo.npz' if global_format == 'sparse' else f'{name}.gld.npz'),
+            'spatial': os.path.join(output_path, 'spatial', f'{name}.spa.npz' if spatial_encoding is None else f'{name}.spc.npz'),
+            'actions': os.path.join(output_path, 'actions', f'{name}.act')
+        }
+
+        if global_format == 'sparse':
+            self.global_writer = SparseChunkWriter(self.paths['global'], self.spool_dir, chunk_size)
+        else:
+            self.global_writer = DeltaGlobalWriter(self.paths['global'], self.spool_dir)
+        if spatial_encoding is None:
+            self.spatial_writer = SparseChunkWriter(self.paths['spatial'], self.spool_dir, chunk_size)
+        else:
+            map_path = None if map_key is None else os.path.join(output_path, 'maps', map_key)
+            self.spatial_writer = CompactSpatialWriter(self.paths['spatial'], self.spool_dir, spatial_encoding, unit_ids,
+                                                       static, map_path, static_probe)
+        self.actions = {}
+        self.n_states = 0
+
+    def append(self, spatial_state, global_state, actions):
+        self.spatial_writer.append(spatial_state)
+        self.global_writer.append(global_state)
+        self.actions[self.n_states] = actions
+        self.n_states += 1
+
+    def finish(self):
+        """Flush everything to the spools, nothing more can be appended"""
+        self.global_writer.finish()
+        self.spatial_writer.finish()
+
+    def seal(self):
+        """Write the final outputs and remove the spool files, returns the paths written"""
+        try:
+            self.global_writer.seal()
+            self.spatial_writer.seal()
+
+            # Last and atomic like the others, so a replay with all three outputs in place was sealed in full
+            tmp_path = self.paths['actions'] + '.tmp'
+            with open(tmp_path, 'w') as f:
+                f.write(json.dumps(self.actions, indent=4))
+            os.replace(tmp_path, self.paths['actions'])
+        finally:
+            shutil.rmtree(self.spool_dir, ignore_errors=True)
+
+        return self.paths
+
+    def abort(self):
+        self.global_writer.abort()
+        self.spatial_writer.abort()
+        shutil.rmtree(self.spool_dir, ignore_errors=True)
+
+
+def remove_partial(output_path):
+    """
+    Remove what writers killed mid replay leave behind: spool directories and temporary files of unsealed outputs
+
+    Only safe while no writer is running on output_path
+    """
+    for name in os.listdir(output_path):
+        if name.startswith('.') and '@' in name and os.path.isdir(os.path.join(output_path, name)):
+            shutil.rmtree(os.path.join(output_path, name), ignore_errors=True)
+
+    for out_folder in ['actions', 'global', 'spatial', 'maps', 'observations']:
+        path = os.path.join(output_path, out_folder)
+        if not os.path.isdir(path):
+            continue
+        for name in os.listdir(path):
+            if name.endswith('.tmp') or name.endswith('.tmp.npz'):
+                os.remove(os.path.join(path, name))
@@ -0,0 +1,56 @@
+import math
+from collections import defaultdict
+
+SCHEDULES = ['library', 'longest']
+
+
+def schedule(replay_list, order='library', group_maps=False, band_resolution=1):
+    """
+    Order work for the replay queue
+
+    library keeps the library order. longest puts the replays with the most duration_frames first (LPT), so the queue
+    ends on short replays instead of leaving every instance but one idle on a long straggler. That only matters when
+    a straggler is long next to an instance's share of the work: with tens of replays per instance and durations
+    clipped to preprocess' bounds, library order is already within a few percent of the best makespan
+
+    With longest and group_maps, replays are binned into duration bands (band_resolution bands per doubling of
+    length), longest band first, and replays of a map are kept together within a band, so consecutive pulls from the
+    queue tend to reuse the map an instance already has loaded while the tail of the queue is still made of short
+    replays
+    """
+    if order == 'library':
+        return list(replay_list)
+
+    if order != 'longest':
+        raise ValueError(f'Unknown schedule {order}')
+
+    by_length = sorted(replay_list, key=lambda replay: -replay['duration_frames'])
+    if not group_maps:
+        return by_length
+
+    # Coarse duration bands, longest first, with maps kept together inside a band so the queue still ends on short replays
+    bands = defaultdict(lambda: defaultdict(list))
+    for replay in by_length:
+        bands[int(math.log2(max(replay['duration_frames'], 1)) * band_resolution)][replay['map']].append(replay)
+
+    return [replay for band in sorted(bands, reverse=True)
+            for replays in sorted(bands[band].values(), key=lambda replays: -sum(r['duration_frames'] for r in replays))
+            for replay in replays]
+
+
+def simulate(durations, maps, n_instance, overhead=0, map_load=0):
+    """
+    Makespan of n_instance workers pulling from a shared queue in order
+
+    A replay costs its duration, plus overhead per replay and map_load whenever an instance switches map. Returns the
+    makespan and the time every instance finished at
+    """
+    free = [0] * n_instance
+    loaded = [None] * n_instance
+
+    for duration, map_name in zip(durations, maps):
+        i = min(range(n_instance), key=free.__getitem__) # First instance to free up takes the next replay
+        free[i] += duration + overhead + (map_load if loaded[i] != map_name else 0)
+        loaded[i] = map_name
+
+    return max(free), free
@@ -0,0 +1,171 @@
+import os
+import json
+
+import numpy as np
+
+INDEX = 'index.json'
+
+
+class ShardWriter:
+    """
+    Packs parsed replays into a few large shard files that ShardDataset memory maps
+
+    Every shard is a set of raw, contiguous files:
+        {shard}.glo  global states, float64 (n_steps, n_features)
+        {shard}.spa  spatial states, uint16 (n_steps, n_channels, height, width)
+        {shard}.act  action function ids, int32, all steps back to back
+        {shard}.ptr  end offset of each step's actions in {shard}.act, int64 (n_steps,)
+
+    index.json holds the shapes and a replay -> (shard, first step, # of steps) map. Replays are appended to the
+    last shard until it holds shard_steps steps, and the index is only rewritten once a replay is fully on disk
+    """
+    def __init__(self, path, shard_steps):
+        self.path = path
+        self.shard_steps = shard_steps
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        if os.path.isfile(os.path.join(path, INDEX)):
+            with open(os.path.join(path, INDEX)) as f:
+                self.index = json.load(f)
+        else:
+            self.index = {'n_features': None, 'spatial_shape': None, 'shards': [], 'replays': {}}
+
+        self.files = None
+        if len(self.index['shards']) > 0:
+            self.open_shard(self.index['shards'][-1])
+
+    def __contains__(self, replay):
+        return replay in self.index['replays']
+
+    def open_shard(self, shard):
+        """Open a shard for appending, dropping anything past what the index knows of (a crashed append)"""
+        self.close()
+
+        n_actions = 0
+        if shard['n_steps'] > 0:
+            ptr = np.memmap(os.path.join(self.path, shard['name'] + '.ptr'), dtype=np.int64, mode='r')
+            n_actions = int(ptr[shard['n_steps'] - 1])
+            del ptr
+
+        sizes = {
+            'glo': shard['n_steps'] * self.index['n_features'] * 8,
+            'spa': shard['n_steps'] * int(np.prod(self.index['spatial_shape'])) * 2,
+            'act': n_actions * 4,
+            'ptr': shard['n_steps'] * 8
+        }
+
+        self.files = {}
+        for ext, size in sizes.items():
+            f = open(os.path.join(self.path, f"{shard['name']}.{ext}"), 'ab')
+            f.truncate(size)
+            self.files[ext] = f
+
+        self.shard = shard
+        self.n_actions = n_actions
+
+    def append(self, replay, global_states, spatial_states, actions):
+        """Append a replay; spatial_states (n_steps, n_channels, height, width), actions a list of function ids per step"""
+        n_steps = global_states.shape[0]
+
+        if self.index['n_features'] is None:
+            self.index['n_features'] = global_states.shape[1]
+            self.index['spatial_shape'] = list(spatial_states.shape[1:])
+
+        if global_states.shape[1] != self.index['n_features'] or list(spatial_states.shape[1:]) != self.index['spatial_shape']:
+            raise ValueError(f'{replay} has a different shape from the rest of the shards')
+        if spatial_states.min(initial=0) < 0 or spatial_states.max(initial=0) > np.iinfo(np.uint16).max:
+            raise ValueError(f'{replay} has spatial values out of uint16 range')
+
+        if self.files is None or (self.shard['n_steps'] > 0 and self.shard['n_steps'] + n_steps > self.shard_steps):
+            shard = {'name': f"shard_{len(self.index['shards']):04d}", 'n_steps': 0}
+            self.index['shards'].append(shard)
+            self.open_shard(shard)
+
+        self.files['glo'].write(np.ascontiguousarray(global_states, dtype=np.float64).tobytes())
+        self.files['spa'].write(np.ascontiguousarray(spatial_states, dtype=np.uint16).tobytes())
+        self.files['act'].write(np.array([func_id for step in actions for func_id in step], dtype=np.int32).tobytes())
+        self.files['ptr'].write((self.n_actions + np.cumsum([len(step) for step in actions], dtype=np.int64)).tobytes())
+
+        for f in self.files.values():
+            f.flush()
+            os.fsync(f.fileno())
+
+        self.index['replays'][replay] = [len(self.index['shards']) - 1, self.shard['n_steps'], n_steps]
+        self.shard['n_steps'] += n_steps
+        self.n_actions += sum(len(step) for step in actions)
+
+        self.write_index()
+
+    def write_index(self):
+        tmp_path = os.path.join(self.path, INDEX + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(self.index, f)
+        os.replace(tmp_path, os.path.join(self.path, INDEX))
+
+    def close(self):
+        if self.files is not None:
+            for f in self.files.values():
+                f.close()
+            self.files = None
+
+
+class ShardDataset:
+    """
+    Zero-copy access to consolidated shards
+
+    Shards are memory mapped on first use, so global and spatial windows come back as views into the page cache
+    without any decompression
+    """
+    def __init__(self, path):
+        self.path = path
+
+        with open(os.path.join(path, INDEX)) as f:
+            self.index = json.load(f)
+
+        self.replays = self.index['replays']
+        self.maps = {}
+
+    def __len__(self):
+        return len(self.replays)
+
+    def n_steps(self, replay):
+        return self.replays[replay][2]
+
+    def shard(self, shard_idx):
+        if shard_idx not in self.maps:
+            shard = self.index['shards'][shard_idx]
+            n_steps = shard['n_steps']
+            base = os.path.join(self.path, shard['name'])
+
+            ptr = np.memmap(base + '.ptr', dtype=np.int64, mode='r', shape=(n_steps,))
+            n_actions = int(ptr[-1]) if n_steps > 0 else 0
+
+            self.maps[shard_idx] = {
+                'glo': np.memmap(base + '.glo', dtype=np.float64, mode='r', shape=(n_steps, self.index['n_features'])),
+                'spa': np.memmap(base + '.spa', dtype=np.uint16, mode='r', shape=(n_steps, *self.index['spatial_shape'])),
+                'act': np.memmap(base + '.act', dtype=np.int32, mode='r', shape=(n_actions,)) if n_actions > 0 \
+                    else np.zeros(0, dtype=np.int32),
+                'ptr': ptr
+            }
+
+        return self.maps[shard_idx]
+
+    def get(self, replay, start=0, stop=None):
+        """Global states, spatial states and per step action ids for steps [start, stop) of a replay"""
+        shard_idx, first, n_steps = self.replays[replay]
+        stop = n_steps if stop is None else min(stop, n_steps)
+        if not 0 <= start <= stop:
+            raise IndexError(f'Steps {start}:{stop} out of range for {replay} ({n_steps} steps)')
+
+        shard = self.shard(shard_idx)
+        lo, hi = first + start, first + stop
+
+        ptr = shard['ptr']
+        act_start = int(ptr[lo - 1]) if lo > 0 else 0
+        ends = ptr[lo:hi] - act_start
+        acts = shard['act'][act_start:act_start + (int(ends[-1]) if len(ends) > 0 else 0)]
+        actions = np.split(acts, ends[:-1]) if len(ends) > 0 else []
+
+        return shard['glo'][lo:hi], shard['spa'][lo:hi], actions
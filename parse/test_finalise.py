@@ -0,0 +1,48 @@
+from manifest import Manifest
+import finalise
+
+import os
+import json
+
+from absl import flags
+
+FLAGS = flags.FLAGS
+
+
+def write_stride(output_path, replays, step_size):
+    """Outputs and manifest records for replays parsed at step_size, as parse writes them under step_{size}/"""
+    path = os.path.join(output_path, 'Protoss_vs_Terran', f'step_{step_size}')
+    for folder in ['global', 'spatial', 'actions']:
+        os.makedirs(os.path.join(path, folder))
+
+    manifest = Manifest(path)
+    for replay in replays:
+        name = f"1@{replay['id']}"
+        paths = {'global': os.path.join(path, 'global', f'{name}.glo.npz'),
+                 'spatial': os.path.join(path, 'spatial', f'{name}.spa.npz'),
+                 'actions': os.path.join(path, 'actions', f'{name}.act')}
+        for file_path in paths.values():
+            with open(file_path, 'w') as f:
+                f.write('{}')
+        manifest.record(replay['id'], 1, list(range(0, replay['duration_frames'] + 1, step_size)), 1, 'sparse',
+                        'sparse', paths)
+    manifest.close()
+
+
+def test_finalise_step_sizes(tmp_path):
+    """Each step size of a multi-stride output is finalised on its own, with its own # of steps"""
+    replays = [{'id': 'a', 'duration_frames': 720}, {'id': 'b', 'duration_frames': 1440}]
+    with open(tmp_path / 'Protoss_vs_Terran.json', 'w') as f:
+        json.dump([{'path': f"/replays/{replay['id']}.SC2Replay", 'duration_frames': replay['duration_frames'],
+                    'players': [{'id': 1, 'race': 'Protoss', 'result': 1}, {'id': 2, 'race': 'Terran', 'result': 2}]}
+                   for replay in replays], f)
+    for step_size in [24, 72]:
+        write_stride(str(tmp_path), replays, step_size)
+
+    for step_size in [24, 72]:
+        FLAGS(['finalise', f'--output_path={tmp_path}', f'--library_path={tmp_path}', f'--step_size={step_size}'])
+        finalise.finalise([])
+
+        with open(tmp_path / 'Protoss_vs_Terran' / f'step_{step_size}' / 'replays.csv') as f:
+            rows = [line.strip().split(',') for line in f]
+        assert rows == [[f"1@{replay['id']}", '1', str(replay['duration_frames'] // step_size + 1)] for replay in replays]
@@ -0,0 +1,100 @@
+from watchdog import Watchdog
+from work_queue import LeaseQueue, DONE
+from writer_pool import WriterQueue, start_writer, stop_writers
+from manifest import Manifest
+
+import os
+import sys
+import time
+import signal
+import multiprocessing
+
+
+class StandInWriter:
+    """A finished ReplayWriter stand-in, hanging in seal() the first time it's asked to if hang"""
+    def __init__(self, output_path, name, hang):
+        self.output_path = output_path
+        self.name = name
+        self.hang = hang
+
+    def finish(self):
+        pass
+
+    def seal(self):
+        marker = os.path.join(self.output_path, 'hung')
+        if self.hang and not os.path.exists(marker):
+            with open(marker, 'w') as f:
+                f.write(str(os.getpid()))
+            time.sleep(600)
+
+        paths = {kind: os.path.join(self.output_path, f'{self.name}.{kind}') for kind in ['global', 'spatial', 'actions']}
+        for path in paths.values():
+            with open(path, 'w') as f:
+                f.write(self.name)
+        return paths
+
+    def abort(self):
+        pass
+
+
+def stand_in_worker(inbox, status_queue, writer_queue, worker_id, output_path):
+    """Hands every replay it gets to the writers as one output, like a ReplayProcessor with writer processes"""
+    signal.signal(signal.SIGTERM, lambda a, b: sys.exit())
+    while True:
+        job, replay = inbox.get()
+        name = f"{replay['player_id']}@{replay['replay_id']}"
+        record = dict(replay_id=replay['replay_id'], player_id=replay['player_id'], game_loops=[0, 72],
+                      player_result=1, spatial_format='sparse', global_format='sparse')
+        writer_queue.put(StandInWriter(output_path, name, replay['replay_id'] == 'hang'), record, job)
+        status_queue.put(('done', worker_id, job, False, 1))
+
+
+def test_writer_killed_mid_write(tmp_path):
+    """A writer SIGKILLed while sealing is restarted, its slot released and its replay retried, so the run ends with
+    every replay written"""
+    output_path = str(tmp_path)
+    replay_queue = LeaseQueue(os.path.join(output_path, 'queue.sqlite'), lease_seconds=60, max_retries=2, backoff=0,
+                              poll_interval=0.05)
+    replay_queue.add([{'replay_id': replay_id, 'player_id': 1, 'duration_frames': 100}
+                      for replay_id in ['a', 'hang', 'b', 'c', 'd']])
+    status_queue = multiprocessing.SimpleQueue()
+    writer_queue = WriterQueue(max_pending=1) # A slot lost with the writer would block the workers for good
+
+    def start_worker(worker_id):
+        inbox = multiprocessing.SimpleQueue()
+        p = multiprocessing.Process(target=stand_in_worker,
+                                    args=(inbox, status_queue, writer_queue, worker_id, output_path))
+        p.inbox = inbox
+        p.daemon = True
+        p.start()
+        return p
+
+    def restart_writer(writer_id):
+        return start_writer(writer_id, status_queue)
+
+    writers = {i: restart_writer(i) for i in range(2)}
+    first_writers = {i: writer.pid for i, writer in writers.items()}
+    watchdog = Watchdog({i: start_worker(i) for i in range(2)}, start_worker, replay_queue, status_queue,
+                        writers=writers, restart_writer=restart_writer, writer_queue=writer_queue)
+
+    killed = False
+    deadline = time.time() + 60
+    while replay_queue.progress()[0] < 5 and time.time() < deadline:
+        time.sleep(0.05)
+        watchdog.poll()
+        if not killed and os.path.exists(os.path.join(output_path, 'hung')):
+            with open(os.path.join(output_path, 'hung')) as f:
+                pid = f.read()
+            if pid:
+                os.kill(int(pid), signal.SIGKILL)
+                killed = True
+
+    stop_writers(watchdog.writers.values())
+    for worker in watchdog.workers.values():
+        worker.terminate()
+
+    assert killed
+    assert {i: writer.pid for i, writer in watchdog.writers.items()} != first_writers
+    states = dict(replay_queue.conn.execute('SELECT name, state FROM replays'))
+    assert states == {f'1@{replay_id}': DONE for replay_id in ['a', 'hang', 'b', 'c', 'd']}
+    assert Manifest(output_path).names() == set(states)
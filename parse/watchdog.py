@@ -0,0 +1,185 @@
+import os
+import time
+import signal
+
+from metrics import Metrics
+
+
+def replay_budget(replay, timeout, timeout_per_loop):
+    """Wall-clock seconds a replay may take, None for no limit"""
+    if timeout <= 0:
+        return None
+
+    return timeout + replay['duration_frames'] * timeout_per_loop
+
+
+class Watchdog:
+    """
+    Supervises the replay workers and writer processes from the parent: hands them replays, restarts dead or hung
+    workers and dead writers, and retries the replays they held
+
+    Replays are claimed from the queue here and sent to idle workers on their inbox as (job, replay), so a replay is
+    held by a worker from the moment it's claimed. Workers only report on status_queue when they're done with one
+    ('done', worker_id, job, failed, n_writes), n_writes being the # of outputs they put on writer_queue. Those are
+    claimed here too and sent to idle writers on their inbox, which report each once it's sealed and recorded
+    ('written', writer_id, job, failed). A replay is only task_done() once all of its outputs are on disk, a write
+    failing retries it. status_queue is a SimpleQueue, which writes to its pipe in
+    put() rather than from a feeder thread, so a report is never lost with a process that dies right after it.
+    Everything else happens here, so a worker killed at any point can't leave the queue's accounting half done:
+        - A replay still running past its budget (timeout + duration_frames * timeout_per_loop seconds) gets its worker
+          and game client killed, and the worker is restarted with restart(worker_id)
+        - A worker found dead is restarted the same way, and a writer found dead with restart_writer(writer_id). The
+          output it held counts as a failed write, and its writer_queue slot is released
+        - A replay that failed, timed out or was held by a dead worker is handed to the queue's retry(), which queues
+          it again after a backoff or gives up on it
+        - The leases of the replays running or being written are renewed, for queues shared between hosts (see
+          work_queue)
+    """
+    def __init__(self, workers, restart, replay_queue, status_queue, timeout=0, timeout_per_loop=0.0, grace=10,
+                 metrics_queue=None, writers=None, restart_writer=None, writer_queue=None):
+        self.workers = workers # By worker id
+        self.restart = restart
+        self.writers = writers or {} # By writer id
+        self.restart_writer = restart_writer
+        self.writer_queue = writer_queue
+        self.replay_queue = replay_queue
+        self.status_queue = status_queue
+        self.timeout = timeout
+        self.timeout_per_loop = timeout_per_loop
+        self.grace = grace
+
+        self.running = {} # Worker id -> (job, replay, deadline)
+        self.writing = {} # Writer id -> job
+        self.jobs = {} # Job -> [replay, # of writes outstanding, failed], until it's task_done() or retried
+        self.n_jobs = 0
+        self.metrics = Metrics('watchdog', metrics_queue)
+
+    def poll(self):
+        """Handle what the workers and writers reported, then any overdue replays or dead workers or writers, then hand
+        replays to idle workers and writers"""
+        self.drain()
+
+        now = time.time()
+        for worker_id, process in list(self.workers.items()):
+            _, replay, deadline = self.running.get(worker_id, (None, None, None))
+            if deadline is not None and now > deadline:
+                print(f"Worker {worker_id} over its budget on {replay['player_id']}@{replay['replay_id']}, restarting")
+                self.metrics.count('timeouts')
+                self.kill(process)
+                self.replace(worker_id)
+            elif not process.is_alive():
+                self.drain() # Anything it reported before dying
+                print(f'Worker {worker_id} died (exit code {process.exitcode}), restarting')
+                self.metrics.count('worker_deaths')
+                self.kill(process) # Its game client may have outlived it
+                self.replace(worker_id)
+
+        for writer_id, process in list(self.writers.items()):
+            if not process.is_alive():
+                self.drain()
+                print(f'Writer {writer_id} died (exit code {process.exitcode}), restarting')
+                self.metrics.count('writer_deaths')
+                process.join()
+                if writer_id in self.writing:
+                    self.written(writer_id, self.writing[writer_id], True)
+                self.writers[writer_id] = self.restart_writer(writer_id)
+
+        self.dispatch()
+        self.dispatch_writes()
+        self.replay_queue.renew([replay for replay, _, _ in self.jobs.values()])
+        self.metrics.push()
+
+    def dispatch(self):
+        """Claim a replay for every idle worker, until the queue has none due"""
+        for worker_id, process in self.workers.items():
+            if worker_id in self.running:
+                continue
+
+            replay = self.replay_queue.claim()
+            if replay is None:
+                return
+
+            self.n_jobs += 1
+            budget = replay_budget(replay, self.timeout, self.timeout_per_loop)
+            self.running[worker_id] = (self.n_jobs, replay, None if budget is None else time.time() + budget)
+            self.jobs[self.n_jobs] = [replay, 0, False]
+            process.inbox.put((self.n_jobs, replay))
+
+    def dispatch_writes(self):
+        """Hand an output waiting on writer_queue to every idle writer"""
+        for writer_id, process in self.writers.items():
+            if writer_id in self.writing:
+                continue
+
+            write = self.writer_queue.claim()
+            if write is None:
+                return
+
+            self.writing[writer_id] = write[2]
+            process.inbox.put(write)
+
+    def drain(self):
+        while not self.status_queue.empty():
+            message = self.status_queue.get()
+            if message[0] == 'done':
+                _, worker_id, job, failed, n_writes = message
+                if self.running.get(worker_id, (None,))[0] == job:
+                    del self.running[worker_id]
+                self.update(job, n_writes, failed)
+            else:
+                _, writer_id, job, failed = message
+                self.written(writer_id, job, failed)
+
+    def written(self, writer_id, job, failed):
+        """A writer is through with an output, written or not"""
+        if self.writing.get(writer_id) != job:
+            return
+
+        del self.writing[writer_id]
+        self.writer_queue.task_done()
+        self.update(job, -1, failed)
+
+    def update(self, job, n_writes, failed):
+        """Count writes handed over or finished for a job, settling it once its worker is done and nothing is left to
+        write. Reports on jobs already retried are ignored"""
+        if job not in self.jobs:
+            return
+
+        entry = self.jobs[job]
+        entry[1] += n_writes
+        entry[2] = entry[2] or failed
+        # A write may be reported before the worker's 'done'
+        if entry[1] > 0 or any(held[0] == job for held in self.running.values()):
+            return
+
+        del self.jobs[job]
+        if entry[2]:
+            self.retry(entry[0])
+        else:
+            self.replay_queue.task_done(entry[0])
+
+    def retry(self, replay):
+        if self.replay_queue.retry(replay):
+            self.metrics.count('retries')
+        else:
+            print(f"Giving up on {replay['player_id']}@{replay['replay_id']}")
+            self.metrics.count('abandoned_replays')
+
+    def kill(self, process):
+        """SIGTERM a worker, which closes its game client on the way out, then SIGKILL its process group (the worker
+        and client) in case either is still around after grace seconds"""
+        process.terminate()
+        process.join(self.grace)
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            pass
+        process.join()
+
+    def replace(self, worker_id):
+        held = self.running.pop(worker_id, None)
+        if held is not None:
+            del self.jobs[held[0]] # Writes it handed over before dying are ignored
+            self.retry(held[1])
+
+        self.workers[worker_id] = self.restart(worker_id)
@@ -0,0 +1,158 @@
+import os
+import json
+import time
+import socket
+import sqlite3
+from contextlib import contextmanager
+
+LEASED, QUEUED, DONE, FAILED = 'leased', 'queued', 'done', 'failed'
+
+
+class LeaseQueue:
+    """
+    Replay queue shared by parse runs on any number of hosts, through a SQLite database on shared storage
+
+    A drop-in for ReplayQueue: the Watchdog claim()s replays for its workers under a lease held by its host's parse
+    run (owner), and renews the leases of the replays its workers are on. A replay whose lease runs out, because its host died or lost
+    the storage, is claimed by the next worker asking, as a failed attempt. Claims take the database's write lock
+    (BEGIN IMMEDIATE), so no two workers anywhere claim the same live lease.
+
+    Every host adds the replays it finds unparsed to the same database, rows already in it are left as they are, so
+    a run is started over by removing the database. The rollback journal is used rather than WAL, which needs
+    shared memory between the processes and doesn't work across hosts. Each process opens its own connection
+    """
+    def __init__(self, path, lease_seconds=300, max_retries=2, backoff=30, poll_interval=5, owner=None):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.poll_interval = poll_interval
+        self.owner = owner or f'{socket.gethostname()}:{os.getpid()}'
+
+        self.pid = None
+        self.last_renewal = 0
+        self.next_claim = 0
+
+        with self.transaction() as conn:
+            conn.execute('''CREATE TABLE IF NOT EXISTS replays (
+                name TEXT PRIMARY KEY,
+                replay TEXT,
+                duration_frames INTEGER,
+                priority INTEGER,
+                state TEXT,
+                owner TEXT,
+                lease_expires REAL,
+                not_before REAL,
+                attempts INTEGER)''')
+            conn.execute('CREATE INDEX IF NOT EXISTS claimable ON replays (state, priority)')
+
+    @property
+    def conn(self):
+        """This process' connection, a connection can't be used across a fork"""
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self._conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            self._conn.execute('PRAGMA journal_mode=DELETE')
+
+        return self._conn
+
+    @contextmanager
+    def transaction(self):
+        """Holds the database's write lock throughout, other processes wait for it (up to a minute)"""
+        conn = self.conn
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def add(self, replay_list):
+        """Queue replays in order, after those already queued"""
+        with self.transaction() as conn:
+            first, = conn.execute('SELECT COALESCE(MAX(priority) + 1, 0) FROM replays').fetchone()
+            conn.executemany('INSERT OR IGNORE INTO replays VALUES (?, ?, ?, ?, ?, NULL, NULL, 0, 0)', [
+                (f"{replay['player_id']}@{replay['replay_id']}", json.dumps(replay), replay['duration_frames'],
+                 first + i, QUEUED) for i, replay in enumerate(replay_list)])
+
+    def claim(self):
+        """Lease the next replay due, None if there isn't one right now. The database isn't asked again for
+        poll_interval seconds after it had none"""
+        now = time.time()
+        if now < self.next_claim:
+            return None
+
+        with self.transaction() as conn:
+            while True:
+                row = conn.execute('SELECT name, replay, state, attempts FROM replays WHERE '
+                                   '(state = ? AND not_before <= ?) OR (state = ? AND lease_expires < ?) '
+                                   'ORDER BY priority LIMIT 1', (QUEUED, now, LEASED, now)).fetchone()
+                if row is None:
+                    self.next_claim = now + self.poll_interval
+                    return None
+
+                name, replay, state, attempts = row
+                if state == LEASED: # Its owner went quiet
+                    attempts += 1
+                    if attempts > self.max_retries:
+                        print(f'Giving up on {name} after {attempts} attempts')
+                        conn.execute('UPDATE replays SET state = ?, attempts = ? WHERE name = ?', (FAILED, attempts, name))
+                        continue
+
+                conn.execute('UPDATE replays SET state = ?, owner = ?, lease_expires = ?, attempts = ? WHERE name = ?',
+                             (LEASED, self.owner, now + self.lease_seconds, attempts, name))
+                return json.loads(replay)
+
+    def renew(self, replays):
+        """Extend the leases this run holds on replays, at most every third of a lease. Leases taken over by another
+        run in the meantime are left to it, the replay is then parsed twice, which only costs time"""
+        now = time.time()
+        if not replays or now - self.last_renewal < self.lease_seconds / 3:
+            return
+        self.last_renewal = now
+
+        with self.transaction() as conn:
+            conn.executemany('UPDATE replays SET lease_expires = ? WHERE name = ? AND owner = ? AND state = ?', [
+                (now + self.lease_seconds, f"{replay['player_id']}@{replay['replay_id']}", self.owner, LEASED)
+                for replay in replays])
+
+    def task_done(self, replay):
+        with self.transaction() as conn:
+            conn.execute('UPDATE replays SET state = ?, owner = NULL WHERE name = ?',
+                         (DONE, f"{replay['player_id']}@{replay['replay_id']}"))
+
+    def retry(self, replay):
+        """Queue a replay that didn't go through again after backoff * 2**attempt seconds, or give up on it after
+        max_retries attempts. Returns whether it's retried"""
+        name = f"{replay['player_id']}@{replay['replay_id']}"
+        with self.transaction() as conn:
+            row = conn.execute('SELECT attempts FROM replays WHERE name = ? AND owner = ? AND state = ?',
+                               (name, self.owner, LEASED)).fetchone()
+            if row is None: # Taken over by another run
+                return True
+
+            attempts = row[0] + 1
+            if attempts > self.max_retries:
+                conn.execute('UPDATE replays SET state = ?, owner = NULL, attempts = ? WHERE name = ?',
+                             (FAILED, attempts, name))
+                return False
+
+            conn.execute('UPDATE replays SET state = ?, owner = NULL, not_before = ?, attempts = ? WHERE name = ?',
+                         (QUEUED, time.time() + self.backoff * 2**(attempts - 1), attempts, name))
+            return True
+
+    def totals(self):
+        """# of replays and game loops queued by every run"""
+        n_replays, n_loops = self.conn.execute('SELECT COUNT(*), COALESCE(SUM(duration_frames), 0) FROM replays').fetchone()
+        return n_replays, n_loops
+
+    def progress(self):
+        """# of replays and game loops processed (parsed or given up on) by every run"""
+        n_replays, n_loops = self.conn.execute('SELECT COUNT(*), COALESCE(SUM(duration_frames), 0) FROM replays '
+                                               'WHERE state IN (?, ?)', (DONE, FAILED)).fetchone()
+        return n_replays, n_loops
+
+    def join(self):
+        """Nothing to wait for once progress() has caught up with totals(), replays are marked done as they're reported"""
+        pass
@@ -0,0 +1,108 @@
+import os
+import sys
+import signal
+import queue
+import traceback
+import multiprocessing
+
+from manifest import Manifest
+from metrics import Metrics
+
+
+class WriterQueue:
+    """
+    Finished replays waiting to be sealed by a ReplayWriterProcess
+
+    A finished ReplayWriter only refers to the spool files it streamed the replay into, so handing it over copies no
+    tensors. At most max_pending replays wait or are being written at once: put() blocks beyond that, which holds
+    workers back when the writers can't keep up with them
+
+    Workers put() replays, and the Watchdog claim()s them in the parent for its writers, calling task_done() once a
+    replay is written or its writer died. Only the parent reads the queue, so no process can die holding its read lock
+    """
+    def __init__(self, max_pending):
+        self.queue = multiprocessing.Queue()
+        self.slots = multiprocessing.BoundedSemaphore(max_pending)
+
+    def put(self, writer, record, job):
+        """Hand over a ReplayWriter with the Manifest.record arguments (everything but paths) for its replay, and the
+        Watchdog job the replay belongs to"""
+        writer.finish()
+        self.slots.acquire()
+        self.queue.put((writer, record, job))
+
+    def claim(self):
+        """The next replay to write, None if there isn't one right now"""
+        try:
+            return self.queue.get_nowait()
+        except queue.Empty:
+            return None
+
+    def task_done(self):
+        self.slots.release()
+
+
+class ReplayWriterProcess(multiprocessing.Process):
+    """
+    A Process sealing finished replays: merging and compressing their outputs into place, then recording them
+
+    Replays come from the Watchdog on the writer's inbox, one at a time, until it gets None. Every one is reported on
+    status_queue once recorded or failed ('written', writer_id, job, failed), for the Watchdog to only count its replay
+    as processed after that
+    """
+    def __init__(self, status_queue, metrics_queue=None, writer_id=0, shared=False):
+        super(ReplayWriterProcess, self).__init__()
+        self.inbox = multiprocessing.SimpleQueue() # One per process, a writer killed reading it leaves its lock held
+        self.status_queue = status_queue
+        self.metrics_queue = metrics_queue
+        self.writer_id = writer_id
+        self.shared = shared # Manifests written from other hosts too
+
+    def run(self):
+        signal.signal(signal.SIGTERM, lambda a, b: sys.exit())
+        manifests = {} # By output path, every step size has its own
+        metrics = Metrics(f'writer-{self.writer_id}', self.metrics_queue)
+
+        while True:
+            job = self.inbox.get()
+            if job is None:
+                break
+
+            writer, record, job = job
+            if writer.output_path not in manifests:
+                manifests[writer.output_path] = Manifest(writer.output_path, self.shared)
+
+            failed = False
+            try:
+                with metrics.time('save'):
+                    paths = writer.seal()
+                with metrics.time('record'):
+                    manifests[writer.output_path].record(paths=paths, **record)
+                metrics.count('bytes_written', sum(os.path.getsize(path) for path in paths.values()))
+            except Exception:
+                traceback.print_exc() # Left out of the manifest, the watchdog retries the replay
+                writer.abort()
+                metrics.count('failed_writes')
+                failed = True
+            finally:
+                metrics.push()
+            self.status_queue.put(('written', self.writer_id, job, failed))
+
+        for manifest in manifests.values():
+            manifest.close()
+
+
+def start_writer(writer_id, status_queue, metrics_queue=None, shared=False):
+    writer = ReplayWriterProcess(status_queue, metrics_queue, writer_id, shared)
+    writer.daemon = True
+    writer.start()
+
+    return writer
+
+
+def stop_writers(writers):
+    """Let the writers finish what they hold and exit"""
+    for writer in writers:
+        writer.inbox.put(None)
+    for writer in writers:
+        writer.join()
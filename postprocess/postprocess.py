@@ -2,52 +2,183 @@ from absl import app
 from absl import flags
 from tqdm import tqdm
 import os
+import sys
 import glob
 import numpy as np
 from scipy import sparse
+import multiprocessing
 import csv
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'parse')) # Output formats and manifest are parse's
+from global_codec import load_global as read_global
+from manifest import Manifest
+
 FLAGS = flags.FLAGS
 flags.DEFINE_string(name='parsed_replays', default='../parsed_replays/Protoss_vs_Terran',
                     help='Parsed data path')
 
+flags.DEFINE_integer(name='n_workers', default=os.cpu_count(),
+                     help='# of processes scanning replays')
+flags.DEFINE_integer(name='replays_per_task', default=8,
+                     help='# of replays each worker reduces before handing back its statistics')
+flags.DEFINE_integer(name='quantile_sample', default=20000,
+                     help='# of steps sampled uniformly across every replay for the approximate quantiles')
+flags.DEFINE_list(name='quantiles', default=['0.01', '0.5', '0.99'],
+                  help='Quantiles to report per feature')
+flags.DEFINE_integer(name='seed', default=0,
+                     help='Seed for the quantile sample')
+flags.DEFINE_boolean(name='write_normalised', default=False,
+                     help='Also write a normalised copy of every replay to global_normal/')
+
+class FeatureStatistics:
+    """
+    Mergeable per-feature statistics: count, min, max (and the first replay reaching it), mean, variance through
+    Chan's parallel algorithm, and a sample of steps for approximate quantiles
+
+    The sample is a bottom-k reservoir: every step gets a uniform random key and the sample_size steps with the
+    smallest keys are kept. Merging keeps the smallest keys of both, so the result is a uniform sample of every step
+    seen whatever the order of the merges, and never holds more than sample_size steps
+    """
+    def __init__(self, n_features, sample_size=0):
+        self.n = 0
+        self.min = np.full(n_features, np.inf)
+        self.max = np.full(n_features, -np.inf)
+        self.max_replay = np.full(n_features, np.iinfo(np.int64).max) # Index into the replay list
+        self.mean = np.zeros(n_features)
+        self.m2 = np.zeros(n_features)
+        self.sample_size = sample_size
+        self.sample_keys = np.zeros(0)
+        self.samples = np.zeros((0, n_features))
+
+    def add(self, global_np, replay_idx, rng):
+        n = global_np.shape[0]
+        mean = global_np.mean(axis=0)
+        batch = FeatureStatistics(global_np.shape[1], self.sample_size)
+        batch.n = n
+        batch.min = global_np.min(axis=0)
+        batch.max = global_np.max(axis=0)
+        batch.max_replay[:] = replay_idx
+        batch.mean = mean
+        batch.m2 = ((global_np - mean) ** 2).sum(axis=0)
+        batch.sample_keys = rng.random(n)
+        batch.samples = global_np
+
+        self.merge(batch)
+
+    def merge(self, other):
+        if other.n == 0:
+            return
+
+        n = self.n + other.n
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * other.n / n
+        self.m2 = self.m2 + other.m2 + delta ** 2 * self.n * other.n / n
+        self.n = n
+
+        self.min = np.minimum(self.min, other.min)
+
+        # Highest value wins, ties go to the replay listed first
+        take = (other.max > self.max) | ((other.max == self.max) & (other.max_replay < self.max_replay))
+        self.max = np.where(take, other.max, self.max)
+        self.max_replay = np.where(take, other.max_replay, self.max_replay)
+
+        keys = np.concatenate((self.sample_keys, other.sample_keys))
+        samples = np.concatenate((self.samples, other.samples))
+        if len(keys) > self.sample_size:
+            keep = np.argpartition(keys, self.sample_size)[:self.sample_size]
+            keys, samples = keys[keep], samples[keep]
+        self.sample_keys, self.samples = keys, samples
+
+    def variance(self):
+        return self.m2 / max(self.n, 1)
+
+    def quantiles(self, q):
+        if self.samples.shape[0] == 0:
+            return np.full((len(q), len(self.mean)), np.nan)
+
+        return np.quantile(self.samples, q, axis=0)
+
+def load_global(replay):
+    """Global states of a parsed replay, whichever format parse wrote them in"""
+    if os.path.isfile(os.path.join(FLAGS.parsed_replays, 'global', f"{replay}.gld.npz")):
+        return read_global(os.path.join(FLAGS.parsed_replays, 'global', f"{replay}.gld.npz"))
+
+    return read_global(os.path.join(FLAGS.parsed_replays, 'global', f"{replay}.glo.npz"))
+
+def scan_replays(task):
+    """Worker: reduce a batch of (index, replay) into one FeatureStatistics"""
+    n_features, replays = task
+    stats = FeatureStatistics(n_features, FLAGS.quantile_sample)
+
+    for replay_idx, replay in replays:
+        rng = np.random.default_rng((FLAGS.seed, replay_idx))
+        stats.add(load_global(replay), replay_idx, rng)
+
+    return stats, len(replays)
+
+def normalise_replay(task):
+    replay, scale = task
+    global_np = load_global(replay)
+    global_np /= scale
+    sparse.save_npz(os.path.join(FLAGS.parsed_replays, 'global_normal', f"{replay}.glo"), sparse.csc_matrix(global_np)) # Global tensor
+
 def postprocess(argv):
 
     feature_names = np.loadtxt(os.path.join(FLAGS.parsed_replays, 'features.csv'), delimiter=',', usecols=(1), unpack=True, dtype='str')
 
-    max_cols = np.zeros(len(feature_names)) 
-    max_replay = ['none'] * len(feature_names)
+    replays = np.loadtxt(os.path.join(FLAGS.parsed_replays, 'replays.csv'), delimiter=',', usecols=(0), ndmin=1, unpack=True, dtype='str')
 
-    # global_files = glob.glob(os.path.join(FLAGS.parsed_replays, 'global', '*.glo.npz'))
+    # Longest replays first so the pool doesn't finish on a straggler, using the lengths parse recorded in its manifest
+    order = list(enumerate(replays))
+    if Manifest.exists(FLAGS.parsed_replays):
+        manifest = Manifest(FLAGS.parsed_replays)
+        steps = manifest.steps()
+        manifest.close()
+        order.sort(key=lambda replay: -steps.get(replay[1], 0))
 
-    # pbar = tqdm(total=len(global_files), desc='Replays processed')
-    replays = np.loadtxt(os.path.join(FLAGS.parsed_replays, 'replays.csv'), delimiter=',', usecols=(0), unpack=True, dtype='str')
+    tasks = [(len(feature_names), order[i:i + FLAGS.replays_per_task])
+             for i in range(0, len(order), FLAGS.replays_per_task)]
 
-    for replay in tqdm(replays, desc='Scanning'):
-        global_np = np.asarray(sparse.load_npz(os.path.join(FLAGS.parsed_replays, 'global', f"{replay}.glo.npz")).todense())
+    stats = FeatureStatistics(len(feature_names), FLAGS.quantile_sample)
 
-        max_counts = np.max(global_np, axis=0)
+    with multiprocessing.Pool(FLAGS.n_workers) as pool:
+        with tqdm(total=len(replays), desc='Scanning') as pbar:
+            for partial, n_replays in pool.imap_unordered(scan_replays, tasks):
+                stats.merge(partial)
+                pbar.update(n_replays)
 
-        for i in range(len(feature_names)):
-            if max_counts[i] > max_cols[i]:
-                max_cols[i] = max_counts[i]
-                max_replay[i] = replay
+    # Maximums as before, floored at 0 with 'none' for features that never go above it
+    max_cols = np.maximum(stats.max, 0)
+    max_replay = [replays[idx] if value > 0 else 'none' for value, idx in zip(stats.max, stats.max_replay)]
 
     with open(os.path.join(FLAGS.parsed_replays, 'maximums.csv'), 'w') as f:
         for i, name in enumerate(feature_names):
             f.write(f"{name},{max_cols[i]},{max_replay[i]}\n")
-            
-    max_cols[max_cols == 0] = 1
-    max_cols = max_cols[np.newaxis, :]
 
-    out_path = os.path.join(FLAGS.parsed_replays, 'global_normal')
-    if not os.path.isdir(out_path):
-        os.makedirs(out_path)
+    quantiles = [float(q) for q in FLAGS.quantiles]
+    quantile_values = stats.quantiles(quantiles)
+    std = np.sqrt(stats.variance())
+
+    with open(os.path.join(FLAGS.parsed_replays, 'statistics.csv'), 'w') as f:
+        f.write(','.join(['feature', 'min', 'max', 'mean', 'std'] + [f"q{q}" for q in FLAGS.quantiles]) + '\n')
+        for i, name in enumerate(feature_names):
+            values = [stats.min[i], stats.max[i], stats.mean[i], std[i]] + list(quantile_values[:,i])
+            f.write(','.join([name] + [str(value) for value in values]) + '\n')
+
+    # Normalisation applied at load time as (global - offset) / scale
+    scale = max_cols.copy()
+    scale[scale == 0] = 1
+    np.savez(os.path.join(FLAGS.parsed_replays, 'normalisation.npz'), offset=np.zeros_like(scale), scale=scale)
+
+    if FLAGS.write_normalised:
+        out_path = os.path.join(FLAGS.parsed_replays, 'global_normal')
+        if not os.path.isdir(out_path):
+            os.makedirs(out_path)
 
-    for replay in tqdm(replays, desc='Normalising'):
-        global_np = np.asarray(sparse.load_npz(os.path.join(FLAGS.parsed_replays, 'global', f"{replay}.glo.npz")).todense())
-        global_np /= max_cols
-        sparse.save_npz(os.path.join(out_path, f"{replay}.glo"), sparse.csc_matrix(global_np)) # Global tensor
+        with multiprocessing.Pool(FLAGS.n_workers) as pool:
+            for _ in tqdm(pool.imap_unordered(normalise_replay, [(replay, scale[np.newaxis, :]) for replay in replays]),
+                          total=len(replays), desc='Normalising'):
+                pass
 
 if __name__ == '__main__':
-    app.run(postprocess)
\ No newline at end of file
+    app.run(postprocess)
@@ -1,10 +1,15 @@
 import os
+import sys
 import json
 import glob
+import signal
+import queue as Queue
+import multiprocessing
 from absl import app
 from absl import flags
 from tqdm import tqdm
 from itertools import chain
+from collections import Counter
 
 from google.protobuf.json_format import Parse
 
@@ -12,12 +17,23 @@ from pysc2 import run_configs
 from s2clientprotocol import sc2api_pb2 as sc_pb
 from s2clientprotocol import common_pb2 as common_pb
 
+from replay_cache import ReplayCache
+from replay_header import read_replay_info
+
 FLAGS = flags.FLAGS
 flags.DEFINE_string(name='replays_paths', default='./;',
                     help='Paths for replays, split by ;')
 flags.DEFINE_string(name='save_path', default='../replay_library',
                     help='Path for saving results')
 
+flags.DEFINE_integer(name='n_instance', default=1,
+                     help='# of game instances querying replay info')
+flags.DEFINE_boolean(name='header_filter', default=False,
+                     help='Filter replays on what can be read from their files before asking the game client. Check '
+                          'read_replay_info against the client with validate_header.py first')
+flags.DEFINE_integer(name='n_readers', default=os.cpu_count(),
+                     help='# of processes reading replay files for the header filter')
+
 flags.DEFINE_integer(name='min_duration', default=8000,
                      help='Min duration')
 flags.DEFINE_integer(name='max_duration', default=80000,
@@ -27,49 +43,192 @@ flags.DEFINE_integer(name='min_apm', default=10,
 flags.DEFINE_integer(name='min_mmr', default=1000,
                      help='Min MMR')
 
-def get_replay_info(run_config, controller, replay_path):
-    replay_data = run_config.replay_data(replay_path)
+def info_to_dict(info):
+    """The parts of a ResponseReplayInfo the filters and the library need"""
+    return {
+        'map': info.map_name,
+        'base_build': info.base_build,
+        'duration_seconds': info.game_duration_seconds,
+        'duration_frames': info.game_duration_loops,
+        'players': [{
+            'id': p.player_info.player_id,
+            'race': common_pb.Race.Name(p.player_info.race_actual),
+            'result': p.player_result.result,
+            'apm': p.player_apm,
+            'mmr': p.player_mmr
+        } for p in info.player_info]
+    }
 
-    try:
-        info = controller.replay_info(replay_data) # Get high level replay info
-    except Exception:
-        print('Unable to get replay data for', replay_path)
-        return None
-
-    if info.HasField("error"):
-        return None
-    if info.base_build != controller.ping().base_build: # Make sure replay has same version
-        return None
-    if info.game_duration_loops < FLAGS.min_duration:
-        return None
-    if info.game_duration_loops > FLAGS.max_duration:
-        return None
-    if len(info.player_info) != 2:
-        return None
+def get_replay_info(info, base_build, replay_path):
+    """
+    Library entry for a replay, or None and the reason it was rejected
+
+    Fields that are None (what read_replay_info couldn't get) pass every filter
+    """
+    def below(value, minimum):
+        return value is not None and value < minimum
+
+    if info['base_build'] is not None and info['base_build'] != base_build: # Make sure replay has same version
+        return None, 'base_build'
+    if below(info['duration_frames'], FLAGS.min_duration):
+        return None, 'min_duration'
+    if info['duration_frames'] is not None and info['duration_frames'] > FLAGS.max_duration:
+        return None, 'max_duration'
+    if len(info['players']) != 2:
+        return None, 'players'
 
     replay_info = {
         'path': replay_path,
-        'map': info.map_name,
-        'duration_seconds': info.game_duration_seconds,
-        'duration_frames': info.game_duration_loops,
+        'map': info['map'],
+        'duration_seconds': info['duration_seconds'],
+        'duration_frames': info['duration_frames'],
         'players': []
     }
 
-    for p in info.player_info:
-        if p.player_apm < FLAGS.min_apm or p.player_mmr < FLAGS.min_mmr:
-            return None
-        if p.player_result.result not in {1, 2}: # 1 is victory, 2 is defeat
-            return None
+    for p in info['players']:
+        if below(p['apm'], FLAGS.min_apm):
+            return None, 'min_apm'
+        if below(p['mmr'], FLAGS.min_mmr):
+            return None, 'min_mmr'
+        if p['result'] is not None and p['result'] not in {1, 2}: # 1 is victory, 2 is defeat
+            return None, 'result'
 
         replay_info['players'].append({
-            'id': p.player_info.player_id,
-            'race': common_pb.Race.Name(p.player_info.race_actual),
-            'result': 2 - p.player_result.result,
-            'apm': p.player_apm,
-            'mmr': p.player_mmr
+            'id': p['id'],
+            'race': p['race'],
+            'result': 2 - p['result'] if p['result'] is not None else None,
+            'apm': p['apm'],
+            'mmr': p['mmr']
         })
 
-    return replay_info
+    return replay_info, None
+
+def read_header(task):
+    """Pool worker: (path, hash) -> (hash, info read from the file, None if it can't be read)"""
+    replay_path, digest = task
+    try:
+        return digest, read_replay_info(replay_path)
+    except Exception:
+        return digest, None
+
+def read_headers(cache, tasks):
+    """Read replay info straight from the files across a process pool, caching it for the filters"""
+    n_read = 0
+    with multiprocessing.Pool(FLAGS.n_readers) as pool:
+        for digest, info in tqdm(pool.imap_unordered(read_header, tasks, chunksize=16), total=len(tasks),
+                                 desc='Headers read'):
+            if info is not None:
+                cache.put(digest, info, None, 'header')
+                n_read += 1
+
+    print(n_read, 'of', len(tasks), 'headers read')
+
+def needs_client(cached, base_build, replay_path):
+    """
+    Whether a replay still has to go through the game client: never read, or only read from its header and not
+    rejected by it. Header rejections only hold while header_filter is on, they're never final in the cache
+    """
+    if cached is None:
+        return True
+
+    info, error, source = cached
+    return source == 'header' and (not FLAGS.header_filter or get_replay_info(info, base_build, replay_path)[1] is None)
+
+class ReplayInfoProcessor(multiprocessing.Process):
+    """A Process with its own game instance, querying replay info for (path, hash) tasks until it gets None"""
+    def __init__(self, run_config, task_queue, result_queue):
+        super(ReplayInfoProcessor, self).__init__()
+        self.run_config = run_config
+        self.task_queue = task_queue
+        self.result_queue = result_queue
+
+    def run(self):
+        signal.signal(signal.SIGTERM, lambda a, b: sys.exit())
+        while True:
+            with self.run_config.start() as controller:
+                self.result_queue.put(('base_build', controller.ping().base_build))
+
+                while True:
+                    task = self.task_queue.get()
+                    if task is None:
+                        return
+
+                    replay_path, digest = task
+                    try:
+                        info = controller.replay_info(self.run_config.replay_data(replay_path)) # Get high level replay info
+                    except Exception:
+                        print('Unable to get replay data for', replay_path)
+                        self.result_queue.put(('failed', digest)) # Not cached, it's retried on the next run
+                        if not self.healthy(controller):
+                            break # Relaunch the instance
+                        continue
+
+                    if info.HasField("error"):
+                        self.result_queue.put(('replay', digest, None, sc_pb.ResponseReplayInfo.Error.Name(info.error)))
+                    else:
+                        self.result_queue.put(('replay', digest, info_to_dict(info), None))
+
+    @staticmethod
+    def healthy(controller):
+        try:
+            controller.ping()
+            return True
+        except Exception:
+            return False
+
+def client_version(run_config):
+    """Version of the client pysc2 would launch now"""
+    return f'{run_config.version.game_version} ({run_config.version.build_version})'
+
+def client_base_build(run_config, cache):
+    """
+    Base build of the client pysc2 would launch now: as last reported by one of its instances, or from its version if
+    none has run since the client changed
+    """
+    base_build = cache.get_meta('base_build')
+    if base_build is None or cache.get_meta('client_version') != client_version(run_config):
+        return run_config.version.build_version
+
+    return int(base_build)
+
+def query_replays(run_config, cache, tasks):
+    """Query replay info for (path, hash) tasks across n_instance game instances, caching results as they arrive"""
+    task_queue = multiprocessing.Queue()
+    result_queue = multiprocessing.Queue()
+    for task in tasks:
+        task_queue.put(task)
+
+    workers = []
+    for _ in range(min(FLAGS.n_instance, len(tasks))):
+        task_queue.put(None)
+        worker = ReplayInfoProcessor(run_config, task_queue, result_queue)
+        worker.daemon = True
+        worker.start()
+        workers.append(worker)
+
+    n_done = 0
+    with tqdm(total=len(tasks), desc='Replays queried') as pbar:
+        while n_done < len(tasks):
+            try:
+                result = result_queue.get(timeout=10)
+            except Queue.Empty:
+                if not any(worker.is_alive() for worker in workers):
+                    print('Every instance exited with', len(tasks) - n_done, 'replays left')
+                    break
+                continue
+
+            if result[0] == 'base_build':
+                cache.set_meta('base_build', result[1])
+                cache.set_meta('client_version', client_version(run_config))
+                continue
+            if result[0] == 'replay':
+                cache.put(*result[1:])
+
+            n_done += 1
+            pbar.update()
+
+    for worker in workers:
+        worker.join(timeout=10)
 
 def preprocess(argv):
 
@@ -77,45 +236,82 @@ def preprocess(argv):
         os.makedirs(FLAGS.save_path)
 
     run_config = run_configs.get()
-    replay_list = sorted(chain(*[run_config.replay_paths(path)
+    replay_list = sorted(set(chain(*[run_config.replay_paths(path)
                             for path in FLAGS.replays_paths.split(';')
-                                if len(path.strip()) > 0]))
+                                if len(path.strip()) > 0])))
 
     result = {}
     stats = {}
     totals = {}
+    rejected = Counter()
 
     min_frames = 999999999
 
+    cache = ReplayCache(FLAGS.save_path)
+
     try:
-        with run_config.start() as controller:
+        # Same contents under several paths are parsed once, from the first path
+        replay_hashes = {}
+        duplicates = []
+        for replay_path in tqdm(replay_list, desc='Hashing replays'):
+            digest = cache.file_hash(replay_path)
+            if digest in replay_hashes:
+                duplicates.append((replay_path, replay_hashes[digest]))
+            else:
+                replay_hashes[digest] = replay_path
 
-            pbar = tqdm(total=len(replay_list), desc='Replays processed')
+        if duplicates:
+            print('Dropped', len(duplicates), 'duplicate replays')
 
-            for replay_path in replay_list:
-                replay_info = get_replay_info(run_config, controller, replay_path)
+        base_build = client_base_build(run_config, cache)
 
-                if replay_info is not None:
+        tasks = [(replay_path, digest) for digest, replay_path in replay_hashes.items() if cache.get(digest) is None]
+        print(len(replay_hashes) - len(tasks), 'replays cached,', len(tasks), 'to read')
+        if FLAGS.header_filter and tasks:
+            read_headers(cache, tasks)
 
-                    races = '_vs_'.join(sorted(player['race'] for player in replay_info['players']))
-                    if races not in result:
-                        result[races] = []
-                        totals[races] = 0
+        # Only what the header filter couldn't reject goes through the game client
+        tasks = [(replay_path, digest) for digest, replay_path in replay_hashes.items()
+                 if needs_client(cache.get(digest), base_build, replay_path)]
+        if tasks:
+            query_replays(run_config, cache, tasks)
 
-                    min_frames = min(min_frames, replay_info['duration_frames'])
+        base_build = client_base_build(run_config, cache)
 
-                    totals[races] += 1
-                    result[races].append(replay_info) # Save based on race vs race
+        for digest, replay_path in replay_hashes.items():
+            cached = cache.get(digest)
+            if needs_client(cached, base_build, replay_path): # The game client failed on it this time
+                rejected['unreadable'] += 1
+                continue
 
-                    if replay_info['map'] not in stats:
-                        stats[replay_info['map']] = {}
+            info, error, source = cached
+            if error is not None:
+                rejected[error] += 1
+                continue
 
-                    if races not in stats[replay_info['map']]:
-                        stats[replay_info['map']][races] = 0
+            replay_info, reason = get_replay_info(info, base_build, replay_path)
 
-                    stats[replay_info['map']][races] += 1
-                
-                pbar.update()
+            if replay_info is not None:
+
+                races = '_vs_'.join(sorted(player['race'] for player in replay_info['players']))
+                if races not in result:
+                    result[races] = []
+                    totals[races] = 0
+
+                min_frames = min(min_frames, replay_info['duration_frames'])
+
+                totals[races] += 1
+                result[races].append(replay_info) # Save based on race vs race
+
+                if replay_info['map'] not in stats:
+                    stats[replay_info['map']] = {}
+
+                if races not in stats[replay_info['map']]:
+                    stats[replay_info['map']][races] = 0
+
+                stats[replay_info['map']][races] += 1
+            else:
+                rejected[reason] += 1
 
         for k, v in result.items():
             with open(os.path.join(FLAGS.save_path, k+'.json'), 'w') as f:
@@ -134,9 +330,19 @@ def preprocess(argv):
 
                 f.write("\n")
 
+            f.write("Rejected\n")
+            for k, v in sorted(rejected.items()):
+                f.write(f"    {k} {v}\n")
+
+            f.write(f"\nDuplicates {len(duplicates)}\n")
+            for replay_path, original_path in duplicates:
+                f.write(f"    {replay_path} {original_path}\n")
+
         print(min_frames)
     except KeyboardInterrupt:
         print("Caught KeyboardInterrupt, exiting.")
+    finally:
+        cache.close()
 
 if __name__ == '__main__':
     app.run(preprocess)
\ No newline at end of file
@@ -0,0 +1,70 @@
+import os
+import json
+import hashlib
+import sqlite3
+
+CACHE = 'replay_cache.sqlite'
+
+
+def content_hash(replay_data):
+    return hashlib.sha1(replay_data).hexdigest()
+
+
+class ReplayCache:
+    """
+    Persistent replay info, keyed by a hash of the replay file's contents
+
+    replays holds what was read of a replay (as a json dict, see preprocess.info_to_dict) or why it couldn't be read,
+    so filters can be re-applied on every run without asking the client again. source is 'client' for what the game
+    client reported, 'header' for what read_replay_info got from the file, which may be incomplete. files maps a path
+    to its hash by size and modification time, so unchanged files aren't even re-read
+    """
+    def __init__(self, save_path):
+        self.path = os.path.join(save_path, CACHE)
+        self.conn = sqlite3.connect(self.path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime REAL, hash TEXT)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS replays (hash TEXT PRIMARY KEY, info TEXT, error TEXT, source TEXT)')
+        if 'source' not in [column[1] for column in self.conn.execute('PRAGMA table_info(replays)')]:
+            self.conn.execute("ALTER TABLE replays ADD COLUMN source TEXT DEFAULT 'client'") # Caches from before headers were read
+        self.conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        self.conn.commit()
+
+    def file_hash(self, path):
+        """Hash of a file, only read if it's new or changed since it was last hashed"""
+        stat = os.stat(path)
+        row = self.conn.execute('SELECT size, mtime, hash FROM files WHERE path = ?', (path,)).fetchone()
+        if row is not None and row[0] == stat.st_size and row[1] == stat.st_mtime:
+            return row[2]
+
+        with open(path, 'rb') as f:
+            digest = content_hash(f.read())
+
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)', (path, stat.st_size, stat.st_mtime, digest))
+
+        return digest
+
+    def get(self, digest):
+        """(info dict, error, source) of a replay, None if it has never been read"""
+        row = self.conn.execute('SELECT info, error, source FROM replays WHERE hash = ?', (digest,)).fetchone()
+        if row is None:
+            return None
+
+        return (json.loads(row[0]) if row[0] is not None else None), row[1], row[2]
+
+    def put(self, digest, info, error, source='client'):
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO replays VALUES (?, ?, ?, ?)',
+                              (digest, json.dumps(info) if info is not None else None, error, source))
+
+    def get_meta(self, key):
+        row = self.conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row is not None else None
+
+    def set_meta(self, key, value):
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', (key, str(value)))
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,238 @@
+import bz2
+import json
+import zlib
+import struct
+
+# Block table flags
+FILE_COMPRESS = 0x00000200
+FILE_ENCRYPTED = 0x00010000
+FILE_SINGLE_UNIT = 0x01000000
+FILE_EXISTS = 0x80000000
+
+HASH_TYPES = {'TABLE_OFFSET': 0, 'HASH_A': 1, 'HASH_B': 2, 'TABLE': 3}
+
+RACES = {'Prot': 'Protoss', 'Terr': 'Terran', 'Zerg': 'Zerg', 'Protoss': 'Protoss', 'Terran': 'Terran'}
+RESULTS = {'Win': 1, 'Loss': 2, 'Tie': 3, 'Undecided': 4} # As sc2api's Result
+
+GAME_LOOPS_PER_SECOND = 22.4 # At faster speed, which replay_info reports durations in
+
+
+def crypt_table():
+    seed = 0x00100001
+    table = [0] * 0x500
+    for i in range(0x100):
+        for j in range(5):
+            seed = (seed * 125 + 3) % 0x2AAAAB
+            high = (seed & 0xFFFF) << 16
+            seed = (seed * 125 + 3) % 0x2AAAAB
+            table[i + j * 0x100] = high | (seed & 0xFFFF)
+
+    return table
+
+CRYPT_TABLE = crypt_table()
+
+
+def mpq_hash(name, hash_type):
+    seed1, seed2 = 0x7FED7FED, 0xEEEEEEEE
+    for ch in name.upper().encode():
+        seed1 = (CRYPT_TABLE[(HASH_TYPES[hash_type] << 8) + ch] ^ (seed1 + seed2)) & 0xFFFFFFFF
+        seed2 = (ch + seed1 + seed2 + (seed2 << 5) + 3) & 0xFFFFFFFF
+
+    return seed1
+
+
+def decrypt(data, key):
+    seed2 = 0xEEEEEEEE
+    values = list(struct.unpack(f'<{len(data) // 4}I', data[:len(data) // 4 * 4]))
+    for i, value in enumerate(values):
+        seed2 = (seed2 + CRYPT_TABLE[0x400 + (key & 0xFF)]) & 0xFFFFFFFF
+        value = (value ^ (key + seed2)) & 0xFFFFFFFF
+        key = (((~key << 21) + 0x11111111) | (key >> 11)) & 0xFFFFFFFF
+        seed2 = (value + seed2 + (seed2 << 5) + 3) & 0xFFFFFFFF
+        values[i] = value
+
+    return values
+
+
+class ReplayArchive:
+    """
+    Minimal reader for the MPQ archive a .SC2Replay is
+
+    Only what's needed to get at the replay header (stored as the archive's user data) and a few small files:
+    hash/block table decryption, single unit and sectored files, zlib and bzip2 compression. Anything else (encrypted
+    files, other compressions) raises ValueError
+    """
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.data = f.read()
+
+        magic, = struct.unpack_from('<4s', self.data, 0)
+        self.user_data = None
+        self.offset = 0
+        if magic == b'MPQ\x1b':
+            _, self.offset, user_data_header_size = struct.unpack_from('<3I', self.data, 4)
+            self.user_data = self.data[16:16 + user_data_header_size]
+        elif magic != b'MPQ\x1a':
+            raise ValueError('Not an MPQ archive')
+
+        magic, _, _, _, self.sector_shift, hash_offset, block_offset, n_hashes, n_blocks = \
+            struct.unpack_from('<4s2I2H4I', self.data, self.offset)
+        if magic != b'MPQ\x1a':
+            raise ValueError('Missing MPQ header')
+
+        hashes = self.read_table(hash_offset, n_hashes, '(hash table)')
+        blocks = self.read_table(block_offset, n_blocks, '(block table)')
+        self.hash_table = [tuple(hashes[i * 4:i * 4 + 4]) for i in range(n_hashes)]   # hash_a, hash_b, locale|platform, block
+        self.block_table = [tuple(blocks[i * 4:i * 4 + 4]) for i in range(n_blocks)]  # offset, archived size, size, flags
+
+    def read_table(self, offset, n_entries, name):
+        start = self.offset + offset
+        return decrypt(self.data[start:start + n_entries * 16], mpq_hash(name, 'TABLE'))
+
+    def read_file(self, name):
+        """Contents of a file in the archive, None if it isn't there"""
+        hash_a, hash_b = mpq_hash(name, 'HASH_A'), mpq_hash(name, 'HASH_B')
+        block_idx = next((entry[3] for entry in self.hash_table if entry[0] == hash_a and entry[1] == hash_b), None)
+        if block_idx is None or block_idx >= len(self.block_table):
+            return None
+
+        offset, archived_size, size, flags = self.block_table[block_idx]
+        if not flags & FILE_EXISTS:
+            return None
+        if flags & FILE_ENCRYPTED:
+            raise ValueError(f'{name} is encrypted')
+
+        data = self.data[self.offset + offset:self.offset + offset + archived_size]
+
+        if flags & FILE_SINGLE_UNIT:
+            return self.decompress(data) if flags & FILE_COMPRESS and size > archived_size else data
+
+        # Sectored file, a table of sector offsets followed by sectors compressed one by one
+        sector_size = 512 << self.sector_shift
+        n_sectors = (size + sector_size - 1) // sector_size
+        positions = struct.unpack_from(f'<{n_sectors + 1}I', data, 0)
+
+        sectors = []
+        left = size
+        for i in range(n_sectors):
+            sector = data[positions[i]:positions[i + 1]]
+            expected = min(sector_size, left)
+            if flags & FILE_COMPRESS and len(sector) < expected:
+                sector = self.decompress(sector)
+            sectors.append(sector)
+            left -= len(sector)
+
+        return b''.join(sectors)
+
+    @staticmethod
+    def decompress(data):
+        if data[0] == 0x02:
+            return zlib.decompress(data[1:])
+        if data[0] == 0x10:
+            return bz2.decompress(data[1:])
+
+        raise ValueError(f'Unsupported compression {data[0]:#x}')
+
+
+class VersionedReader:
+    """
+    Decoder for Blizzard's self describing "versioned" serialisation (replay header and details)
+
+    Structs come back as {tag: value} dicts, the tags of the fields read here have been the same in every protocol
+    """
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def byte(self):
+        self.pos += 1
+        return self.data[self.pos - 1]
+
+    def bytes(self, n):
+        self.pos += n
+        return self.data[self.pos - n:self.pos]
+
+    def vint(self):
+        b = self.byte()
+        negative = b & 1
+        value = (b >> 1) & 0x3F
+        shift = 6
+        while b & 0x80:
+            b = self.byte()
+            value |= (b & 0x7F) << shift
+            shift += 7
+
+        return -value if negative else value
+
+    def read(self):
+        kind = self.byte()
+        if kind == 0: # Array
+            return [self.read() for _ in range(self.vint())]
+        if kind == 1: # Bit array
+            length = self.vint()
+            return self.bytes((length + 7) // 8)
+        if kind == 2: # Blob
+            return self.bytes(self.vint())
+        if kind == 3: # Choice
+            tag = self.vint()
+            return {tag: self.read()}
+        if kind == 4: # Optional
+            return self.read() if self.byte() != 0 else None
+        if kind == 5: # Struct
+            return {self.vint(): self.read() for _ in range(self.vint())}
+        if kind == 6: # u8
+            return self.byte()
+        if kind == 7: # u32
+            return struct.unpack('>I', self.bytes(4))[0]
+        if kind == 8: # u64
+            return struct.unpack('>Q', self.bytes(8))[0]
+        if kind == 9: # vint
+            return self.vint()
+
+        raise ValueError(f'Unknown versioned type {kind}')
+
+
+def read_replay_info(path):
+    """
+    Replay info from a .SC2Replay without the game client, in the form preprocess.info_to_dict gives
+
+    Durations and base build come from the replay header, map, races and results from replay.details, APM and MMR
+    from replay.gamemetadata.json where the replay has one. Anything that can't be read is None
+    """
+    archive = ReplayArchive(path)
+    if archive.user_data is None:
+        raise ValueError('Missing replay header')
+
+    header = VersionedReader(archive.user_data).read()
+    details = VersionedReader(archive.read_file('replay.details')).read()
+
+    metadata_file = archive.read_file('replay.gamemetadata.json')
+    metadata = json.loads(metadata_file.decode()) if metadata_file else {}
+    metadata_players = {p.get('PlayerID'): p for p in metadata.get('Players', [])}
+
+    loops = header.get(3)
+    info = {
+        'map': details[1].decode() if isinstance(details.get(1), bytes) else None,
+        'base_build': header.get(1, {}).get(5),
+        'duration_seconds': loops / GAME_LOOPS_PER_SECOND if loops is not None else None,
+        'duration_frames': loops,
+        'players': []
+    }
+
+    for i, player in enumerate(details.get(0) or [], start=1):
+        if player.get(7, 0) != 0: # Observer
+            continue
+
+        extra = metadata_players.get(i, {})
+        race = extra.get('AssignedRace') or player.get(2, b'').decode(errors='replace')
+        result = player.get(8) or RESULTS.get(extra.get('Result'))
+
+        info['players'].append({
+            'id': i,
+            'race': RACES.get(race),
+            'result': result if result else None,
+            'apm': extra.get('APM'),
+            'mmr': extra.get('MMR')
+        })
+
+    return info
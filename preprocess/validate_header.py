@@ -0,0 +1,95 @@
+from preprocess import get_replay_info
+from replay_cache import ReplayCache
+from replay_header import read_replay_info
+
+import os
+import sqlite3
+from absl import app
+from absl import flags
+from collections import Counter
+
+from tqdm import tqdm
+
+FLAGS = flags.FLAGS
+flags.DEFINE_integer(name='sample', default=1000,
+                     help='# of client queried replays to compare, 0 for all')
+flags.DEFINE_float(name='duration_tolerance', default=1.0,
+                   help='Seconds duration_seconds may differ by')
+
+
+def compare(header, client, counts):
+    """Count agreement of every field between what the header reader and the game client got for a replay"""
+    def check(field, header_value, client_value, equal=lambda a, b: a == b):
+        if header_value is None:
+            counts[field, 'missing'] += 1
+        elif equal(header_value, client_value):
+            counts[field, 'equal'] += 1
+        else:
+            counts[field, 'different'] += 1
+
+    check('map', header['map'], client['map'])
+    check('base_build', header['base_build'], client['base_build'])
+    check('duration_frames', header['duration_frames'], client['duration_frames'])
+    check('duration_seconds', header['duration_seconds'], client['duration_seconds'],
+          lambda a, b: abs(a - b) <= FLAGS.duration_tolerance)
+    check('players', len(header['players']), len(client['players']))
+
+    client_players = {p['id']: p for p in client['players']}
+    for p in header['players']:
+        if p['id'] not in client_players:
+            counts['player_id', 'different'] += 1
+            continue
+
+        for field in ['race', 'result', 'apm', 'mmr']:
+            check(field, p[field], client_players[p['id']][field])
+
+def validate(argv):
+    """Compare read_replay_info with what the game client reported for replays in the preprocess cache"""
+    cache = ReplayCache(FLAGS.save_path)
+    base_build = cache.get_meta('base_build')
+    base_build = int(base_build) if base_build is not None else None
+
+    conn = sqlite3.connect(cache.path)
+    rows = conn.execute("SELECT path, replays.hash FROM files JOIN replays ON files.hash = replays.hash "
+                        "WHERE source = 'client' AND info IS NOT NULL GROUP BY replays.hash ORDER BY path").fetchall()
+    conn.close()
+    if FLAGS.sample > 0:
+        rows = rows[::max(len(rows) // FLAGS.sample, 1)][:FLAGS.sample]
+
+    counts = Counter()
+    decisions = Counter()
+    for replay_path, digest in tqdm(rows, desc='Validating'):
+        if not os.path.isfile(replay_path):
+            continue
+
+        try:
+            header = read_replay_info(replay_path)
+        except Exception:
+            counts['file', 'unreadable'] += 1
+            continue
+
+        client = cache.get(digest)[0]
+        compare(header, client, counts)
+
+        # The header filter may only reject what the client's info would have rejected as well
+        header_reason = get_replay_info(header, base_build, replay_path)[1]
+        client_reason = get_replay_info(client, base_build, replay_path)[1]
+        if header_reason is None:
+            decisions['passed to client'] += 1
+        elif client_reason is not None:
+            decisions['rejected, agreeing'] += 1
+        else:
+            decisions['rejected, client accepts'] += 1
+            print('Wrongly rejected', replay_path, header_reason)
+
+    cache.close()
+
+    print(f"{len(rows)} replays")
+    for field in sorted({field for field, _ in counts}):
+        print(f"{field:>17} " + ' '.join(f"{outcome} {counts[field, outcome]}"
+                                        for outcome in ['equal', 'different', 'missing', 'unreadable']
+                                        if counts[field, outcome] > 0))
+    print('Filter', dict(decisions))
+
+if __name__ == '__main__':
+    app.run(validate)